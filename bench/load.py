@@ -0,0 +1,388 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+from throughput import ROOT, start_relay
+
+sys.path.insert(0, ROOT)
+from functions.net import encode_frame, read_frame, Deflater, Inflater, FRAME_HEADER, FROM_LEN, F_DEFLATE, K_CONTROL, K_DELIVER, K_CHAT, K_ROOM
+
+# Load generator for the relay. Every scenario starts a fresh relay, opens the
+# clients in one event loop and speaks the real protocol:
+#   send     clients/2 pairs, each sender `send`s to its receiver
+#   chat     clients/2 pairs do chat_request/chat_accept, then chat_message
+#   fanin    clients-1 senders `send` to one sink
+#   room     every client joins one room and --room-senders of them post to it
+#   idle     clients just stay connected; a sample of them measures ping RTT
+# `--idle N` adds N silent connections to any scenario; `--compress` makes binary
+# clients ask for stream compression. Payloads start with the send time
+# (perf_counter_ns, 20 digits) so receivers can compute delivery latency.
+SCENARIOS = ("send", "chat", "fanin", "room", "idle")
+STAMP = 20
+PAGE = os.sysconf("SC_PAGE_SIZE")
+TICK = os.sysconf("SC_CLK_TCK")
+
+class Client:
+    __slots__ = ("reader", "writer", "binary", "deflate", "inflate", "wire_in", "seq")
+
+    def __init__(self, reader, writer, binary: bool, compress: bool = False):
+        self.reader = reader
+        self.writer = writer
+        self.binary = binary
+        self.deflate = Deflater() if compress else None
+        self.inflate = Inflater() if compress else None
+        self.wire_in = 0   # bytes received after register
+        self.seq = 0   # last message seq, with --seq
+
+    def send(self, obj: dict):
+        if self.binary:
+            frame = encode_frame(obj)
+            self.writer.write(self.deflate.pack(frame) if self.deflate else frame)
+        else:
+            self.writer.write((json.dumps(obj) + "\n").encode("utf-8"))
+
+    # -> (type, payload); payload is str (json) or bytes (binary) for messages
+    async def recv(self):
+        if not self.binary:
+            line = await self.reader.readline()
+            if not line:
+                raise EOFError
+            self.wire_in += len(line)
+            msg = json.loads(line)
+            return msg.get("type"), msg.get("payload")
+        kind, flags, target, payload = await read_frame(self.reader)
+        self.wire_in += FRAME_HEADER.size + len(target) + len(payload)
+        if flags & F_DEFLATE:
+            _, payload = self.inflate.unpack(payload)
+        if kind == K_DELIVER:
+            return "deliver", bytes(payload)
+        if kind == K_CHAT:
+            return "chat_message", bytes(payload)
+        if kind == K_ROOM:
+            (flen,) = FROM_LEN.unpack_from(payload)
+            return "room_message", bytes(payload[2 + flen :])
+        msg = json.loads(bytes(payload).decode("utf-8")) if kind == K_CONTROL else {}
+        return msg.get("type"), msg.get("payload")
+
+    def close(self):
+        self.writer.close()
+
+async def open_client(port: int, cid: str, framing: str, compress: bool) -> Client:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=1 << 20)
+    hello = {"type": "register", "id": cid}
+    if framing == "bin":
+        hello["framing"] = ["bin"]
+        if compress:
+            hello["compress"] = ["deflate"]
+    writer.write((json.dumps(hello) + "\n").encode("utf-8"))
+    await writer.drain()
+    reply = json.loads(await reader.readline())
+    return Client(reader, writer, reply.get("framing") == "bin", reply.get("compress") == "deflate")
+
+async def open_clients(port: int, names: List[str], framing: str, compress: bool = False, batch: int = 256) -> List[Client]:
+    clients = []
+    for i in range(0, len(names), batch):
+        clients += await asyncio.gather(*(open_client(port, n, framing, compress) for n in names[i : i + batch]))
+    return clients
+
+async def wait_for_relay(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, w = await asyncio.open_connection("127.0.0.1", port)
+            w.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+# relay process plus its workers
+def process_tree(root: int) -> List[int]:
+    parents = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    parents[int(name)] = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                pass
+    tree = [root]
+    for pid in tree:
+        tree += [p for p, pp in parents.items() if pp == pid]
+    return tree
+
+def usage(root: int):
+    rss = ticks = 0
+    for pid in process_tree(root):
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                rss += int(f.read().split()[1]) * PAGE
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+                ticks += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            pass
+    return rss, ticks / TICK
+
+def own_cpu() -> float:
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return ru.ru_utime + ru.ru_stime
+
+def percentiles(samples: List[int]) -> dict:
+    if not samples:
+        return {}
+    samples.sort()
+    pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] / 1e6, 3)
+    return {"p50": pick(0.5), "p99": pick(0.99), "p999": pick(0.999), "max": round(samples[-1] / 1e6, 3)}
+
+class Receipts:
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.received = 0
+        self.replies = 0   # frames that were not messages: sent, ack, ...
+        self.latencies: List[int] = []
+        self.done = asyncio.Event()
+        if expected <= 0:
+            self.done.set()
+
+    def record(self, payload):
+        self.latencies.append(time.perf_counter_ns() - int(payload[:STAMP]))
+        self.received += 1
+        if self.received >= self.expected:
+            self.done.set()
+
+async def consume(client: Client, receipts: Receipts):
+    try:
+        while True:
+            mtype, payload = await client.recv()
+            if mtype in ("deliver", "chat_message", "room_message"):
+                receipts.record(payload)
+            else:
+                receipts.replies += 1
+    except (EOFError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+
+async def pump(client: Client, mtype: str, to: str, messages: int, pad: str, interval: float, seq: bool):
+    key = "room" if mtype == "room_message" else "to"
+    due = time.perf_counter()
+    for _ in range(messages):
+        msg = {"type": mtype, key: to, "payload": f"{time.perf_counter_ns():020d}{pad}"}
+        if seq:
+            client.seq += 1
+            msg["seq"] = client.seq
+        client.send(msg)
+        await client.writer.drain()
+        if interval:
+            due += interval
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+async def handshake(a: Client, b: Client, b_id: str, a_id: str):
+    a.send({"type": "chat_request", "to": b_id})
+    await a.writer.drain()
+    while (await b.recv())[0] != "chat_request":
+        pass
+    b.send({"type": "chat_accept"})
+    await b.writer.drain()
+    while (await a.recv())[0] != "chat_accept":
+        pass
+    while (await b.recv())[0] != "chat_accept":
+        pass
+
+async def join(client: Client, room: str):
+    client.send({"type": "join", "room": room})
+    await client.writer.drain()
+    while (await client.recv())[0] != "joined":
+        pass
+
+async def ping_probe(client: Client, count: int, samples: List[int]):
+    for _ in range(count):
+        started = time.perf_counter_ns()
+        client.send({"type": "ping"})
+        await client.writer.drain()
+        while (await client.recv())[0] != "pong":
+            pass
+        samples.append(time.perf_counter_ns() - started)
+
+async def run(args, proc: subprocess.Popen) -> dict:
+    await wait_for_relay(args.port)
+    await asyncio.sleep(0.2)
+    rss_before, _ = usage(proc.pid)
+
+    scenario = args.scenario
+    names = [f"c{i}" for i in range(args.clients)]
+    idle_names = [f"idle{i}" for i in range(args.idle)]
+    started = time.perf_counter()
+    clients = await open_clients(args.port, names, args.framing, args.compress)
+    await asyncio.sleep(0.2)
+    rss_active, _ = usage(proc.pid)
+    clients += await open_clients(args.port, idle_names, args.framing, args.compress)
+    connect_secs = time.perf_counter() - started
+    await asyncio.sleep(0.2)
+    rss_after, cpu_start = usage(proc.pid)
+    # every client of the idle scenario is idle; otherwise only the --idle ones
+    if scenario == "idle":
+        idle_bytes = (rss_after - rss_before) / max(1, len(clients))
+    else:
+        idle_bytes = (rss_after - rss_active) / args.idle if args.idle else None
+    own_start = own_cpu()
+
+    pad = "x" * max(0, args.size - STAMP)
+    interval = 1.0 / args.rate if args.rate else 0.0
+    active = clients[: args.clients]
+    samples: List[int] = []
+    readers = []
+    complete = True
+    replies = 0
+    started = time.perf_counter()
+
+    if scenario == "idle":
+        await asyncio.sleep(args.duration)
+        probes = active[: args.probes]
+        started = time.perf_counter()
+        await asyncio.gather(*(ping_probe(c, args.messages, samples) for c in probes))
+        sent = received = len(samples)
+    else:
+        if scenario == "room":
+            senders = active[: args.room_senders]
+            await asyncio.gather(*(join(c, "bench") for c in active))
+            receipts = Receipts(len(senders) * args.messages * (len(active) - 1))
+            flows = [(c, "bench") for c in senders]
+            readers = [consume(c, receipts) for c in active]
+        elif scenario == "fanin":
+            senders = active[1:]
+            receipts = Receipts(len(senders) * args.messages)
+            flows = [(c, names[0]) for c in senders]
+            readers = [consume(c, receipts) for c in active]
+        else:
+            pairs = len(active) // 2
+            receipts = Receipts(pairs * args.messages)
+            flows = [(active[2 * i], names[2 * i + 1]) for i in range(pairs)]
+            if scenario == "chat":
+                hs = time.perf_counter()
+                await asyncio.gather(*(
+                    handshake(active[2 * i], active[2 * i + 1], names[2 * i + 1], names[2 * i]) for i in range(pairs)
+                ))
+                handshake_secs = time.perf_counter() - hs
+            readers = [consume(c, receipts) for c in active[: 2 * pairs]]
+        mtype = {"chat": "chat_message", "room": "room_message"}.get(scenario, "send")
+        tasks = [asyncio.ensure_future(r) for r in readers]
+        started = time.perf_counter()
+        senders_done = asyncio.gather(*(pump(c, mtype, to, args.messages, pad, interval, args.seq) for c, to in flows))
+        try:
+            await asyncio.wait_for(asyncio.gather(senders_done, receipts.done.wait()), args.timeout)
+        except asyncio.TimeoutError:
+            complete = False
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(0.2)   # replies to the last messages
+        sent = len(flows) * args.messages
+        received = receipts.received
+        replies = receipts.replies
+        samples = receipts.latencies
+        for t in tasks:
+            t.cancel()
+
+    if scenario == "idle":
+        elapsed = time.perf_counter() - started
+    _, cpu_end = usage(proc.pid)
+    own_end = own_cpu()
+    for c in clients:
+        c.close()
+
+    result = {
+        "scenario": scenario,
+        "clients": args.clients,
+        "idle": args.idle,
+        "framing": args.framing,
+        "compress": all(c.deflate for c in clients),
+        "workers": args.workers,
+        "overflow": args.overflow,
+        "client_rate": args.client_rate,
+        "messages_per_client": args.messages,
+        "payload_bytes": max(args.size, STAMP),
+        "complete": complete,
+        "sent": sent,
+        "received": received,
+        "seq": args.seq,
+        "reply_frames_per_msg": round(replies / sent, 4) if sent and scenario != "idle" else None,
+        "seconds": round(elapsed, 3),
+        "msgs_per_sec": round(received / elapsed) if elapsed else 0,
+        "latency_ms": percentiles(samples),
+        "wire_bytes_in": sum(c.wire_in for c in clients),
+        "connects_per_sec": round(len(clients) / connect_secs),
+        "relay_rss_bytes": rss_after,
+        "relay_bytes_per_conn": round((rss_after - rss_before) / max(1, len(clients))),
+        "relay_bytes_per_idle_conn": None if idle_bytes is None else round(idle_bytes),
+        "relay_cpu_pct": round(100 * (cpu_end - cpu_start) / elapsed, 1) if elapsed else 0,
+        "loadgen_cpu_pct": round(100 * (own_end - own_start) / elapsed, 1) if elapsed else 0,
+    }
+    if scenario == "chat":
+        result["handshake_seconds"] = round(handshake_secs, 3)
+    return result
+
+def revision(path: str) -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "-C", path, "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    ap = argparse.ArgumentParser(description="relay load generator")
+    ap.add_argument("--scenario", default="send", help=f"comma separated: {', '.join(SCENARIOS)}")
+    ap.add_argument("--clients", type=int, default=1000)
+    ap.add_argument("--idle", type=int, default=0, help="extra connections that never send")
+    ap.add_argument("--messages", type=int, default=100, help="messages per sender (pings per probe for idle)")
+    ap.add_argument("--size", type=int, default=64)
+    ap.add_argument("--rate", type=float, default=0, help="messages/s per sender, 0 = as fast as possible")
+    ap.add_argument("--framing", choices=("json", "bin"), default="json")
+    ap.add_argument("--seq", action="store_true", help="number messages; the relay acks them in batches instead of `sent`")
+    ap.add_argument("--compress", action="store_true", help="bin framing: ask for stream compression")
+    ap.add_argument("--duration", type=float, default=5.0, help="idle scenario: seconds to sit idle")
+    ap.add_argument("--probes", type=int, default=100, help="idle scenario: clients that measure ping RTT")
+    ap.add_argument("--room-senders", type=int, default=1, help="room scenario: clients posting to the room")
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--overflow", default="block", help="relay overflow policy ('' for checkouts without one)")
+    ap.add_argument("--client-rate", default="0", help="relay per-client message rate, 0 = unlimited ('' for checkouts without one)")
+    ap.add_argument("--port", type=int, default=4142)
+    ap.add_argument("--timeout", type=float, default=300.0)
+    ap.add_argument("--server-dir", default=ROOT, help="checkout whose server.py is benchmarked")
+    ap.add_argument("--out", help="append one JSON line per scenario to this file")
+    args = ap.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))   # inherited by the relay
+    rev = revision(args.server_dir)
+
+    for scenario in args.scenario.split(","):
+        if scenario not in SCENARIOS:
+            ap.error(f"unknown scenario {scenario!r}")
+        args.scenario = scenario
+        proc = start_relay(
+            args.port, args.server_dir,
+            overflow=args.overflow or None,
+            workers=args.workers if args.workers > 1 else None,
+            settings={"rate": float(args.client_rate)} if args.client_rate else None,
+        )
+        try:
+            result = asyncio.run(run(args, proc))
+        finally:
+            proc.terminate()
+            proc.wait()
+        result["revision"] = rev
+        line = json.dumps(result)
+        print(line, flush=True)
+        if args.out:
+            with open(args.out, "a") as f:
+                f.write(line + "\n")
+
+if __name__ == "__main__":
+    main()
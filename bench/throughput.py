@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# options left as None are not passed, so older checkouts without them still start
+def start_relay(port: int, cwd: str, **options) -> subprocess.Popen:
+    extra = "".join(f", {k}={v!r}" for k, v in options.items() if v is not None)
+    code = (
+        "import asyncio, server\n"
+        f"try: asyncio.run(server.main('127.0.0.1', {port}{extra}))\n"
+        "except (KeyboardInterrupt, asyncio.CancelledError): pass"
+    )
+    return subprocess.Popen([sys.executable, "-c", code], cwd=cwd, stdout=subprocess.DEVNULL)
+
+async def connect(port: int, cid: str):
+    for _ in range(100):
+        try:
+            r, w = await asyncio.open_connection("127.0.0.1", port, limit=1 << 20)
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    w.write((json.dumps({"type": "register", "id": cid}) + "\n").encode())
+    await w.drain()
+    await r.readline()
+    return r, w
+
+async def count_frames(reader, want: int, kind: bytes):
+    got = reads = 0
+    buf = b""
+    while got < want:
+        chunk = await reader.read(1 << 16)
+        if not chunk:
+            break
+        reads += 1
+        buf += chunk
+        lines = buf.split(b"\n")
+        buf = lines.pop()
+        got += sum(1 for ln in lines if kind in ln)
+    return reads
+
+async def run(port: int, pairs: int, messages: int, size: int):
+    conns = [await connect(port, f"b{i}-{side}") for i in range(pairs) for side in "sr"]
+    senders, receivers = conns[0::2], conns[1::2]
+    frames = [(json.dumps({"type": "send", "to": f"b{i}-r", "payload": "x" * size}) + "\n").encode() for i in range(pairs)]
+
+    async def pump(i, w):
+        for _ in range(messages):
+            w.write(frames[i])
+            await w.drain()
+
+    start = time.perf_counter()
+    waits = [count_frames(r, messages, b'"deliver"') for r, _ in receivers]
+    waits += [count_frames(r, messages, b'"sent"') for r, _ in senders]
+    _, reads = await asyncio.gather(
+        asyncio.gather(*(pump(i, w) for i, (_, w) in enumerate(senders))),
+        asyncio.gather(*waits),
+    )
+    elapsed = time.perf_counter() - start
+    for _, w in conns:
+        w.close()
+    total = pairs * messages
+    return {
+        "pairs": pairs,
+        "messages": total,
+        "payload_bytes": size,
+        "seconds": round(elapsed, 3),
+        "msgs_per_sec": round(total / elapsed),
+        "client_reads_per_msg": round(sum(reads) / (2 * total), 4),
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="relay send/deliver throughput")
+    ap.add_argument("--pairs", type=int, default=20)
+    ap.add_argument("--messages", type=int, default=5000)
+    ap.add_argument("--size", type=int, default=64)
+    ap.add_argument("--port", type=int, default=4141)
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--server-dir", default=ROOT, help="checkout whose server.py is benchmarked")
+    ap.add_argument("--overflow", help="relay overflow policy (omit for checkouts without one)")
+    ap.add_argument("--client-rate", default="0", help="relay per-client message rate, 0 = unlimited ('' for checkouts without one)")
+    args = ap.parse_args()
+
+    proc = start_relay(args.port, args.server_dir, overflow=args.overflow,
+                       settings={"rate": float(args.client_rate)} if args.client_rate else None)
+    try:
+        result = asyncio.run(asyncio.wait_for(run(args.port, args.pairs, args.messages, args.size), args.timeout))
+    finally:
+        proc.terminate()
+        proc.wait()
+    print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
@@ -1,113 +1,487 @@
 import curses
 import asyncio
 import json
-from typing import Optional
-from functions.net import send_json
+import os
+import random
+import signal
+import sys
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+from functions.net import decode_frames, CREDITED, encode_frame, send_json, split_lines, Deflater, Inflater
+from functions.history import History
+from functions.stats import Stats
+from functions.transfer import Transfers
 from ui.curses_ui import CursesUI
 
+READ_CHUNK = 1 << 16
+HISTORY_PAGE = 200   # rows read from the history store per scroll past the top
+SEARCH_LIMIT = 50
+INVALID = {"type": "info", "message": "invalid frame from server"}
+
+# reconnect delays grow from RECONNECT_BASE to RECONNECT_MAX seconds; each wait
+# is drawn from [0, delay] so clients dropped together do not return together
+RECONNECT_BASE = 0.5
+RECONNECT_MAX = 30.0
+SPOOL_LIMIT = 1000   # frames typed while offline; the oldest go first
+COMPRESS_THRESHOLD = 64   # bytes; smaller frames are sent uncompressed
+# the relay dropped us on purpose; reconnect only once the user sends something
+DISMISSED = {"idle_timeout", "signed_in_elsewhere"}
+# flow control: the relay sends at most WINDOW messages we have not granted
+# credit for. Credit goes back once half of that is handled, but not while the
+# UI is a window behind, so a stalled screen holds the relay's messages there.
+# Replies, acks and pings need no credit.
+WINDOW = 256
+SLOW_NOTICE = 10.0   # seconds between "not keeping up" lines for one peer
+# handled by Transfers straight from the network reader
+FILE_FRAMES = {"file_offer", "file_accept", "file_ack", "file_cancel", "file_chunk"}
+
+# Messages carry a seq and the relay acks them cumulatively (see F_SEQ in
+# functions/net.py). Up to INFLIGHT are sent ahead of their acks; later ones
+# wait their turn. Each message line ends in a mark of MARK_WIDTH that is
+# swapped in place as its state changes: "...", then "sent", "queued"
+# (offline recipient), "slow" (recipient not keeping up) or "failed" with the
+# round-trip time, "unconfirmed" if the connection dropped first, or
+# "dropped" if more than SPOOL_LIMIT were waiting.
+INFLIGHT = 32
+MARK_WIDTH = 16
+
+def mark(state: str, rtt: Optional[float] = None) -> str:
+    if rtt is not None:
+        state += f" {rtt * 1000:.0f}ms" if rtt < 10 else f" {rtt:.0f}s"
+    return f"  {state}".ljust(MARK_WIDTH)[:MARK_WIDTH]
+
+class Pending:
+    __slots__ = ("seq", "obj", "line", "shown", "sent_at", "state")
+
+    def __init__(self, seq: int, obj: dict, line: int, shown: str):
+        self.seq = seq
+        self.obj = obj
+        self.line = line     # number of the message's last line on screen, see CursesUI.log_line
+        self.shown = shown   # that line's text, mark included
+        self.sent_at = 0.0
+        self.state: Optional[str] = None   # from a reply naming the seq; None is "sent"
+
+# server frame type -> payload of the UI event it becomes; anything else ("sent") is dropped
+EVENTS = {
+    "deliver": lambda m: m,
+    "nodeliver": lambda m: m,
+    "registered": lambda m: m,
+    "info": lambda m: m.get("message"),
+    "error": lambda m: m.get("error"),
+    "chat_request": lambda m: m.get("from"),
+    "chat_accept": lambda m: m.get("from"),
+    "chat_reject": lambda m: m.get("from"),
+    "chat_message": lambda m: m,
+    "joined": lambda m: m.get("room"),
+    "left": lambda m: m.get("room"),
+    "room_message": lambda m: m,
+    "who": lambda m: m,
+    "presence": lambda m: m,
+    "slow_down": lambda m: m,
+}
+
 class App:
-    def __init__(self, host: str, port: int, my_id: str):
+    def __init__(self, host: str, port: int, my_id: str, history: Optional[History] = None, stats: Optional[Stats] = None):
         self.host = host
         self.port = port
         self.my_id = my_id
+        self.history = history
         self.reader = None
         self.writer = None
         self.ui: Optional[CursesUI] = None
-        self.event_q: asyncio.Queue = asyncio.Queue()
+        self.events: Deque[Tuple[str, Any]] = deque()
+        self.events_at = 0.0   # when the oldest queued event arrived (perf_counter)
+        self.stats = stats or Stats()
+        self.wakeup = asyncio.Event()   # set by network events, stdin readability and resizes
+        self.resized = False
+        self.binary = False
+        self.deflate: Optional[Deflater] = None   # per connection, when the relay agreed to compress
+        self.inflate: Optional[Inflater] = None
+        self.online = False   # registered on the current connection
+        self.token: Optional[str] = None   # resumption token from the relay
+        self.spool: Deque[dict] = deque(maxlen=SPOOL_LIMIT)
+        self.rooms: Set[str] = set()   # joined again after a reconnect
+        self.watching: Set[str] = set()   # watched again after a reconnect
+        self.who_next: Optional[str] = None   # cursor of the next /who page
+        self.redial = asyncio.Event()   # cleared while DISMISSED
+        self.redial.set()
+        self.files = Transfers(self)
+        self.window: Optional[int] = None   # granted by the relay at register
+        self.handled = 0   # messages since the last credit, see CREDITED
+        self.slowed: Dict[str, float] = {}   # peer -> when we last said it is not keeping up
+        self.seq = 0
+        self.acks = False   # the relay acks messages with a seq; older ones only say `sent` to `send`
+        self.inflight: Dict[int, Pending] = {}   # by seq, oldest first
+        self.waiting: Deque[Pending] = deque()   # not sent yet: window full or offline
 
     async def connect(self):
         self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
-        await send_json(self.writer, {"type": "register", "id": self.my_id})
-        await self.event_q.put(("info", f"Connected to {self.host}:{self.port}"))
+        hello = {"type": "register", "id": self.my_id, "framing": ["bin"], "compress": ["deflate"], "window": WINDOW,
+                 "heartbeat": True}
+        if self.token and self.ui and self.ui.chat_peer:
+            hello["resume"] = self.token
+        await send_json(self.writer, hello)
+        self.post("info", f"Connected to {self.host}:{self.port}")
+        # the reply to register is always a JSON line; it tells us whether to switch framing
+        try:
+            msg = await self._read_json_line()
+        except EOFError:
+            msg = None
+        if msg is None or msg.get("type") != "registered":
+            if msg is not None:
+                self._dispatch([msg])
+            self.writer.close()
+            return
+        self.binary = msg.get("framing") == "bin"
+        compressed = msg.get("compress") == "deflate"
+        self.deflate = Deflater(COMPRESS_THRESHOLD) if compressed else None
+        self.inflate = Inflater() if compressed else None
+        self.token = msg.get("resume")
+        self.window = msg.get("window")
+        self.acks = msg.get("acks") is True
+        self.handled = 0
+        self.online = True
+        self._dispatch([msg])
+        await self._flush_spool()
+        await self._pump()
 
+    # rejoins rooms, watches again and sends everything typed while offline in one write
+    async def _flush_spool(self):
+        batch = [{"type": "join", "room": room} for room in sorted(self.rooms)]
+        if self.watching:
+            batch.append({"type": "watch", "payload": sorted(self.watching)})
+        sent = len(self.spool)
+        batch += self.spool
+        self.spool.clear()
+        if batch:
+            self.writer.write(b"".join(map(self._encode, batch)))
+            await self.writer.drain()
+        if sent:
+            self.post("info", f"sent {sent} message(s) queued while offline")
+
+    # waits with jittered exponential backoff between attempts until registered
+    async def reconnect(self):
+        attempt = 0
+        while not self.online:
+            await asyncio.sleep(random.uniform(0, min(RECONNECT_MAX, RECONNECT_BASE * 2 ** attempt)))
+            attempt += 1
+            try:
+                await self.connect()
+            except OSError:
+                pass
+
+    def post(self, kind: str, payload):
+        if not self.events:
+            self.events_at = time.perf_counter()
+        self.events.append((kind, payload))
+        self.wakeup.set()
+
+    def _on_resize(self):
+        self.resized = True
+        self.wakeup.set()
+
+    def _encode(self, obj: dict) -> bytes:
+        if self.binary:
+            frame = encode_frame(obj)
+            return self.deflate.pack(frame) if self.deflate else frame
+        return (json.dumps(obj) + "\n").encode("utf-8")
+
+    # a message with its own line and delivery mark; peer and kind are for the history store
+    async def send_message(self, obj: dict, line: str, peer: str, kind: str):
+        self.seq += 1
+        obj["seq"] = self.seq
+        suffix = mark("...")
+        number = self._log(line, peer, kind, suffix)
+        self.waiting.append(Pending(self.seq, obj, number, line.splitlines()[-1] + suffix if line else suffix))
+        if len(self.waiting) > SPOOL_LIMIT:
+            self._settle(self.waiting.popleft(), "dropped")
+        await self._pump()
+
+    # sends waiting messages while the window has room, in one write
+    async def _pump(self):
+        if not self.waiting or len(self.inflight) >= INFLIGHT:
+            return
+        if not self.online or self.writer.transport.is_closing():
+            if len(self.waiting) == 1 and not self.spool:
+                self.post("info", "offline: messages will be sent when the relay is back")
+            self.redial.set()
+            return
+        now = time.perf_counter()
+        frames = []
+        while self.waiting and len(self.inflight) < INFLIGHT:
+            item = self.waiting.popleft()
+            item.sent_at = now
+            if self.acks:
+                self.inflight[item.seq] = item
+            else:
+                del item.obj["seq"]
+                item.state = "sent"
+                self.post("ack", [(item, None)])
+            frames.append(self._encode(item.obj))
+        try:
+            self.writer.write(b"".join(frames))
+            await self.writer.drain()
+        except ConnectionError:
+            self.online = False
+
+    def _settle(self, item: Pending, state: str, rtt: Optional[float] = None):
+        if self.ui:
+            self.ui.replace_line(item.line, item.shown[:-MARK_WIDTH] + mark(state, rtt))
+
+    # every message up to seq has been handled by the relay
+    def _acked(self, seq, now: float) -> List[Tuple[Pending, float]]:
+        done = []
+        if type(seq) is int:
+            for s in list(self.inflight):
+                if s > seq:
+                    break
+                item = self.inflight.pop(s)
+                done.append((item, now - item.sent_at))
+                self.stats.span("rtt", item.sent_at, now)
+        return done
+
+    # while offline, frames wait in the spool until the next register
+    async def send(self, obj: dict):
+        if self.online and not self.writer.transport.is_closing():
+            try:
+                self.writer.write(self._encode(obj))
+                await self.writer.drain()
+                return
+            except ConnectionError:
+                self.online = False
+        if obj.get("type") in ("pong", "credit"):
+            return
+        if not self.spool:
+            self.post("info", "offline: messages will be sent when the relay is back")
+        self.spool.append(obj)
+        self.redial.set()
+
+    async def _read_json_line(self) -> Optional[dict]:
+        line = await self.reader.readline()
+        if not line:
+            raise EOFError
+        try:
+            return json.loads(line.decode("utf-8").strip())
+        except Exception:
+            self.post("info", "invalid frame from server")
+            return None
+
+    # runs for the life of the client: reads until the connection drops, then
+    # reconnects
     async def network_reader(self):
-        reader = self.reader
         try:
             while True:
-                line = await reader.readline()
-                if not line:
-                    await self.event_q.put(("info", "disconnected from server"))
-                    break
-                try:
-                    msg = json.loads(line.decode("utf-8").strip())
-                except Exception:
-                    await self.event_q.put(("info", "invalid frame from server"))
-                    continue
-                t = msg.get("type")
-                if t == "deliver":
-                    await self.event_q.put(("deliver", msg))
-                elif t == "sent":
-                    pass
-                elif t == "nodeliver":
-                    await self.event_q.put(("nodeliver", msg))
-                elif t == "registered":
-                    await self.event_q.put(("registered", msg))
-                elif t == "info":
-                    await self.event_q.put(("info", msg.get("message")))
-                elif t == "error":
-                    await self.event_q.put(("error", msg.get("error")))
-                elif t == "chat_request":
-                    await self.event_q.put(("chat_request", msg.get("from")))
-                elif t == "chat_accept":
-                    await self.event_q.put(("chat_accept", msg.get("from")))
-                elif t == "chat_reject":
-                    await self.event_q.put(("chat_reject", msg.get("from")))
-                elif t == "chat_message":
-                    await self.event_q.put(("chat_message", msg))
+                if self.online:
+                    await self._read_connection()
+                    self.online = False
+                    self.writer.close()
+                    if self.inflight:
+                        lost, self.inflight = list(self.inflight.values()), {}
+                        self.post("ack", [(item, None) for item in lost])
+                    if self.files.outgoing or self.files.incoming:
+                        self.files.abort_all("disconnected")
+                    if self.redial.is_set():
+                        self.post("info", "disconnected from server, reconnecting")
+                    else:
+                        self.post("info", "disconnected from server; send something to reconnect")
+                await self.redial.wait()
+                await self.reconnect()
         except asyncio.CancelledError:
             pass
 
+    # reads whatever the socket has, up to READ_CHUNK, and dispatches every
+    # complete frame in it at once
+    async def _read_connection(self):
+        buf = bytearray()
+        try:
+            while True:
+                data = await self.reader.read(READ_CHUNK)
+                if not data:
+                    return
+                received = time.perf_counter()
+                buf += data
+                try:
+                    msgs = decode_frames(buf, self.inflate, INVALID) if self.binary else split_lines(buf, INVALID)
+                except ValueError:
+                    self.post("info", "invalid frame from server")
+                    return
+                pinged = self._dispatch(msgs, received)
+                self.stats.span("net", received, time.perf_counter())
+                if pinged:
+                    await self.send({"type": "pong"})
+                await self.grant()
+                await self._pump()
+        except ConnectionError:
+            pass
+
+    # returns whether the relay sent a heartbeat ping that needs a pong;
+    # received is when the bytes holding msgs came off the socket
+    def _dispatch(self, msgs: List[dict], received: Optional[float] = None) -> bool:
+        events = []
+        pinged = False
+        self.handled += sum(msg.get("type") in CREDITED for msg in msgs)
+        for msg in msgs:
+            t = msg.get("type")
+            if t == "ack":
+                events.append(("ack", self._acked(msg.get("seq"), received or time.perf_counter())))
+                continue
+            seq = msg.get("seq")
+            item = self.inflight.get(seq) if type(seq) is int else None
+            if item is not None:
+                if t == "nodeliver":
+                    item.state = "queued" if msg.get("queued") else "failed"
+                elif t == "slow_down":
+                    item.state = "slow"
+                else:
+                    item.state = "failed"
+            pick = EVENTS.get(t)
+            if pick is not None:
+                payload = pick(msg)
+                events.append((t, payload))
+                if t in ("error", "info") and payload in DISMISSED:
+                    self.redial.clear()
+                elif t == "nodeliver":
+                    self.files.unreachable(msg.get("to"))
+            elif t in FILE_FRAMES:
+                try:
+                    self.files.handle(msg)
+                except (TypeError, ValueError, AttributeError):
+                    events.append(("info", f"invalid {t} from {msg.get('from')}"))
+            elif t == "ping":
+                pinged = True
+            elif t == "resume":
+                self.token = msg.get("token")
+        if events:
+            if not self.events:
+                self.events_at = received or time.perf_counter()
+            self.events.extend(events)
+            self.wakeup.set()
+        return pinged
+
+    async def grant(self):
+        if self.window and self.online and self.handled >= self.window // 2 and len(self.events) < self.window:
+            n, self.handled = self.handled, 0
+            await self.send({"type": "credit", "payload": n})
+
+    # a line worth keeping: shown and queued for the history store; suffix is
+    # only shown. Returns the line's number on screen.
+    def _log(self, line: str, peer: str = "", kind: str = "system", suffix: str = "") -> int:
+        rid = self.history.add(peer or "", kind, line) if self.history else None
+        return self.ui.log_line(line + suffix, rid)
+
     def _apply_event(self, kind: str, payload):
         ui = self.ui
         if not ui:
             return
         if kind == "info":
-            ui.log_line(f"[system] {payload}")
+            self._log(f"[system] {payload}")
         elif kind == "error":
-            ui.log_line(f"[error] {payload}")
+            self._log(f"[error] {payload}")
         elif kind == "registered":
-            ui.log_line(f"[system] session registered as {payload.get('id')}")
+            self._log(f"[system] session registered as {payload.get('id')}")
+            if payload.get("chat"):
+                ui.set_chat_peer(payload["chat"])
+                self._log(f"[chat] resumed chat with {payload['chat']}", payload["chat"])
+            elif ui.chat_peer:
+                self._log(f"[chat] chat with {ui.chat_peer} could not be resumed", ui.chat_peer)
+                ui.set_chat_peer(None)
         elif kind == "nodeliver":
-            ui.log_line(f"[system] user {payload.get('to')} is offline")
+            if payload.get("queued"):
+                self._log(f"[system] user {payload.get('to')} is offline, message queued")
+            else:
+                self._log(f"[system] user {payload.get('to')} is offline")
         elif kind == "deliver":
-            ui.log_line(f"[from {payload.get('from')}]: {payload.get('payload','')}")
+            self._log(f"[from {payload.get('from')}]: {payload.get('payload','')}", payload.get("from"), "deliver")
         elif kind == "chat_message":
-            ui.log_line(f"(chat) {payload.get('from')}: {payload.get('payload','')}")
+            self._log(f"(chat) {payload.get('from')}: {payload.get('payload','')}", payload.get("from"), "chat")
         elif kind == "chat_request":
             from_id = payload
             ui.show_chat_request_modal(from_id)
         elif kind == "chat_accept":
             from_id = payload
             ui.set_chat_peer(from_id)
-            ui.log_line(f"[chat] {from_id} accepted your chat")
+            self._log(f"[chat] {from_id} accepted your chat", from_id)
         elif kind == "chat_reject":
             from_id = payload
-            ui.log_line(f"[chat] {from_id} rejected your chat request")
+            self._log(f"[chat] {from_id} rejected your chat request", from_id)
+        elif kind == "joined":
+            self.rooms.add(payload)
+            self._log(f"[room] joined {payload}", f"#{payload}")
+        elif kind == "left":
+            self.rooms.discard(payload)
+            self._log(f"[room] left {payload}", f"#{payload}")
+        elif kind == "room_message":
+            self._log(f"[{payload.get('room')}] {payload.get('from')}: {payload.get('payload','')}", f"#{payload.get('room')}", "room")
+        elif kind == "who":
+            self.who_next = payload.get("next")
+            users = payload.get("users") or []
+            more = ", /who more for the rest" if self.who_next else ""
+            ui.log_line(f"[who] {payload.get('total', len(users))} online{more}: {', '.join(users)}")
+        elif kind == "presence":
+            for state in ("online", "offline"):
+                if payload.get(state):
+                    self._log(f"[presence] {state}: {', '.join(payload[state])}")
+        elif kind == "ack":
+            for item, rtt in payload:
+                self._settle(item, item.state or ("sent" if rtt is not None else "unconfirmed"), rtt)
+        elif kind == "slow_down":
+            to = payload.get("to")
+            if not to:
+                ui.log_line(f"[system] sending too fast; the relay holds your messages for {payload.get('retry_after')}s")
+            elif time.perf_counter() - self.slowed.get(to, -SLOW_NOTICE) >= SLOW_NOTICE:
+                self.slowed[to] = time.perf_counter()
+                ui.log_line(f"[system] {to} is not keeping up; {payload.get('queued')} message(s) wait at the relay")
 
     async def _handle_command(self, cmd: str):
         if cmd.startswith("__MODAL__:"):
             choice = cmd.split(":", 1)[1]
             from_id = self.ui.pending_from
             if choice == "accept" and from_id:
-                await send_json(self.writer, {"type": "chat_accept", "to": from_id})
+                await self.send({"type": "chat_accept", "to": from_id})
                 self.ui.set_chat_peer(from_id)
                 self.ui.set_pending_from(None)
                 self.ui.log_line(f"accepted chat with {self.ui.chat_peer}.")
             elif choice == "reject" and from_id:
-                await send_json(self.writer, {"type": "chat_reject", "to": from_id})
+                await self.send({"type": "chat_reject", "to": from_id})
                 self.ui.log_line(f"rejected chat with {from_id}.")
                 self.ui.set_pending_from(None)
             return
 
         text = cmd
 
+        # room commands also work from inside a chat
+        if text.startswith(("/join ", "/part ")):
+            parts = text.split()
+            if len(parts) != 2:
+                self.ui.log_line(f"usage: {parts[0]} <room>")
+                return
+            await self.send({"type": "join" if parts[0] == "/join" else "leave", "room": parts[1]})
+            return
+
+        if text.startswith("/room "):
+            parts = text.split(maxsplit=2)
+            if len(parts) < 3:
+                self.ui.log_line("usage: /room <room> <message>")
+                return
+            await self.send_message({"type": "room_message", "room": parts[1], "payload": parts[2]},
+                                    f"[{parts[1]}] me: {parts[2]}", f"#{parts[1]}", "room")
+            return
+
+        if text.startswith("/msg "):
+            parts = text.split(maxsplit=2)
+            if len(parts) < 3:
+                self.ui.log_line("usage: /msg <peer_id> <message>")
+                return
+            await self.send_message({"type": "send", "to": parts[1], "payload": parts[2]}, f"[to {parts[1]}]: {parts[2]}", parts[1], "send")
+            return
+
         if self.ui.chat_peer:
             if text == "/leave":
                 self.ui.log_line(f"left chat {self.ui.chat_peer}.")
                 self.ui.set_chat_peer(None)
             else:
-                await send_json(self.writer, {"type": "chat_message", "to": self.ui.chat_peer, "payload": text})
-                self.ui.log_line(f"[me] {text}")
+                await self.send_message({"type": "chat_message", "to": self.ui.chat_peer, "payload": text}, f"[me] {text}", self.ui.chat_peer, "chat")
             return
 
         if text.startswith("/chat "):
@@ -116,10 +490,79 @@ class App:
                 self.ui.log_line("usage: /chat <peer_id>")
                 return
             to = parts[1]
-            await send_json(self.writer, {"type": "chat_request", "to": to})
+            await self.send({"type": "chat_request", "to": to})
             self.ui.log_line(f"requested {to}")
             return
 
+        if text.startswith("/send-file "):
+            parts = text.split(maxsplit=2)
+            if len(parts) < 3:
+                self.ui.log_line("usage: /send-file <peer_id> <path>")
+            elif not self.online or not self.binary:
+                self.ui.log_line("file transfer needs a binary connection to the relay")
+            else:
+                try:
+                    out = await self.files.offer(parts[1], os.path.expanduser(parts[2]))
+                    self.ui.log_line(f"offered {parts[2]} to {parts[1]} as #{out.xid}")
+                except OSError as e:
+                    self.ui.log_line(f"cannot send {parts[2]}: {e.strerror}")
+            return
+
+        if text.startswith(("/accept-file ", "/cancel-file ")):
+            parts = text.split()
+            if len(parts) != 3 or not parts[2].isdigit():
+                self.ui.log_line(f"usage: {parts[0]} <peer_id> <id>")
+                return
+            peer, xid = parts[1], int(parts[2])
+            if parts[0] == "/accept-file":
+                inc = await self.files.accept(peer, xid)
+                self.ui.log_line(f"receiving into {inc.name}" if inc else "no such offer")
+            elif not (await self.files.cancel(peer, xid, self.my_id) or await self.files.cancel(peer, xid, peer)):
+                self.ui.log_line("no such transfer")
+            return
+
+        if text == "/who" or text == "/who more":
+            if text == "/who more" and not self.who_next:
+                self.ui.log_line("no more users; /who starts over")
+                return
+            await self.send({"type": "who", "payload": {"after": self.who_next if text == "/who more" else ""}})
+            return
+
+        if text.startswith(("/watch ", "/unwatch ")):
+            parts = text.split()
+            users = parts[1:]
+            if not users:
+                self.ui.log_line(f"usage: {parts[0]} <peer_id> ...")
+            elif parts[0] == "/watch":
+                self.watching.update(users)
+                await self.send({"type": "watch", "payload": users})
+            else:
+                self.watching.difference_update(users)
+                await self.send({"type": "unwatch", "payload": users})
+            return
+
+        if text.startswith("/search "):
+            terms = text[len("/search "):].strip()
+            peer = None
+            if terms.startswith("@"):
+                peer, _, terms = terms[1:].partition(" ")
+            if not self.history or not terms:
+                self.ui.log_line("usage: /search [@peer] <terms>" if self.history else "no history store")
+                return
+            rows = await asyncio.to_thread(self.history.search, terms, SEARCH_LIMIT, peer)
+            self.ui.log_line(f"[search] {len(rows)}{'+' if len(rows) == SEARCH_LIMIT else ''} match(es) for {terms}")
+            for _, ts, _, line in reversed(rows):
+                self.ui.log_line(f"  {time.strftime('%Y-%m-%d %H:%M', time.localtime(ts))} {line}")
+            return
+
+        if text == "/stats":
+            self.ui.set_overlay(None if self.ui.overlay is not None else self.stats.lines())
+            return
+
+        if text == "/files":
+            self.ui.log_line("\n".join(self.files.status()) or "no file transfers")
+            return
+
         if text == "/whoami":
             self.ui.log_line(self.my_id)
             return
@@ -129,6 +572,19 @@ class App:
                 "Commands:\n"
                 "  /chat <peer_id>           start a chat session\n"
                 "  /leave                    leave chat session\n"
+                "  /join <room>              join a room\n"
+                "  /room <room> <message>    send to a room\n"
+                "  /msg <peer> <message>     send a direct message\n"
+                "  /part <room>              leave a room\n"
+                "  /who [more]               list who is online, a page at a time\n"
+                "  /watch <peer> ...         get told when they come and go\n"
+                "  /unwatch <peer> ...       stop watching\n"
+                "  /search [@peer] <terms>   search the message history\n"
+                "  /stats                    show or hide client timings\n"
+                "  /send-file <peer> <path>  offer a file\n"
+                "  /accept-file <peer> <id>  receive an offered file\n"
+                "  /cancel-file <peer> <id>  decline or stop a transfer\n"
+                "  /files                    list file transfers\n"
                 "  /quit                     exit"
             )
             return
@@ -147,34 +603,81 @@ class App:
             stdscr.keypad(True)
 
             self.ui = CursesUI(stdscr, self.my_id)
+            self.ui.bracketed_paste(True)
+            if self.history:
+                self.ui.prepend_lines((rid, line) for rid, _, _, line in self.history.before(None, HISTORY_PAGE))
             self.ui.log_line("/help to view all commands")
             self.ui.draw()
 
-            while not self.ui.should_exit:
-                drained = 0
-                try:
-                    while True:
-                        kind, payload = self.event_q.get_nowait()
-                        self._apply_event(kind, payload)
-                        drained += 1
-                except asyncio.QueueEmpty:
-                    pass
+            # sleep until stdin is readable, a network event is posted or the
+            # terminal is resized; then handle everything pending and draw once
+            loop = asyncio.get_running_loop()
+            stdin_fd = sys.stdin.fileno()
+            loop.add_reader(stdin_fd, self.wakeup.set)
+            loop.add_signal_handler(signal.SIGWINCH, self._on_resize)
+            try:
+                while not self.ui.should_exit:
+                    await self.wakeup.wait()
+                    self.wakeup.clear()
 
-                try:
-                    ch = stdscr.getch()
-                except Exception:
-                    ch = -1
+                    if self.resized:
+                        self.resized = False
+                        cols, lines = os.get_terminal_size(stdin_fd)
+                        curses.resizeterm(lines, cols)
+
+                    stats = self.stats
+                    start = time.perf_counter()
+                    events, self.events = self.events, deque()
+                    events_at = self.events_at
+                    if events:
+                        stats.count("queue_depth", len(events))
+                        stats.span("queue_age", events_at, start)
+                        for kind, payload in events:
+                            self._apply_event(kind, payload)
+                        stats.span("events", start, time.perf_counter())
+                        await self.grant()
 
-                if ch != -1:
-                    cmd = self.ui.handle_key(ch)
-                    if cmd is not None:
+                    start = time.perf_counter()
+                    keys = []
+                    while True:
+                        try:
+                            ch = stdscr.getch()
+                        except Exception:
+                            ch = -1
+                        if ch == -1:
+                            break
+                        keys.append(ch)
+                    for cmd in self.ui.handle_keys(keys):
+                        if self.ui.should_exit:
+                            break
                         await self._handle_command(cmd)
+                    if keys:
+                        stats.span("keys", start, time.perf_counter())
+
+                    if self.ui.want_older:
+                        self.ui.want_older = False
+                        if self.history:
+                            rows = await asyncio.to_thread(self.history.before, self.ui.oldest_id(), HISTORY_PAGE)
+                            self.ui.prepend_lines((rid, line) for rid, _, _, line in rows)
 
-                self.ui.draw()
-                await asyncio.sleep(0.01)
+                    if self.ui.overlay is not None:
+                        self.ui.set_overlay(stats.lines())
+                    drawing = bool(self.ui.dirty)
+                    start = time.perf_counter()
+                    self.ui.draw()
+                    end = time.perf_counter()
+                    if drawing:
+                        stats.span("draw", start, end)
+                    if events:
+                        stats.span("recv_to_screen", events_at, end)
+            finally:
+                loop.remove_reader(stdin_fd)
+                loop.remove_signal_handler(signal.SIGWINCH)
 
         finally:
             try:
+                if self.ui:
+                    self.ui.bracketed_paste(False)
                 curses.nocbreak()
                 stdscr.keypad(False)
                 curses.echo()
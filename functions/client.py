@@ -0,0 +1,334 @@
+import asyncio
+import json
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+from functions.net import decode_frames, CREDITED, encode_frame, split_lines, Deflater, Inflater
+
+# A client without a screen, for bots, bridges and load generators:
+#
+#   client = Client(host, port, "bot-1")
+#   await client.connect()
+#   state = await client.send("alice", "hi")   # "sent", "queued", "slow", "failed" or "unconfirmed"
+#   async for msg in client:                   # the relay's frames as dicts, until it disconnects
+#       ...
+#
+# A Client is its connection's protocol and holds nothing else: no task, no
+# stream reader, and zlib state only if compress is asked for. Thousands fit
+# in one process and share its event loop.
+#
+# Messages carry a seq (see F_SEQ in functions/net.py). Up to `inflight` are
+# written ahead of the relay's acks and the rest wait in order; messages
+# posted during one event-loop tick go out in one write. Each one resolves to
+# its delivery state once an ack covers it. Other frames go out at once.
+#
+# Incoming frames wait in `incoming` until they are read. Credit for messages
+# (see CREDITED) goes back to the relay once half the window is handled, but
+# not while a window is still unread, so a reader that falls behind holds the
+# relay's messages at the relay instead of here. Acks, replies and pings are
+# not held back, and ping is answered without the reader.
+WINDOW = 256
+INFLIGHT = 64
+COMPRESS_THRESHOLD = 64
+INVALID = {"type": "error", "error": "invalid_frame"}
+# frames answered with one reply: the reply type, and the errors that stand for it
+REPLIES = {
+    "join": ("joined", {"invalid_room", "too_many_rooms"}),
+    "leave": ("left", {"not_in_room"}),
+    "who": ("who", set()),
+}
+
+class Client(asyncio.Protocol):
+    __slots__ = ("host", "port", "id", "framing", "compress", "window", "inflight_max", "transport", "buf", "binary",
+                 "deflate", "inflate", "token", "acks", "seq", "inflight", "states", "waiting", "pumping", "replies",
+                 "incoming", "handled", "paused", "wake", "ready", "online", "closed")
+
+    def __init__(self, host: str, port: int, user_id: str, framing: str = "bin", compress: bool = False,
+                 window: int = WINDOW, inflight: int = INFLIGHT):
+        self.host = host
+        self.port = port
+        self.id = user_id
+        self.framing = framing   # "bin" or "json"
+        self.compress = compress
+        self.window = window
+        self.inflight_max = inflight
+        self.transport: Optional[asyncio.Transport] = None
+        self.closed = True
+        self.token: Optional[str] = None   # resumption token from the relay
+
+    # registers and returns the relay's `registered` frame; resume picks the
+    # chat back up after a dropped connection
+    async def connect(self, resume: bool = False, timeout: float = 15.0) -> dict:
+        loop = asyncio.get_running_loop()
+        self.buf = bytearray()
+        self.binary = False
+        self.deflate: Optional[Deflater] = None
+        self.inflate: Optional[Inflater] = None
+        self.acks = False
+        self.seq = 0
+        self.inflight: Dict[int, asyncio.Future] = {}   # by seq, oldest first
+        self.states: Dict[int, str] = {}   # seq -> state from a reply naming it, until its ack
+        self.waiting: Deque[Tuple[dict, asyncio.Future]] = deque()
+        self.pumping = False
+        self.replies: Deque[Tuple[str, set, asyncio.Future]] = deque()
+        self.incoming: Deque[dict] = deque()
+        self.handled = 0
+        self.paused = False
+        self.wake: Optional[asyncio.Future] = None
+        self.ready = loop.create_future()
+        self.online = False   # registered
+        await loop.create_connection(lambda: self, self.host, self.port)
+        self.closed = False
+        hello = {"type": "register", "id": self.id, "window": self.window, "heartbeat": True}
+        if self.framing == "bin":
+            hello["framing"] = ["bin"]
+            if self.compress:
+                hello["compress"] = ["deflate"]
+        if resume and self.token:
+            hello["resume"] = self.token
+        self.transport.write((json.dumps(hello) + "\n").encode("utf-8"))
+        try:
+            return await asyncio.wait_for(self.ready, timeout)
+        except asyncio.TimeoutError:
+            self.transport.abort()
+            raise ConnectionError("register_timeout")
+
+    async def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        while not self.closed:
+            await self._wait()
+
+    # a message; the future resolves to its delivery state
+    def post(self, kind: str, to: str, text: str) -> asyncio.Future:
+        if self.closed:
+            raise ConnectionError("not_connected")
+        obj = {"type": kind, "room" if kind == "room_message" else "to": to, "payload": text}
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append((obj, future))
+        if not self.pumping:
+            self.pumping = True
+            asyncio.get_running_loop().call_soon(self._pump)
+        return future
+
+    async def send(self, to: str, text: str) -> str:
+        return await self.post("send", to, text)
+
+    async def chat_message(self, to: str, text: str) -> str:
+        return await self.post("chat_message", to, text)
+
+    async def room_message(self, room: str, text: str) -> str:
+        return await self.post("room_message", room, text)
+
+    # many messages of one kind, pipelined; the states come back in order
+    async def send_batch(self, messages: Iterable[Tuple[str, str]], kind: str = "send") -> List[str]:
+        return list(await asyncio.gather(*(self.post(kind, to, text) for to, text in messages)))
+
+    async def chat_request(self, to: str):
+        await self.send_frame({"type": "chat_request", "to": to})
+
+    # answers the request from `to`, or the newest one
+    async def chat_accept(self, to: Optional[str] = None):
+        await self.send_frame({"type": "chat_accept", "to": to} if to else {"type": "chat_accept"})
+
+    async def chat_reject(self, to: Optional[str] = None):
+        await self.send_frame({"type": "chat_reject", "to": to} if to else {"type": "chat_reject"})
+
+    async def join(self, room: str) -> dict:
+        return await self.request({"type": "join", "room": room})
+
+    async def part(self, room: str) -> dict:
+        return await self.request({"type": "leave", "room": room})
+
+    # one page of online users: {"users": [...], "next": cursor or None, "total": n}
+    async def who(self, after: str = "", limit: Optional[int] = None) -> dict:
+        return await self.request({"type": "who", "payload": {"after": after, "limit": limit}})
+
+    # their current state and every later change arrive as presence frames
+    async def watch(self, users: Iterable[str]):
+        await self.send_frame({"type": "watch", "payload": list(users)})
+
+    async def unwatch(self, users: Iterable[str]):
+        await self.send_frame({"type": "unwatch", "payload": list(users)})
+
+    # the next frame, or None once the connection is gone and all were read
+    async def recv(self) -> Optional[dict]:
+        while not self.incoming:
+            if self.closed:
+                return None
+            await self._wait()
+        msg = self.incoming.popleft()
+        self._grant()
+        return msg
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        msg = await self.recv()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+    async def send_frame(self, obj: dict):
+        if self.closed:
+            raise ConnectionError("not_connected")
+        self._pump()   # messages posted before this frame go first while the window has room
+        self.transport.write(self._encode(obj))
+        while self.paused and not self.closed:
+            await self._wait()
+
+    # a frame answered by one reply (see REPLIES); an error reply raises
+    # ValueError with its code
+    async def request(self, obj: dict) -> dict:
+        reply, errors = REPLIES[obj["type"]]
+        future = asyncio.get_running_loop().create_future()
+        self.replies.append((reply, errors, future))
+        await self.send_frame(obj)
+        msg = await future
+        if msg.get("type") == "error":
+            raise ValueError(msg.get("error"))
+        return msg
+
+    def _encode(self, obj: dict) -> bytes:
+        if self.binary:
+            frame = encode_frame(obj)
+            return self.deflate.pack(frame) if self.deflate else frame
+        return (json.dumps(obj) + "\n").encode("utf-8")
+
+    # writes waiting messages while the window has room, in one write
+    def _pump(self):
+        self.pumping = False
+        if self.closed or self.paused or not self.online:
+            return
+        frames = []
+        while self.waiting and len(self.inflight) < self.inflight_max:
+            obj, future = self.waiting.popleft()
+            if self.acks:
+                self.seq += 1
+                obj["seq"] = self.seq
+                self.inflight[self.seq] = future
+            elif not future.done():   # a relay without acks: written is as far as we know
+                future.set_result("sent")
+            frames.append(self._encode(obj))
+        if frames:
+            self.transport.write(b"".join(frames))
+
+    def _grant(self):
+        if self.window and not self.closed and self.handled >= self.window // 2 and len(self.incoming) < self.window:
+            n, self.handled = self.handled, 0
+            self.transport.write(self._encode({"type": "credit", "payload": n}))
+
+    # every waiter shares one future; the shield keeps a waiter that is
+    # cancelled (a timeout around recv) from cancelling it for the others
+    async def _wait(self):
+        if self.wake is None or self.wake.done():
+            self.wake = asyncio.get_running_loop().create_future()
+        await asyncio.shield(self.wake)
+
+    def _wakeup(self):
+        if self.wake is not None:
+            if not self.wake.done():
+                self.wake.set_result(None)
+            self.wake = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+
+    def data_received(self, data: bytes):
+        buf = self.buf
+        buf += data
+        if not self.online:
+            # the reply to register is always a JSON line; it says whether to switch framing
+            end = buf.find(b"\n")
+            if end < 0:
+                return
+            msg = split_lines(buf[: end + 1], INVALID)[0]
+            del buf[: end + 1]
+            if msg.get("type") != "registered" or self.ready.done():
+                if not self.ready.done():
+                    self.ready.set_exception(ConnectionError(msg.get("error") or msg.get("message") or "register_failed"))
+                self.transport.close()
+                return
+            self.binary = msg.get("framing") == "bin"
+            if msg.get("compress") == "deflate":
+                self.deflate = Deflater(COMPRESS_THRESHOLD)
+                self.inflate = Inflater()
+            self.token = msg.get("resume")
+            self.acks = msg.get("acks") is True
+            self.online = True
+            self.ready.set_result(msg)
+            self._pump()
+        try:
+            msgs = decode_frames(buf, self.inflate, INVALID) if self.binary else split_lines(buf, INVALID)
+        except ValueError:
+            self.transport.abort()
+            return
+        if msgs:
+            self._handle(msgs)
+
+    def _handle(self, msgs: List[dict]):
+        self.handled += sum(msg.get("type") in CREDITED for msg in msgs)
+        acked = False
+        for msg in msgs:
+            t = msg.get("type")
+            if t == "ack":
+                seq = msg.get("seq")
+                if type(seq) is int:
+                    for s in list(self.inflight):
+                        if s > seq:
+                            break
+                        future = self.inflight.pop(s)
+                        if not future.done():
+                            future.set_result(self.states.pop(s, "sent"))
+                    acked = True
+                continue
+            seq = msg.get("seq")
+            if type(seq) is int and seq in self.inflight:
+                if t == "nodeliver":
+                    self.states[seq] = "queued" if msg.get("queued") else "failed"
+                else:
+                    self.states[seq] = "slow" if t == "slow_down" else "failed"
+                continue
+            if self.replies:
+                reply, errors, future = self.replies[0]
+                if t == reply or (t == "error" and msg.get("error") in errors):
+                    self.replies.popleft()
+                    if not future.done():
+                        future.set_result(msg)
+                    continue
+            if t == "ping":
+                self.transport.write(self._encode({"type": "pong"}))
+            elif t == "resume":
+                self.token = msg.get("token")
+            else:
+                self.incoming.append(msg)
+        if acked:
+            self._pump()
+        self._grant()
+        self._wakeup()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._pump()
+        self._wakeup()
+
+    # what was never acked is "unconfirmed"; requests still waiting fail
+    def connection_lost(self, exc: Optional[Exception]):
+        self.closed = True
+        self.online = False
+        if not self.ready.done():
+            self.ready.set_exception(ConnectionError("closed"))
+        for future in self.inflight.values():
+            if not future.done():
+                future.set_result("unconfirmed")
+        for _, future in self.waiting:
+            if not future.done():
+                future.set_result("unconfirmed")
+        for _, _, future in self.replies:
+            if not future.done():
+                future.set_exception(ConnectionError("closed"))
+        self.inflight, self.waiting, self.replies = {}, deque(), deque()
+        self._wakeup()
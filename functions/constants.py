@@ -3,6 +3,8 @@ import pathlib
 APP_DIR = pathlib.Path.cwd()
 APP_DIR.mkdir(parents=True, exist_ok=True)
 ID_FILE = APP_DIR / "id.txt"
+DOWNLOAD_DIR = APP_DIR / "downloads"
+HISTORY_FILE = APP_DIR / "history.db"
 
 PROMPT = "> "
 CHAT_PROMPT = "(chat)> "
@@ -0,0 +1,103 @@
+import queue
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+# Chat, delivery and system lines kept across runs, in SQLite with an FTS5
+# index over the text and the peer. `peer` partitions the history (a user id,
+# "#room", or "" for system lines) and (peer, id) is indexed for per-peer
+# paging. Ids are handed out by add() itself, so the UI knows a line's row at
+# once, while a writer thread commits whatever queued up every FLUSH_DELAY in
+# one transaction. Opening costs two index lookups however long the history.
+FLUSH_DELAY = 0.1
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+CREATE TABLE IF NOT EXISTS lines (id INTEGER PRIMARY KEY, ts REAL NOT NULL, peer TEXT NOT NULL, kind TEXT NOT NULL, text TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS lines_peer ON lines (peer, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts5 (text, peer, content = 'lines', content_rowid = 'id');
+"""
+
+Row = Tuple[int, float, str, str]   # id, ts, peer, text
+
+class History:
+    def __init__(self, path):
+        self.path = str(path)
+        # reads come from the UI one at a time, on whatever thread awaits them
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.next_id = (self.db.execute("SELECT max(id) FROM lines").fetchone()[0] or 0) + 1
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._write_loop, name="history", daemon=True)
+        self.writer.start()
+
+    # queues the line and returns its id; never touches the disk
+    def add(self, peer: str, kind: str, text: str) -> int:
+        rid = self.next_id
+        self.next_id += 1
+        self.queue.put((rid, time.time(), peer, kind, text))
+        return rid
+
+    # up to limit rows older than before_id (all rows when None), oldest first
+    def before(self, before_id: Optional[int], limit: int, peer: Optional[str] = None) -> List[Row]:
+        before_id = before_id or self.next_id
+        if peer is None:
+            rows = self.db.execute("SELECT id, ts, peer, text FROM lines WHERE id < ? ORDER BY id DESC LIMIT ?", (before_id, limit))
+        else:
+            rows = self.db.execute("SELECT id, ts, peer, text FROM lines WHERE peer = ? AND id < ? ORDER BY id DESC LIMIT ?", (peer, before_id, limit))
+        return rows.fetchall()[::-1]
+
+    # newest matches first; every term must appear, the last one as a prefix
+    def search(self, terms: str, limit: int = 50, peer: Optional[str] = None) -> List[Row]:
+        words = [w.replace('"', '""') for w in terms.split()]
+        if not words:
+            return []
+        query = " ".join(f'"{w}"' for w in words) + "*"
+        if peer:
+            query = f'peer : "{peer.replace(chr(34), "")}" AND text : ({query})'
+        return self.db.execute(
+            "SELECT lines.id, lines.ts, lines.peer, lines.text FROM lines_fts JOIN lines ON lines.id = lines_fts.rowid"
+            " WHERE lines_fts MATCH ? ORDER BY lines_fts.rowid DESC LIMIT ?", (query, limit)).fetchall()
+
+    # writes what is queued and stops the writer
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+        self.db.close()
+
+    def _write_loop(self):
+        db = sqlite3.connect(self.path)
+        try:
+            while True:
+                first = self.queue.get()
+                if first is None:
+                    return
+                time.sleep(FLUSH_DELAY)
+                batch = [first]
+                done = False
+                while True:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        done = True
+                        break
+                    batch.append(item)
+                try:
+                    self._insert(db, batch)
+                except sqlite3.IntegrityError:
+                    # another client wrote these ids in the meantime; let SQLite pick
+                    self._insert(db, [(None,) + b[1:] for b in batch])
+                if done:
+                    return
+        finally:
+            db.close()
+
+    @staticmethod
+    def _insert(db: sqlite3.Connection, batch: list):
+        with db:
+            for item in batch:
+                rid = db.execute("INSERT INTO lines (id, ts, peer, kind, text) VALUES (?, ?, ?, ?, ?)", item).lastrowid
+                db.execute("INSERT INTO lines_fts (rowid, text, peer) VALUES (?, ?, ?)", (rid, item[4], item[2]))
@@ -1,6 +1,191 @@
 import json
-from typing import Any
+import struct
+import zlib
+from typing import Any, List, Optional, Tuple
+
+# Binary framing, offered by the client in `register` ("framing": ["bin"]) and
+# confirmed by the relay in `registered` ("framing": "bin"). Every frame is a
+# fixed header followed by the target id and the payload:
+#   kind:u8 flags:u8 target_len:u16 payload_len:u32
+# The relay routes `send`/`chat_message` on the header alone and forwards the
+# payload bytes untouched; everything else travels as a K_CONTROL JSON object.
+FRAME_HEADER = struct.Struct("!BBHI")
+MAX_PAYLOAD = 1 << 20
+
+K_CONTROL = 0   # payload is a JSON object, no target
+K_SEND = 1      # client -> relay, target is the recipient
+K_DELIVER = 2   # relay -> client, target is the sender
+K_CHAT = 3      # chat_message, target is the recipient (outbound) or sender (inbound)
+K_ROOM = 4      # room_message, target is the room; inbound payloads start with from_len:u16 from
+K_FILE = 5      # file chunk, target as for K_CHAT; payload is xfer_id:u32 data (see functions/transfer.py)
+K_ACK = 6       # relay -> client, no target; payload is seq:u32, see F_SEQ
+
+MESSAGE_KINDS = {"send": K_SEND, "chat_message": K_CHAT, "room_message": K_ROOM}
+FROM_LEN = struct.Struct("!H")
+XFER = struct.Struct("!I")   # K_FILE payload prefix: transfer id
+
+# Message sequence numbers. A send/chat_message/room_message may carry the
+# sender's "seq" (binary: flag F_SEQ and a seq:u32 payload prefix). The relay
+# then answers with cumulative acks instead of a `sent` per message: one
+# {"type": "ack", "seq": n} (binary: K_ACK) per batch of input, covering every
+# message up to n. A message that was not delivered gets its own reply
+# naming its seq (nodeliver, error, slow_down) before the ack that covers it.
+F_SEQ = 0x02
+SEQ = struct.Struct("!I")
+
+# Stream compression, offered in `register` ("compress": ["deflate"]) next to
+# binary framing and confirmed in `registered` ("compress": "deflate"). Each
+# direction keeps one raw deflate stream for the life of the connection, so ids
+# and JSON keys repeated across frames cost a few bits after their first use.
+# A frame of at least `threshold` bytes goes out as the next sync-flushed piece
+# of that stream: flags F_DEFLATE, no target, and a payload that inflates to
+# target_len:u16 target payload. Smaller frames are sent as they are and do not
+# touch the stream. zlib state (tens of KiB) is only allocated once a frame
+# needs it, so idle connections do not pay for it.
+F_DEFLATE = 0x01
+DEFLATE_WBITS = 12     # 4 KiB window: ~50 KiB of zlib state per connection, both directions
+DEFLATE_MEMLEVEL = 5
+SYNC_TAIL = b"\x00\x00\xff\xff"   # ends every sync flush; dropped on the wire
 
 async def send_json(writer, obj: Any):
     writer.write((json.dumps(obj) + "\n").encode("utf-8"))
     await writer.drain()
+
+def pack_frame(kind: int, target: bytes, payload: bytes, flags: int = 0) -> bytes:
+    return b"".join((FRAME_HEADER.pack(kind, flags, len(target), len(payload)), target, payload))
+
+def encode_frame(obj: dict) -> bytes:
+    kind = MESSAGE_KINDS.get(obj.get("type"))
+    if kind is None:
+        return pack_frame(K_CONTROL, b"", json.dumps(obj).encode("utf-8"))
+    target = obj["room"] if kind == K_ROOM else obj["to"]
+    payload = obj.get("payload", "").encode("utf-8")
+    if "seq" in obj:
+        return pack_frame(kind, target.encode("utf-8"), SEQ.pack(obj["seq"]) + payload, F_SEQ)
+    return pack_frame(kind, target.encode("utf-8"), payload)
+
+async def send_frame(writer, obj: dict):
+    writer.write(encode_frame(obj))
+    await writer.drain()
+
+class Deflater:
+    __slots__ = ("stream", "threshold", "level")
+
+    def __init__(self, threshold: int = 64, level: int = zlib.Z_DEFAULT_COMPRESSION):
+        self.stream = None
+        self.threshold = threshold
+        self.level = level
+
+    # frame is a whole packed frame; returns it as is or as its F_DEFLATE form
+    def pack(self, frame: bytes) -> bytes:
+        if len(frame) < self.threshold:
+            return frame
+        stream = self.stream
+        if stream is None:
+            stream = self.stream = zlib.compressobj(self.level, zlib.DEFLATED, -DEFLATE_WBITS, DEFLATE_MEMLEVEL)
+        kind, flags, tlen, _ = FRAME_HEADER.unpack_from(frame)
+        body = stream.compress(FROM_LEN.pack(tlen)) + stream.compress(memoryview(frame)[FRAME_HEADER.size :])
+        body += stream.flush(zlib.Z_SYNC_FLUSH)
+        return pack_frame(kind, b"", body[: -len(SYNC_TAIL)], flags | F_DEFLATE)
+
+class Inflater:
+    __slots__ = ("stream", "limit")
+
+    def __init__(self, limit: int = MAX_PAYLOAD):
+        self.stream = None
+        self.limit = limit + FROM_LEN.size + 0xFFFF
+
+    # payload of an F_DEFLATE frame -> (target, payload)
+    def unpack(self, payload) -> Tuple[bytes, bytes]:
+        stream = self.stream
+        if stream is None:
+            stream = self.stream = zlib.decompressobj(-DEFLATE_WBITS)
+        try:
+            body = stream.decompress(bytes(payload) + SYNC_TAIL, self.limit)
+        except zlib.error:
+            raise ValueError("bad_compression")
+        if stream.unconsumed_tail:
+            raise ValueError("frame_too_large")
+        (tlen,) = FROM_LEN.unpack_from(body)
+        return body[2 : 2 + tlen], body[2 + tlen :]
+
+async def read_frame(reader, limit: int = MAX_PAYLOAD) -> Tuple[int, int, bytes, memoryview]:
+    kind, flags, tlen, plen = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if plen > limit:
+        raise ValueError("frame_too_large")
+    body = memoryview(await reader.readexactly(tlen + plen))
+    return kind, flags, bytes(body[:tlen]), body[tlen:]
+
+# every complete frame at the start of buf, plus the number of bytes they used
+def split_frames(buf: bytearray, limit: int = MAX_PAYLOAD) -> Tuple[List[Tuple[int, int, bytes, bytes]], int]:
+    frames = []
+    pos = 0
+    with memoryview(buf) as view:
+        while len(buf) - pos >= FRAME_HEADER.size:
+            kind, flags, tlen, plen = FRAME_HEADER.unpack_from(buf, pos)
+            if plen > limit:
+                raise ValueError("frame_too_large")
+            start = pos + FRAME_HEADER.size
+            end = start + tlen + plen
+            if end > len(buf):
+                break
+            frames.append((kind, flags, bytes(view[start : start + tlen]), bytes(view[start + tlen : end])))
+            pos = end
+    return frames, pos
+
+# Client side: the relay's frames as dicts, the shape JSON clients get.
+# `invalid` stands in for a JSON object that does not parse.
+
+# the frames a receive window (`"window"` in register) counts and credit pays for
+CREDITED = {"deliver", "chat_message", "room_message", "file_chunk"}
+
+# every complete line in buf, which loses them
+def split_lines(buf: bytearray, invalid: dict) -> List[dict]:
+    end = buf.rfind(b"\n")
+    if end < 0:
+        return []
+    lines = bytes(buf[:end]).split(b"\n")
+    del buf[: end + 1]
+    msgs = []
+    for line in lines:
+        try:
+            msgs.append(json.loads(line))
+        except Exception:
+            msgs.append(invalid)
+    return msgs
+
+# every complete binary frame in buf, which loses them; inflate is the
+# connection's inbound stream when compression was agreed
+def decode_frames(buf: bytearray, inflate: Optional[Inflater], invalid: dict) -> List[dict]:
+    frames, used = split_frames(buf)
+    del buf[:used]
+    msgs = []
+    for kind, flags, target, payload in frames:
+        if flags & F_DEFLATE:
+            if inflate is None:
+                raise ValueError("bad_compression")
+            target, payload = inflate.unpack(payload)
+        if kind == K_DELIVER:
+            msgs.append({"type": "deliver", "from": target.decode("utf-8"), "payload": payload.decode("utf-8", "replace")})
+        elif kind == K_CHAT:
+            msgs.append({"type": "chat_message", "from": target.decode("utf-8"), "payload": payload.decode("utf-8", "replace")})
+        elif kind == K_FILE:
+            if len(payload) < 4:
+                raise ValueError("invalid_file_frame")
+            msgs.append({"type": "file_chunk", "from": target.decode("utf-8"), "payload": payload})
+        elif kind == K_ROOM:
+            (flen,) = FROM_LEN.unpack_from(payload)
+            msgs.append({
+                "type": "room_message",
+                "room": target.decode("utf-8"),
+                "from": payload[2 : 2 + flen].decode("utf-8"),
+                "payload": payload[2 + flen :].decode("utf-8", "replace"),
+            })
+        elif kind == K_ACK and len(payload) == SEQ.size:
+            msgs.append({"type": "ack", "seq": SEQ.unpack(payload)[0]})
+        elif kind == K_CONTROL:
+            try:
+                msgs.append(json.loads(payload))
+            except Exception:
+                msgs.append(invalid)
+    return msgs
@@ -1,11 +1,15 @@
 import uuid
 from .constants import ID_FILE
 
-def load_or_create_id() -> str:
+# interactive: show the saved id and let the user type another; otherwise the
+# saved id is used as it is, for headless runs that have no one to ask
+def load_or_create_id(interactive: bool = True) -> str:
     try:
         if ID_FILE.exists():
             existing = ID_FILE.read_text().strip()
             if existing:
+                if not interactive:
+                    return existing
                 print(f"[system] your id: {existing}")
                 choice = input("").strip()
                 if choice:
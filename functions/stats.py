@@ -0,0 +1,82 @@
+import json
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+# Client timing. Each stage keeps its last WINDOW samples; percentiles are
+# only worked out when the /stats overlay asks, at most once per REFRESH.
+# Recording is a perf_counter() call and a deque append.
+#
+# With a trace file every sample is also written as a Chrome trace event
+# (load it in chrome://tracing or ui.perfetto.dev): stages as complete events
+# on thread 0, latencies (event age, receive-to-screen, message round trips)
+# on thread 1, queue depth as a counter. The closing "]" is optional in that
+# format, so the trace of a client that crashed still loads.
+WINDOW = 512
+REFRESH = 0.5
+
+# stage -> (overlay label, unit); samples are seconds unless the unit is ""
+STAGES = {
+    "net": ("network parse", "ms"),
+    "events": ("apply events", "ms"),
+    "keys": ("keys+commands", "ms"),
+    "draw": ("draw", "ms"),
+    "queue_age": ("event age", "ms"),
+    "queue_depth": ("event depth", ""),
+    "recv_to_screen": ("recv->screen", "ms"),
+    "rtt": ("message rtt", "ms"),
+}
+LATENCIES = {"queue_age", "recv_to_screen", "rtt"}
+
+def percentile(ordered: List[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class Stats:
+    def __init__(self, trace_path: Optional[str] = None):
+        self.samples: Dict[str, Deque[float]] = {name: deque(maxlen=WINDOW) for name in STAGES}
+        self.trace = None
+        self.origin = time.perf_counter()
+        self.lines_at = 0.0
+        self.cached: List[str] = []
+        if trace_path:
+            self.trace = open(trace_path, "w")
+            self.trace.write('[{"name": "process_name", "ph": "M", "pid": 0, "args": {"name": "fluid client"}}')
+
+    # a stage that ran from start to end (perf_counter seconds)
+    def span(self, name: str, start: float, end: float):
+        self.samples[name].append(end - start)
+        if self.trace:
+            self._emit(name, "X", start, dur=round((end - start) * 1e6, 1), tid=1 if name in LATENCIES else 0)
+
+    def count(self, name: str, value: int):
+        self.samples[name].append(value)
+        if self.trace:
+            self._emit(name, "C", time.perf_counter(), args={name: value})
+
+    # overlay text: p50/p90/p99/max of every stage with samples
+    def lines(self) -> List[str]:
+        now = time.perf_counter()
+        if now - self.lines_at < REFRESH:
+            return self.cached
+        self.lines_at = now
+        out = [f"{'':14} {'p50':>7} {'p90':>7} {'p99':>7} {'max':>7}"]
+        for name, (label, unit) in STAGES.items():
+            ordered = sorted(self.samples[name])
+            if not ordered:
+                continue
+            scale = 1000 if unit else 1
+            cells = [percentile(ordered, q) * scale for q in (0.5, 0.9, 0.99)] + [ordered[-1] * scale]
+            out.append(f"{label:14} " + " ".join(f"{c:7.2f}" if unit else f"{c:7.0f}" for c in cells) + f" {unit}")
+        out.append(f"last {WINDOW} samples per stage; /stats to close")
+        self.cached = out
+        return out
+
+    def close(self):
+        if self.trace:
+            self.trace.write("\n]\n")
+            self.trace.close()
+            self.trace = None
+
+    def _emit(self, name: str, ph: str, start: float, tid: int = 0, **fields):
+        event = {"name": name, "ph": ph, "ts": round((start - self.origin) * 1e6, 1), "pid": 0, "tid": tid, **fields}
+        self.trace.write(",\n" + json.dumps(event))
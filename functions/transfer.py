@@ -0,0 +1,236 @@
+import asyncio
+import itertools
+import os
+import time
+from typing import Dict, Optional, Tuple
+from functions.constants import DOWNLOAD_DIR
+from functions.net import FRAME_HEADER, XFER, K_FILE
+
+# File transfer between two binary-framed clients:
+#   sender   file_offer  {id, sender, name, size}
+#   receiver file_accept {id, sender, window}   or file_cancel to decline
+#   sender   K_FILE frames, target the receiver, payload xfer_id:u32 data
+#   receiver file_ack    {id, sender, received} once per ACK_EVERY bytes on disk
+# The sender keeps at most `window` bytes past the last ack, so sender, relay
+# and receiver each hold at most one window of a transfer however large the
+# file is. Ids are per sender; "sender" tells either side whose transfer it is.
+CHUNK = 128 << 10
+WINDOW = 2 << 20
+ACK_EVERY = WINDOW // 4
+
+class Outgoing:
+    def __init__(self, xid: int, peer: str, path: str, size: int):
+        self.xid = xid
+        self.peer = peer
+        self.path = path
+        self.size = size
+        self.sent = 0
+        self.acked = 0
+        self.window = 0   # granted by file_accept
+        self.credit = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.started = 0.0
+
+class Incoming:
+    def __init__(self, xid: int, peer: str, name: str, size: int):
+        self.xid = xid
+        self.peer = peer
+        self.name = name
+        self.size = size
+        self.received = 0   # bytes on disk
+        self.acked = 0
+        self.chunks: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+        self.started = 0.0
+
+def human(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def _free_path(name: str) -> str:
+    base, ext = os.path.splitext(name)
+    path = os.path.join(DOWNLOAD_DIR, name)
+    for n in itertools.count(1):
+        if not os.path.exists(path) and not os.path.exists(path + ".part"):
+            return path
+        path = os.path.join(DOWNLOAD_DIR, f"{base} ({n}){ext}")
+
+# Transfers of one App. Disk reads and writes run in worker threads so a slow
+# disk stalls the transfer (through the window) but never the UI.
+class Transfers:
+    def __init__(self, app):
+        self.app = app
+        self.ids = itertools.count(1)
+        self.outgoing: Dict[int, Outgoing] = {}
+        self.incoming: Dict[Tuple[str, int], Incoming] = {}
+        self.offers: Dict[Tuple[str, int], Incoming] = {}   # waiting for /accept-file
+
+    async def offer(self, peer: str, path: str) -> Outgoing:
+        size = os.stat(path).st_size
+        out = Outgoing(next(self.ids), peer, path, size)
+        self.outgoing[out.xid] = out
+        await self._send("file_offer", peer, out.xid, self.app.my_id, name=os.path.basename(path), size=size)
+        return out
+
+    async def accept(self, peer: str, xid: int) -> Optional[Incoming]:
+        inc = self.offers.pop((peer, xid), None)
+        if inc is None:
+            return None
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        inc.name = _free_path(inc.name)
+        self.incoming[(peer, xid)] = inc
+        inc.started = time.monotonic()
+        inc.task = asyncio.create_task(self._receive(inc))
+        await self._send("file_accept", peer, xid, peer, window=WINDOW)
+        return inc
+
+    # declines an offer or stops a transfer in either direction
+    async def cancel(self, peer: str, xid: int, sender: str, reason: str = "cancelled") -> bool:
+        if sender == self.app.my_id:
+            found = self._drop_outgoing(xid)
+        else:
+            found = self._drop_incoming(peer, xid) or self.offers.pop((peer, xid), None) is not None
+        if found and self.app.online:
+            await self._send("file_cancel", peer, xid, sender, reason=reason)
+        return found
+
+    def abort_all(self, reason: str):
+        for xid in list(self.outgoing):
+            self._drop_outgoing(xid)
+        for key in list(self.incoming):
+            self._drop_incoming(*key)
+        self.offers.clear()
+        self.app.post("info", f"file transfers stopped: {reason}")
+
+    def status(self):
+        lines = []
+        for out in self.outgoing.values():
+            state = f"{100 * out.acked // max(out.size, 1)}%" if out.window else "waiting"
+            lines.append(f"  #{out.xid} to {out.peer}: {os.path.basename(out.path)} {human(out.size)} {state}")
+        for inc in self.incoming.values():
+            lines.append(f"  #{inc.xid} from {inc.peer}: {os.path.basename(inc.name)} {human(inc.size)} {100 * inc.received // max(inc.size, 1)}%")
+        for inc in self.offers.values():
+            lines.append(f"  #{inc.xid} from {inc.peer}: {inc.name} {human(inc.size)} offered")
+        return lines
+
+    # called from the network reader for file_* frames and chunks
+    def handle(self, msg: dict):
+        t = msg["type"]
+        peer = msg.get("from")
+        if t == "file_chunk":
+            data = msg["payload"]
+            inc = self.incoming.get((peer, XFER.unpack_from(data)[0]))
+            if inc is not None:
+                inc.chunks.put_nowait(memoryview(data)[XFER.size :])
+            return
+        body = msg.get("payload") or {}
+        xid = body.get("id")
+        if t == "file_offer":
+            name = os.path.basename(str(body.get("name") or "")).lstrip(".") or "file"
+            inc = Incoming(xid, peer, name, max(int(body.get("size", 0)), 0))
+            self.offers[(peer, xid)] = inc
+            self.app.post("info", f"{peer} offers {name} ({human(inc.size)}): /accept-file {peer} {xid} or /cancel-file {peer} {xid}")
+        elif t == "file_accept":
+            out = self.outgoing.get(xid)
+            if out is not None and out.peer == peer and out.task is None:
+                out.window = max(int(body.get("window", WINDOW)), CHUNK)
+                out.started = time.monotonic()
+                out.task = asyncio.create_task(self._pump(out))
+        elif t == "file_ack":
+            out = self.outgoing.get(xid)
+            if out is not None and out.peer == peer:
+                out.acked = max(out.acked, int(body.get("received", 0)))
+                out.credit.set()
+                if out.acked >= out.size:
+                    self.outgoing.pop(xid, None)
+                    self._done(f"sent {os.path.basename(out.path)} to {peer}", out.size, out.started)
+        elif t == "file_cancel":
+            reason = body.get("reason", "cancelled")
+            if body.get("sender") == self.app.my_id:
+                if self._drop_outgoing(xid):
+                    self.app.post("info", f"transfer #{xid} to {peer} stopped: {reason}")
+            elif self._drop_incoming(peer, xid) or self.offers.pop((peer, xid), None):
+                self.app.post("info", f"transfer #{xid} from {peer} stopped: {reason}")
+
+    # the relay could not reach peer; every transfer with it is over
+    def unreachable(self, peer: str):
+        for xid in [x for x, out in self.outgoing.items() if out.peer == peer]:
+            self._drop_outgoing(xid)
+        for key in [k for k in self.incoming if k[0] == peer]:
+            self._drop_incoming(*key)
+
+    async def _pump(self, out: Outgoing):
+        to = out.peer.encode("utf-8")
+        try:
+            with open(out.path, "rb") as f:
+                while out.sent < out.size:
+                    while out.sent - out.acked >= out.window:
+                        out.credit.clear()
+                        await out.credit.wait()
+                    data = await asyncio.to_thread(f.read, min(CHUNK, out.size - out.sent))
+                    if not data:
+                        raise OSError("file shrank while sending")
+                    writer = self.app.writer
+                    # header and id in one small write, the chunk as read
+                    writer.write(FRAME_HEADER.pack(K_FILE, 0, len(to), XFER.size + len(data)) + to + XFER.pack(out.xid))
+                    writer.write(data)
+                    out.sent += len(data)
+                    await writer.drain()
+        except OSError as e:
+            await self.cancel(out.peer, out.xid, self.app.my_id, reason="read error")
+            self.app.post("info", f"transfer #{out.xid} to {out.peer} failed: {e}")
+
+    async def _receive(self, inc: Incoming):
+        part = inc.name + ".part"
+        try:
+            with open(part, "wb") as f:
+                while inc.received < inc.size:
+                    data = await inc.chunks.get()
+                    if inc.received + len(data) > inc.size:
+                        raise OSError("more data than offered")
+                    await asyncio.to_thread(f.write, data)
+                    inc.received += len(data)
+                    if inc.received - inc.acked >= ACK_EVERY or inc.received == inc.size:
+                        inc.acked = inc.received
+                        await self._send("file_ack", inc.peer, inc.xid, inc.peer, received=inc.received)
+            if not inc.size:
+                await self._send("file_ack", inc.peer, inc.xid, inc.peer, received=0)
+            os.replace(part, inc.name)
+        except OSError as e:
+            self.incoming.pop((inc.peer, inc.xid), None)
+            await self._send("file_cancel", inc.peer, inc.xid, inc.peer, reason="write error")
+            self.app.post("info", f"transfer #{inc.xid} from {inc.peer} failed: {e}")
+            _unlink(part)
+            return
+        except asyncio.CancelledError:
+            _unlink(part)
+            raise
+        self.incoming.pop((inc.peer, inc.xid), None)
+        self._done(f"received {inc.name} from {inc.peer}", inc.size, inc.started)
+
+    async def _send(self, mtype: str, peer: str, xid: int, sender: str, **fields):
+        await self.app.send({"type": mtype, "to": peer, "payload": {"id": xid, "sender": sender, **fields}})
+
+    def _drop_outgoing(self, xid: int) -> bool:
+        out = self.outgoing.pop(xid, None)
+        if out is not None and out.task is not None:
+            out.task.cancel()
+        return out is not None
+
+    def _drop_incoming(self, peer: str, xid: int) -> bool:
+        inc = self.incoming.pop((peer, xid), None)
+        if inc is not None and inc.task is not None:
+            inc.task.cancel()
+        return inc is not None
+
+    def _done(self, what: str, size: int, started: float):
+        secs = max(time.monotonic() - started, 1e-6)
+        self.app.post("info", f"{what}: {human(size)} in {secs:.1f}s ({human(size / secs)}/s)")
+
+def _unlink(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
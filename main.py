@@ -1,18 +1,112 @@
+import argparse
 import asyncio
+import json
 import sys
+import threading
+from functions.client import Client
+from functions.net import MESSAGE_KINDS
 from functions.persistence import load_or_create_id
-from functions.app import App
 
 async def main():
-    if len(sys.argv) < 3:
-        print("invalid usage, main.py [host] [port]")
-        sys.exit(1)
-    host = sys.argv[1]
-    port = int(sys.argv[2])
-    my_id = load_or_create_id()
+    parser = argparse.ArgumentParser(usage="main.py [host] [port] [--trace FILE] [--headless] [--id ID]")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--trace", metavar="FILE", help="write a Chrome trace of client timings to FILE")
+    parser.add_argument("--headless", action="store_true", help="no screen: JSON frames in on stdin, out on stdout")
+    parser.add_argument("--id", help="register as ID instead of the one in id.txt")
+    args = parser.parse_args()
+    my_id = args.id or load_or_create_id(interactive=not args.headless)
+    if args.headless:
+        sys.exit(await headless(args.host, args.port, my_id))
+    await interactive(args.host, args.port, my_id, args.trace)
 
-    app = App(host, port, my_id)
-    await app.connect()
+# every line on stdin is a JSON frame as a JSON client would send it; send,
+# chat_message and room_message are pipelined and their delivery state is
+# printed as {"type": "delivery", "line": n, "state": ...}. Every frame from
+# the relay is printed as one JSON line. Exits at the end of stdin, once every
+# message is settled, or with 1 when the relay goes away.
+async def headless(host: str, port: int, my_id: str) -> int:
+    client = Client(host, port, my_id)
+    try:
+        print(json.dumps(await client.connect()), flush=True)
+    except OSError as e:
+        print(f"cannot reach {host}:{port} ({e.strerror or e})", file=sys.stderr)
+        return 1
+
+    async def output():
+        async for msg in client:
+            print(json.dumps(msg, default=bytes.hex), flush=True)
+
+    def settled(n: int, future: asyncio.Future):
+        print(json.dumps({"type": "delivery", "line": n, "state": future.result()}), flush=True)
+
+    printer = asyncio.create_task(output())
+    lines = read_lines()
+    pending = []
+    n = 0
+    while True:
+        line = asyncio.ensure_future(lines.get())
+        await asyncio.wait((line, printer), return_when=asyncio.FIRST_COMPLETED)
+        if not line.done():   # the relay went away
+            line.cancel()
+            break
+        line = line.result()
+        if not line:
+            break
+        n += 1
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+            mtype = obj.get("type")
+            if mtype in MESSAGE_KINDS:
+                to = obj["room" if mtype == "room_message" else "to"]
+                if not isinstance(to, str):
+                    raise ValueError(to)
+                future = client.post(mtype, to, str(obj.get("payload", "")))
+                future.add_done_callback(lambda f, n=n: settled(n, f))
+                pending.append(future)
+            else:
+                await client.send_frame(obj)
+        except (ValueError, KeyError, AttributeError):
+            print(json.dumps({"type": "error", "error": "invalid_input", "line": n}), flush=True)
+        except ConnectionError:
+            break
+    if pending:
+        await asyncio.gather(*pending)
+    lost = client.closed
+    await client.close()
+    await printer
+    return 1 if lost else 0
+
+# stdin, a line at a time, from a daemon thread that never holds up exit; "" at the end
+def read_lines() -> asyncio.Queue:
+    loop = asyncio.get_running_loop()
+    lines: asyncio.Queue = asyncio.Queue()
+
+    def reader():
+        try:
+            for line in iter(sys.stdin.readline, ""):
+                loop.call_soon_threadsafe(lines.put_nowait, line)
+            loop.call_soon_threadsafe(lines.put_nowait, "")
+        except RuntimeError:   # the loop is closed
+            pass
+
+    threading.Thread(target=reader, daemon=True).start()
+    return lines
+
+async def interactive(host: str, port: int, my_id: str, trace):
+    # the screen, history store and curses are only loaded for the interactive client
+    from functions.app import App
+    from functions.constants import HISTORY_FILE
+    from functions.history import History
+    from functions.stats import Stats
+
+    app = App(host, port, my_id, History(HISTORY_FILE), Stats(trace))
+    try:
+        await app.connect()
+    except OSError as e:
+        app.post("info", f"cannot reach {host}:{port} ({e.strerror or e}), retrying")
 
     task_net = asyncio.create_task(app.network_reader())
     try:
@@ -30,6 +124,8 @@ async def main():
                 await app.writer.wait_closed()
         except Exception:
             pass
+        app.history.close()
+        app.stats.close()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,324 @@
+import asyncio
+from time import perf_counter
+from typing import Awaitable, Callable, List, Optional, Tuple
+from functions.net import Deflater, Inflater, FRAME_HEADER, MAX_PAYLOAD
+from relay.flow import Bucket
+from relay.metrics import METRICS
+from relay.timers import Timer
+
+OVERFLOW_POLICIES = ("drop", "disconnect", "block")
+
+# Every peer gets a bounded outbox, so a slow reader only ever stalls its own
+# queue and never the sender's read loop. Frames queued during one event-loop
+# tick go out with one transport write; while the transport is above its high
+# water mark they wait in the outbox and count against `limit`.
+# A frame is bytes, or a (head, payload) tuple for forwarded file chunks: the
+# payload is a view of the received frame and is written without copying.
+# An idle peer costs the outbox list and a few slots: no task, no events.
+#
+# A client that registered with a window also holds `credit`: how many more
+# messages (deliver, chat, room and file frames, queued with credited=True) it
+# has room for. Messages beyond that wait in `held` until the client grants
+# more (see grant); they are only compressed once released, so the deflate
+# stream stays in write order. Replies, acks, pings and errors never wait for
+# credit, and only messages count held frames against `limit`, so a client's
+# own replies cannot stall behind messages it has not made room for.
+WINDOW_MAX = 4096   # largest window a client may ask for
+
+class Outbox:
+    __slots__ = ("transport", "outbox", "held", "deflate", "closing", "flushing", "paused", "space", "credit")
+    limit = 1024          # max queued frames per connection
+    policy = "disconnect" # what happens when a peer's queue is full, see OVERFLOW_POLICIES
+    metered = True        # count written bytes in fluid_bytes_out_total
+    close_timeout = 5.0   # seconds to flush pending frames before aborting on close
+
+    def __init__(self):
+        self.transport: Optional[asyncio.WriteTransport] = None
+        self.outbox: List = []
+        self.held: Optional[List] = None   # messages waiting for credit, made when the first one has to
+        self.deflate: Optional[Deflater] = None   # negotiated at register
+        self.closing = False
+        self.flushing = False   # a flush is scheduled for the end of this tick
+        self.paused = False     # the transport asked us to stop writing
+        self.space: Optional[asyncio.Event] = None   # only made once a reply has to wait
+        self.credit: Optional[int] = None   # None: no window, the transport is the only limit
+
+    async def send(self, data: bytes, credited: bool = False):
+        if self.closing:
+            return
+        if self._full(credited):
+            if self.policy == "drop":
+                return
+            if self.policy == "disconnect":
+                self.abort()
+                return
+        await self.reply(data, credited)
+
+    # replies to a client's own requests always wait for room: that only pauses
+    # reading from the same client, which is the backpressure we want
+    async def reply(self, data: bytes, credited: bool = False):
+        while self._full(credited) and not self.closing:
+            if self.space is None:
+                self.space = asyncio.Event()
+            self.space.clear()
+            await self.space.wait()
+        if self.closing:
+            return
+        self._queue(data, credited)
+
+    # never waits: a full outbox drops the frame (or the connection, under the
+    # disconnect policy). Used for fan-out and from timer callbacks.
+    def offer(self, data: bytes, credited: bool = False) -> bool:
+        if self.closing:
+            return False
+        if self._full(credited):
+            if self.policy == "disconnect":
+                self.abort()
+            return False
+        self._queue(data, credited)
+        return True
+
+    # frames queued, held messages included
+    def depth(self) -> int:
+        return len(self.outbox) + (len(self.held) if self.held else 0)
+
+    def _full(self, credited: bool) -> bool:
+        return (self.depth() if credited else len(self.outbox)) >= self.limit
+
+    def _queue(self, data, credited: bool = False):
+        if credited and self.credit is not None:
+            if not self.credit or self.held:
+                if self.held is None:
+                    self.held = []
+                self.held.append(data)
+                return
+            self.credit -= 1
+        self.outbox.append(self._pack(data) if self.deflate else data)
+        if not self.flushing:
+            self.flushing = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    # frames join the compressed stream as they are queued, so they stay in
+    # order and dropped frames cost nothing
+    def _pack(self, data: bytes) -> bytes:
+        if type(data) is tuple or len(data) < self.deflate.threshold:
+            return data
+        started = perf_counter()
+        packed = self.deflate.pack(data)
+        METRICS.observe_compress("out", perf_counter() - started, len(data) - len(packed))
+        return packed
+
+    def _flush(self):
+        self.flushing = False
+        if self.paused or not self.outbox or self.transport is None:
+            return
+        self._write_out()
+
+    # the client has handled n more messages
+    def grant(self, n: int):
+        self.credit = min(self.credit + n, WINDOW_MAX)
+        if self.held:
+            self._release(self.credit)
+        if not self.flushing:
+            self._flush()
+
+    # moves up to n held messages to the outbox, in order
+    def _release(self, n: int):
+        held = self.held
+        n = min(n, len(held))
+        for data in held[:n]:
+            self.outbox.append(self._pack(data) if self.deflate else data)
+        self.held = held[n:] or None
+        if self.credit is not None:
+            self.credit -= n
+
+    # hands the outbox to the transport; small frames are joined into one write
+    def _write_out(self):
+        outbox = self.outbox
+        self.outbox = []
+        transport = self.transport
+        small = []
+        size = 0
+        for frame in outbox:
+            if type(frame) is tuple:
+                if not isinstance(frame[1], (bytes, bytearray, memoryview)):
+                    continue   # never half a frame: the peer's stream would be lost
+                small.append(frame[0])
+                transport.write(b"".join(small))
+                transport.write(frame[1])
+                size += len(frame[0]) + len(frame[1])
+                small = []
+            else:
+                small.append(frame)
+                size += len(frame)
+        if small:
+            transport.write(small[0] if len(small) == 1 else b"".join(small))
+        if self.metered:
+            METRICS.bytes_out += size
+        if self.space is not None:
+            self.space.set()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._flush()
+
+    # what is queued still goes out; a peer that does not take it within
+    # close_timeout is aborted
+    def close(self):
+        if self.closing:
+            return
+        self.closing = True
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.held:
+            self._release(len(self.held))   # the last frames go out regardless
+        self.credit = None
+        if self.outbox:
+            self._write_out()
+        self.transport.close()
+        if self.transport.get_write_buffer_size():
+            asyncio.get_running_loop().call_later(self.close_timeout, self.transport.abort)
+
+    def abort(self):
+        self.closing = True
+        self.outbox = []
+        self.held = None
+        if self.space is not None:
+            self.space.set()
+        if self.transport is not None:
+            self.transport.abort()
+
+# A client connection is its own protocol and holds everything the relay
+# keeps per client. Reads land in one buffer shared by all connections; a
+# connection only keeps the bytes of a frame it has not finished, so an idle
+# one holds no read buffer. `handler` runs as a task while frames are
+# waiting and returns once they are handled: an idle client has no task or
+# coroutine frame either.
+READ_BUFFER = memoryview(bytearray(1 << 16))
+READ_PAUSE = 1 << 18   # stop reading from a client this far behind; resumed once its handler is done
+LINE_LIMIT = 1 << 16   # longest JSON line
+
+class Connection(Outbox, asyncio.BufferedProtocol):
+    __slots__ = ("handler", "task", "inbuf", "lost", "user", "binary", "inflate", "seen", "active", "pinged", "heartbeat", "timer", "bucket",
+                 "seq", "unacked")
+
+    def __init__(self, handler: Callable[["Connection"], Awaitable[None]]):
+        super().__init__()
+        self.handler = handler
+        self.task: Optional[asyncio.Task] = None
+        self.inbuf: Optional[bytearray] = None   # unhandled bytes
+        self.lost = False   # the transport is gone; the handler cleans up
+        self.user: Optional[str] = None
+        self.binary = False   # negotiated at register, see functions/net.py
+        self.inflate: Optional[Inflater] = None
+        # liveness, see check_liveness in server.py; times are perf_counter()
+        self.seen = self.active = perf_counter()   # last frame / last frame that was not a pong or credit
+        self.pinged = 0.0
+        self.heartbeat = False   # registered saying it answers ping with pong
+        self.timer: Optional[Timer] = None
+        self.bucket: Optional[Bucket] = None   # rate limit, see relay/flow.py
+        self.seq = 0     # of the message being handled, when it carried one
+        self.unacked = 0   # last seq handled and not acked yet; see F_SEQ in functions/net.py
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return READ_BUFFER
+
+    def buffer_updated(self, nbytes: int):
+        if self.inbuf is None:
+            self.inbuf = bytearray(READ_BUFFER[:nbytes])
+        else:
+            self.inbuf += READ_BUFFER[:nbytes]
+        self._wake()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.lost = self.closing = True
+        self.outbox = []
+        self.held = None
+        if self.space is not None:
+            self.space.set()
+        self._wake()
+
+    def _wake(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+        elif self.inbuf is not None and len(self.inbuf) > READ_PAUSE and not self.lost:
+            self.transport.pause_reading()
+
+    async def _run(self):
+        try:
+            await self.handler(self)
+        finally:
+            self.task = None
+            if not self.lost and not self.transport.is_reading():
+                self.transport.resume_reading()
+
+    # the next complete line (with its newline), or None
+    def read_line(self) -> Optional[bytes]:
+        buf = self.inbuf
+        if buf is None:
+            return None
+        end = buf.find(b"\n") + 1
+        if not end:
+            if len(buf) > LINE_LIMIT:
+                self.inbuf = None
+                raise ValueError("line_too_long")
+            return None
+        line = bytes(buf[:end])
+        self._consume(end)
+        return line
+
+    # the next complete binary frame (kind, flags, target, payload), or None
+    def read_frame(self, limit: int = MAX_PAYLOAD) -> Optional[Tuple[int, int, bytes, memoryview]]:
+        buf = self.inbuf
+        if buf is None or len(buf) < FRAME_HEADER.size:
+            return None
+        kind, flags, tlen, plen = FRAME_HEADER.unpack_from(buf)
+        if plen > limit:
+            raise ValueError("frame_too_large")
+        end = FRAME_HEADER.size + tlen + plen
+        if len(buf) < end:
+            return None
+        with memoryview(buf) as view:
+            body = memoryview(bytes(view[FRAME_HEADER.size : end]))
+        self._consume(end)
+        return kind, flags, bytes(body[:tlen]), body[tlen:]
+
+    def _consume(self, n: int):
+        if n == len(self.inbuf):
+            self.inbuf = None
+        else:
+            del self.inbuf[:n]
+
+# Shard and federation links write through a StreamWriter, whose protocol
+# gets the pause/resume calls; the link waits in drain() instead.
+class Link(Outbox):
+    __slots__ = ("writer",)
+    policy = "block"   # frames between relays are never dropped
+    limit = 1 << 16
+    metered = False
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        super().__init__()
+        self.writer = writer
+        self.transport = writer.transport
+
+    def _flush(self):
+        super()._flush()
+        if not self.paused and self.transport.get_write_buffer_size() > self.transport.get_write_buffer_limits()[1]:
+            self.paused = True
+            asyncio.ensure_future(self._drain())
+
+    async def _drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            self.abort()
+            return
+        self.paused = False
+        self._flush()
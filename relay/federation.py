@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import hmac
+import random
+import secrets
+import time
+from typing import Any, Callable, Dict, Optional, Set
+from functions.net import read_frame, MAX_PAYLOAD
+from relay.connection import Link
+from relay.shards import decode_op, encode_op
+
+# Relays on different hosts form a federation over TCP. Each node dials every
+# node it knows of (the --peer seeds, then the nodes their hellos list) and,
+# like shard links, sends only on its own outgoing stream with encode_op
+# framing. After the handshake the stream carries ops one way only.
+#
+# Handshake: each side sends a fresh nonce and proves it holds the shared key
+# by MACing the other side's nonce with its own name and role, so an answer
+# to one side's challenge is never a valid answer in the other role. Nothing
+# about the federation goes out before the other side has proved itself.
+#   dialer   -> hello    {"nonce": nd}
+#   accepter -> hello    {"nonce": na, "mac": mac("accept", nd, accepter)}
+#   dialer   -> auth     {"mac": mac("dial", na, dialer), "addr", "nodes"}
+#   accepter -> welcome  {"addr", "nodes"}
+#
+# Presence: a node announces its users with a snapshot when a link comes up,
+# then with deltas ({"up": [[user, registered_at], ...], "down": [user, ...]})
+# batched for PRESENCE_DELAY. Pending deltas always go out ahead of any other
+# op, so a node never hears from a user before it knows where that user is.
+# A node whose stream closes or stays silent for DEAD_AFTER is gone.
+PRESENCE_DELAY = 0.05
+HEARTBEAT = 5.0
+DEAD_AFTER = 15.0
+REDIAL_MAX = 30.0
+
+OpHandler = Callable[[str, str, str, Optional[str], Any, int], Any]
+
+def parse_addr(addr: str):
+    host, _, port = addr.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+class Federation:
+    def __init__(self, name: str, addr: str, seeds, on_op: OpHandler, on_node_up: Callable[[str], Any],
+                 on_node_down: Callable[[str], Any], key: bytes):
+        # without a key any host that reaches the port could join and speak for users
+        if not key:
+            raise ValueError("federation needs a shared key")
+        self.name = name
+        self.addr = addr   # where other nodes dial us
+        self.seeds = list(seeds)
+        self.key = key
+        self.on_op = on_op
+        self.on_node_up = on_node_up
+        self.on_node_down = on_node_down
+        self.links: Dict[str, Link] = {}   # node -> our outgoing stream
+        self.inbound: Dict[str, object] = {}   # node -> marker of its current stream to us
+        self.nodes: Dict[str, str] = {}   # node -> addr, every node heard of
+        self.dialing: Set[str] = set()   # addrs with a dial loop running
+        self.local: Dict[str, float] = {}   # our users -> when they registered
+        self.ups: Dict[str, float] = {}
+        self.downs: Set[str] = set()
+        self.flushing = False
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(self._accept, host, port)
+        for addr in self.seeds:
+            self._dial_soon(addr)
+        asyncio.create_task(self._heartbeat())
+
+    # the user registered here; a later registration elsewhere wins over this one
+    def up(self, user: str):
+        self.local[user] = self.ups[user] = time.time()
+        self.downs.discard(user)
+        self._schedule()
+
+    def down(self, user: str, announce: bool = True):
+        self.local.pop(user, None)
+        self.ups.pop(user, None)
+        if announce:
+            self.downs.add(user)
+            self._schedule()
+
+    # whether our user's registration is newer than node's claim on them
+    def beats(self, user: str, since, node: str) -> bool:
+        mine = self.local.get(user)
+        return mine is not None and (mine, self.name) > (float(since or 0), node)
+
+    async def send(self, node: str, op: str, user: str, from_id: Optional[str] = None, payload: Any = None, seq: int = 0):
+        if self.ups or self.downs:
+            await self._flush()
+        link = self.links.get(node)
+        if link is not None:
+            await link.send(encode_op(op, user, from_id, payload, seq))
+
+    async def broadcast(self, op: str, user: str, from_id: Optional[str] = None, payload: Any = None):
+        if self.ups or self.downs:
+            await self._flush()
+        data = encode_op(op, user, from_id, payload)
+        for link in list(self.links.values()):
+            await link.send(data)
+
+    def _schedule(self):
+        if not self.flushing:
+            self.flushing = True
+            asyncio.get_running_loop().call_later(PRESENCE_DELAY, lambda: asyncio.ensure_future(self._flush()))
+
+    async def _flush(self):
+        self.flushing = False
+        if not (self.ups or self.downs):
+            return
+        delta = {"up": list(self.ups.items()), "down": list(self.downs)}
+        self.ups, self.downs = {}, set()
+        data = encode_op("presence", "", self.name, delta)
+        for link in list(self.links.values()):
+            await link.send(data)
+
+    def _mac(self, role: str, nonce: str, name: str) -> str:
+        return hmac.new(self.key, f"{role}:{nonce}:{name}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def _about(self) -> dict:
+        return {"addr": self.addr, "nodes": self.nodes}
+
+    # whether body proves name holds the key, answering our nonce in role
+    def _check(self, role: str, name, body, nonce: str) -> bool:
+        return isinstance(name, str) and isinstance(body, dict) \
+            and hmac.compare_digest(str(body.get("mac", "")), self._mac(role, nonce, name))
+
+    def _learn(self, nodes):
+        for name, addr in (nodes or {}).items():
+            if name != self.name and name not in self.nodes:
+                self.nodes[name] = addr
+                self._dial_soon(addr)
+
+    def _dial_soon(self, addr: str):
+        if addr != self.addr and addr not in self.dialing:
+            self.dialing.add(addr)
+            asyncio.create_task(self._dial(addr))
+
+    # keeps one outgoing stream to the node at addr, redialing with backoff
+    async def _dial(self, addr: str):
+        attempt = 0
+        try:
+            while True:
+                name = await self._link(addr)
+                if name == self.name or name in self.links:
+                    return   # a seed that turned out to be us, or a node we reach by another address
+                if name:
+                    attempt = 0
+                else:
+                    attempt += 1
+                await asyncio.sleep(random.uniform(0, min(REDIAL_MAX, 0.25 * 2 ** attempt)))
+        finally:
+            self.dialing.discard(addr)
+
+    # runs one outgoing stream until it breaks; returns the node's name if the handshake worked
+    async def _link(self, addr: str) -> Optional[str]:
+        try:
+            reader, writer = await asyncio.open_connection(*parse_addr(addr))
+        except OSError:
+            return None
+        try:
+            nonce = secrets.token_hex(16)
+            writer.write(encode_op("hello", "", self.name, {"nonce": nonce}))
+            op, _, name, body, _ = decode_op(*await asyncio.wait_for(read_frame(reader), DEAD_AFTER))
+            if op != "hello" or not self._check("accept", name, body, nonce):
+                writer.close()
+                return None
+            if name == self.name or name in self.links:
+                writer.close()
+                return name
+            writer.write(encode_op("auth", "", self.name, {"mac": self._mac("dial", str(body.get("nonce")), self.name), **self._about()}))
+            op, _, _, body, _ = decode_op(*await asyncio.wait_for(read_frame(reader), DEAD_AFTER))
+            if op != "welcome" or not isinstance(body, dict):
+                writer.close()
+                return None
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError, KeyError):
+            writer.close()
+            return None
+        self.nodes[name] = body.get("addr") or addr
+        self._learn(body.get("nodes"))
+        link = Link(writer)
+        # the snapshot goes first so ops that follow can be routed
+        await link.send(encode_op("presence", "", self.name, {"up": list(self.local.items()), "down": []}))
+        self.links[name] = link
+        print(f"federation: linked to {name} at {addr}")
+        try:
+            await self.on_node_up(name)
+            # nothing comes back on this stream; EOF means the node is gone
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            if self.links.get(name) is link:
+                del self.links[name]
+            link.close()
+        return name
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        name = None
+        marker = object()
+        try:
+            op, _, name, body, _ = decode_op(*await asyncio.wait_for(read_frame(reader), DEAD_AFTER))
+            if op != "hello" or not isinstance(name, str) or name == self.name or not isinstance(body, dict):
+                name = None
+                return
+            nonce = secrets.token_hex(16)
+            writer.write(encode_op("hello", "", self.name, {"nonce": nonce, "mac": self._mac("accept", str(body.get("nonce")), self.name)}))
+            op, _, claimed, body, _ = decode_op(*await asyncio.wait_for(read_frame(reader), DEAD_AFTER))
+            if op != "auth" or claimed != name or not self._check("dial", name, body, nonce):
+                name = None
+                return
+            writer.write(encode_op("welcome", "", self.name, self._about()))
+            if name in self.inbound:
+                await self.on_node_down(name)   # back before its old stream timed out
+            self.inbound[name] = marker
+            self.nodes[name] = body.get("addr") or self.nodes.get(name, "")
+            self._learn(body.get("nodes"))
+            if name not in self.links and self.nodes[name]:
+                self._dial_soon(self.nodes[name])
+            while True:
+                op, user, from_id, body, seq = decode_op(*await asyncio.wait_for(read_frame(reader, 2 * MAX_PAYLOAD), DEAD_AFTER))
+                if op == "presence":
+                    for user, since in body.get("up", ()):
+                        await self.on_op(name, "claim", user, None, since, 0)
+                    for user in body.get("down", ()):
+                        await self.on_op(name, "release", user, None, None, 0)
+                elif op != "ping":
+                    await self.on_op(name, op, user, from_id, body, seq)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            writer.close()
+            if name is not None and self.inbound.get(name) is marker:
+                del self.inbound[name]
+                print(f"federation: {name} left")
+                link = self.links.pop(name, None)
+                if link is not None:
+                    link.close()   # its dial loop reconnects when the node is back
+                await self.on_node_down(name)
+
+    async def _heartbeat(self):
+        ping = encode_op("ping", "")
+        while True:
+            await asyncio.sleep(HEARTBEAT)
+            for link in list(self.links.values()):
+                await link.send(ping)
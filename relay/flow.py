@@ -0,0 +1,26 @@
+# Rate limit for the frames that carry messages. Every client has a token
+# bucket that holds `burst` tokens and refills at `rate` a second; a frame
+# takes one. A client that runs dry is told to slow_down once and its input
+# waits for the next token, so nothing it sent is lost and reading from it
+# pauses once its buffer fills. Buckets are made on a client's first message.
+class Bucket:
+    __slots__ = ("tokens", "stamp", "warned")
+    rate = 200.0    # tokens a second; 0 turns rate limiting off
+    burst = 400.0
+
+    def __init__(self, now: float):
+        self.tokens = self.burst
+        self.stamp = now
+        self.warned = False   # slow_down was sent and the client has not backed off since
+
+    # takes a token and returns 0.0, or returns the seconds until one is earned
+    def take(self, now: float) -> float:
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            if self.tokens >= self.burst / 2:
+                self.warned = False
+            return 0.0
+        self.tokens = tokens
+        return (1 - tokens) / self.rate
@@ -0,0 +1,243 @@
+import base64
+import json
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+# Offline messages are appended to per-recipient segment files
+#   <root>/<b64(user)>/<seq:020d>.seg
+# each record being
+#   payload_len:u32 ts:f64 from_len:u16 flags:u8 from payload
+# Only offsets are kept in memory. Delivery walks segments through mmap and
+# deletes them once consumed; `cursor` remembers a partially delivered head.
+RECORD = struct.Struct("!IdHB")
+F_JSON = 1   # payload is a JSON value rather than utf-8 text
+
+class Segment:
+    __slots__ = ("seq", "path", "offsets", "size", "last_ts")
+
+    def __init__(self, seq: int, path: str):
+        self.seq = seq
+        self.path = path
+        self.offsets: List[int] = []
+        self.size = 0
+        self.last_ts = 0.0
+
+class Box:
+    __slots__ = ("user", "path", "segments", "head", "bytes", "draining")
+
+    def __init__(self, user: str, path: str):
+        self.user = user
+        self.path = path
+        self.segments: Deque[Segment] = deque()
+        self.head = 0   # first undelivered record in segments[0]
+        self.bytes = 0
+        self.draining = False
+
+    def count(self) -> int:
+        return sum(len(s.offsets) for s in self.segments) - self.head
+
+class Mailbox:
+    def __init__(
+        self,
+        root: str,
+        segment_bytes: int = 1 << 20,
+        max_user_bytes: int = 16 << 20,
+        max_user_messages: int = 10000,
+        max_total_bytes: int = 1 << 30,
+        max_age: float = 7 * 86400,
+        open_files: int = 256,
+        owns: Optional[Callable[[str], bool]] = None,
+    ):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.max_user_bytes = max_user_bytes
+        self.max_user_messages = max_user_messages
+        self.max_total_bytes = max_total_bytes
+        self.max_age = max_age
+        self.open_files = open_files
+        self.owns = owns   # sharded relays share the root; each worker loads only its users
+        self.boxes: Dict[str, Box] = {}
+        self.total_bytes = 0
+        self.fds: "OrderedDict[str, int]" = OrderedDict()   # appenders, LRU by segment path
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def count(self, user: str) -> int:
+        box = self.boxes.get(user)
+        return box.count() if box is not None else 0
+
+    def append(self, user: str, from_id: str, payload: Any) -> bool:
+        if isinstance(payload, str):
+            data, flags = payload.encode("utf-8"), 0
+        elif isinstance(payload, (bytes, memoryview)):
+            data, flags = bytes(payload), 0
+        else:
+            data, flags = json.dumps(payload).encode("utf-8"), F_JSON
+        sender = from_id.encode("utf-8")
+        now = time.time()
+        record = RECORD.pack(len(data), now, len(sender), flags) + sender + data
+        if self.total_bytes + len(record) > self.max_total_bytes or len(record) > self.max_user_bytes:
+            return False
+
+        box = self.boxes.get(user)
+        if box is None:
+            path = os.path.join(self.root, base64.urlsafe_b64encode(user.encode("utf-8")).decode("ascii"))
+            os.makedirs(path, exist_ok=True)
+            box = self.boxes[user] = Box(user, path)
+        seg = box.segments[-1] if box.segments else None
+        if seg is None or seg.size + len(record) > self.segment_bytes:
+            seg = self._new_segment(box, seg.seq + 1 if seg else 0)
+        os.write(self._appender(seg.path), record)
+        seg.offsets.append(seg.size)
+        seg.size += len(record)
+        seg.last_ts = now
+        box.bytes += len(record)
+        self.total_bytes += len(record)
+        self._enforce(box, now)
+        return True
+
+    # yields lists of (from, payload, ts); the caller consumes a batch before asking
+    # for the next one, and whatever it did not consume is kept for next time
+    def batches(self, user: str, size: int = 256) -> Iterator[List[Tuple[str, Any, float]]]:
+        box = self.boxes.get(user)
+        if box is None or box.draining:
+            return
+        box.draining = True
+        try:
+            self._enforce(box, time.time())
+            while box.segments:
+                seg = box.segments[0]
+                if box.head < len(seg.offsets):
+                    with open(seg.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        limit = len(seg.offsets)   # records appended meanwhile are picked up on the next pass
+                        while box.segments and box.segments[0] is seg and box.head < limit:
+                            end = min(box.head + size, limit)
+                            batch = [_parse(mm, off) for off in seg.offsets[box.head : end]]
+                            yield batch
+                            box.head = end
+                    continue
+                self._drop_segment(box)
+        finally:
+            box.draining = False
+            self._save_cursor(box)
+            if not box.segments:
+                self._remove_box(box)
+
+    def _enforce(self, box: Box, now: float):
+        while box.segments and (
+            box.bytes > self.max_user_bytes or box.segments[0].last_ts < now - self.max_age
+        ):
+            self._drop_segment(box)
+        excess = box.count() - self.max_user_messages
+        if excess > 0 and box.segments:
+            box.head += excess
+            while box.segments and box.head >= len(box.segments[0].offsets):
+                box.head -= len(box.segments[0].offsets)
+                self._drop_segment(box, keep_head=True)
+            self._save_cursor(box)
+
+    def _new_segment(self, box: Box, seq: int) -> Segment:
+        seg = Segment(seq, os.path.join(box.path, f"{seq:020d}.seg"))
+        box.segments.append(seg)
+        return seg
+
+    def _drop_segment(self, box: Box, keep_head: bool = False):
+        seg = box.segments.popleft()
+        self._close_appender(seg.path)
+        try:
+            os.unlink(seg.path)
+        except OSError:
+            pass
+        box.bytes -= seg.size
+        if box.user in self.boxes:
+            self.total_bytes -= seg.size
+        if not keep_head:
+            box.head = 0
+
+    def _remove_box(self, box: Box):
+        self.boxes.pop(box.user, None)
+        for name in os.listdir(box.path):
+            os.unlink(os.path.join(box.path, name))
+        os.rmdir(box.path)
+
+    def _appender(self, path: str) -> int:
+        fd = self.fds.pop(path, None)
+        if fd is None:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            while len(self.fds) >= self.open_files:
+                os.close(self.fds.popitem(last=False)[1])
+        self.fds[path] = fd
+        return fd
+
+    def _close_appender(self, path: str):
+        fd = self.fds.pop(path, None)
+        if fd is not None:
+            os.close(fd)
+
+    def _save_cursor(self, box: Box):
+        cursor = os.path.join(box.path, "cursor")
+        if box.segments and box.head:
+            with open(cursor, "w") as f:
+                f.write(f"{box.segments[0].seq} {box.head}")
+        elif os.path.exists(cursor):
+            os.unlink(cursor)
+
+    def _load(self):
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                user = base64.urlsafe_b64decode(name.encode("ascii")).decode("utf-8")
+            except Exception:
+                continue
+            if self.owns is not None and not self.owns(user):
+                continue
+            box = Box(user, path)
+            for seg_name in sorted(n for n in os.listdir(path) if n.endswith(".seg")):
+                seg = Segment(int(seg_name[:-4]), os.path.join(path, seg_name))
+                _scan(seg)
+                box.segments.append(seg)
+                box.bytes += seg.size
+            try:
+                with open(os.path.join(path, "cursor")) as f:
+                    seq, head = map(int, f.read().split())
+                while box.segments and box.segments[0].seq < seq:
+                    self._drop_segment(box)
+                if box.segments and box.segments[0].seq == seq:
+                    box.head = min(head, len(box.segments[0].offsets))
+            except (OSError, ValueError):
+                pass
+            if box.count() <= 0:
+                self._remove_box(box)
+                continue
+            self.boxes[user] = box
+            self.total_bytes += box.bytes
+
+def _parse(mm: mmap.mmap, off: int) -> Tuple[str, Any, float]:
+    plen, ts, flen, flags = RECORD.unpack_from(mm, off)
+    start = off + RECORD.size
+    from_id = mm[start : start + flen].decode("utf-8")
+    data = mm[start + flen : start + flen + plen]
+    payload = json.loads(data) if flags & F_JSON else data
+    return from_id, payload, ts
+
+def _scan(seg: Segment):
+    size = os.path.getsize(seg.path)
+    if not size:
+        return
+    with open(seg.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        off = 0
+        while off + RECORD.size <= size:
+            plen, ts, flen, _ = RECORD.unpack_from(mm, off)
+            end = off + RECORD.size + flen + plen
+            if end > size:
+                break   # torn tail from a crash mid-append
+            seg.offsets.append(off)
+            seg.last_ts = ts
+            off = end
+    seg.size = off
+    if off < size:
+        os.truncate(seg.path, off)
@@ -0,0 +1,132 @@
+import asyncio
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Always-on relay instrumentation. Recording is a dict increment and a bisect
+# per frame; rendering to Prometheus text happens only when scraped.
+LATENCY_BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.5)
+LAG_BOUNDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str = "") -> Iterable[str]:
+        sep = "," if labels else ""
+        total = 0
+        for bound, n in zip(self.bounds, self.counts):
+            total += n
+            yield f'{name}_bucket{{{labels}{sep}le="{bound}"}} {total}'
+        yield f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}'
+        yield sample(f"{name}_sum", labels, self.sum)
+        yield sample(f"{name}_count", labels, self.count)
+
+def sample(name: str, labels: str, value) -> str:
+    return f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+
+class Metrics:
+    def __init__(self):
+        self.frames: Dict[str, int] = {}
+        self.latency: Dict[str, Histogram] = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.loop_lag = Histogram(LAG_BOUNDS)
+        self.last_lag = 0.0
+        self.reaped: Dict[str, int] = {}   # connections dropped by the liveness checks, by reason
+        self.slowed = {"rate": 0, "window": 0}   # slow_down frames sent, by reason
+        # stream compression by direction ("in": from clients, "out": to clients)
+        self.compressed = {"in": 0, "out": 0}        # frames
+        self.compress_saved = {"in": 0, "out": 0}    # bytes kept off the wire
+        self.compress_seconds = {"in": 0.0, "out": 0.0}
+        self.labels = ""   # constant labels, e.g. shard="0"
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self.collectors: List[Callable[[str], Iterable[str]]] = []   # called with the constant labels
+
+    def observe_frame(self, mtype: str, seconds: float, size: int):
+        self.frames[mtype] = self.frames.get(mtype, 0) + 1
+        hist = self.latency.get(mtype)
+        if hist is None:
+            hist = self.latency[mtype] = Histogram(LATENCY_BOUNDS)
+        hist.observe(seconds)
+        self.bytes_in += size
+
+    def observe_compress(self, direction: str, seconds: float, saved: int):
+        self.compressed[direction] += 1
+        self.compress_saved[direction] += saved
+        self.compress_seconds[direction] += seconds
+
+    async def watch_loop(self, interval: float = 0.5):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.last_lag = max(0.0, loop.time() - start - interval)
+            self.loop_lag.observe(self.last_lag)
+
+    def render(self) -> str:
+        base = self.labels
+        sep = "," if base else ""
+        out = [
+            "# TYPE fluid_frames_total counter",
+            *(f'fluid_frames_total{{{base}{sep}type="{t}"}} {n}' for t, n in sorted(self.frames.items())),
+            "# TYPE fluid_frame_seconds histogram",
+        ]
+        for t, hist in sorted(self.latency.items()):
+            out.extend(hist.render("fluid_frame_seconds", f'{base}{sep}type="{t}"'))
+        out += [
+            "# TYPE fluid_bytes_in_total counter",
+            sample("fluid_bytes_in_total", base, self.bytes_in),
+            "# TYPE fluid_bytes_out_total counter",
+            sample("fluid_bytes_out_total", base, self.bytes_out),
+            "# TYPE fluid_loop_lag_seconds histogram",
+            *self.loop_lag.render("fluid_loop_lag_seconds", base),
+            "# TYPE fluid_loop_lag_last_seconds gauge",
+            sample("fluid_loop_lag_last_seconds", base, self.last_lag),
+        ]
+        for name, values in (
+            ("fluid_compressed_frames_total", self.compressed),
+            ("fluid_compress_saved_bytes_total", self.compress_saved),
+            ("fluid_compress_seconds_total", self.compress_seconds),
+        ):
+            out.append(f"# TYPE {name} counter")
+            out.extend(f'{name}{{{base}{sep}dir="{d}"}} {v}' for d, v in values.items())
+        out.append("# TYPE fluid_reaped_total counter")
+        out.extend(f'fluid_reaped_total{{{base}{sep}reason="{r}"}} {n}' for r, n in sorted(self.reaped.items()))
+        out.append("# TYPE fluid_slow_down_total counter")
+        out.extend(f'fluid_slow_down_total{{{base}{sep}reason="{r}"}} {n}' for r, n in self.slowed.items())
+        for name, fn in self.gauges.items():
+            out += [f"# TYPE {name} gauge", sample(name, base, fn())]
+        for collect in self.collectors:
+            out.extend(collect(base))
+        return "\n".join(out) + "\n"
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self._handle_scrape, host, port)
+
+    async def _handle_scrape(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            body = self.render().encode("utf-8")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii")
+                + body
+            )
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+METRICS = Metrics()
@@ -0,0 +1,98 @@
+import bisect
+from time import monotonic
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+# Presence subscriptions of the users held by this process.
+#   watching  subscriber -> {watched user: online state last reported to them}
+#   watchers  watched user -> local subscribers
+#   pending   subscribers with a watched user that changed since the last drain
+# A change only marks subscribers; drain() reports each one's net change, so a
+# user flapping within one interval, or a mass reconnect, costs a subscriber
+# at most one frame per interval and nothing when the state came back.
+class Presence:
+    def __init__(self, max_watch: int = 256, interval: float = 1.0):
+        self.max_watch = max_watch
+        self.interval = interval   # also the longest a /who directory stays stale
+        self.watching: Dict[str, Dict[str, bool]] = {}
+        self.watchers: Dict[str, Set[str]] = {}
+        self.pending: Dict[str, Set[str]] = {}
+        self.directory: List[str] = []   # sorted snapshot for /who
+        self.dirty = True
+        self.built = 0.0
+
+    # adds to sub's watch list; returns None when it would exceed max_watch
+    def watch(self, sub: str, users: Iterable[str], online: Callable[[str], bool]) -> Optional[Dict[str, bool]]:
+        seen = self.watching.setdefault(sub, {})
+        new = [u for u in dict.fromkeys(users) if u not in seen]
+        if len(seen) + len(new) > self.max_watch:
+            if not seen:
+                del self.watching[sub]
+            return None
+        for user in new:
+            seen[user] = online(user)
+            self.watchers.setdefault(user, set()).add(sub)
+        return seen
+
+    def unwatch(self, sub: str, users: Iterable[str]):
+        seen = self.watching.get(sub)
+        if seen is None:
+            return
+        for user in users:
+            if seen.pop(user, None) is not None:
+                self._unlink(user, sub)
+        if not seen:
+            del self.watching[sub]
+            self.pending.pop(sub, None)
+
+    def forget(self, sub: str):
+        for user in self.watching.pop(sub, ()):
+            self._unlink(user, sub)
+        self.pending.pop(sub, None)
+
+    # True when somebody watches user
+    def changed(self, user: str) -> bool:
+        self.dirty = True
+        subs = self.watchers.get(user)
+        if not subs:
+            return False
+        for sub in subs:
+            self.pending.setdefault(sub, set()).add(user)
+        return True
+
+    # (subscriber, came online, went offline) for every subscriber with a net change
+    def drain(self, online: Callable[[str], bool]) -> List[Tuple[str, List[str], List[str]]]:
+        pending, self.pending = self.pending, {}
+        out = []
+        for sub, users in pending.items():
+            seen = self.watching.get(sub)
+            if seen is None:
+                continue
+            up, down = [], []
+            for user in users:
+                now = online(user)
+                if user in seen and seen[user] != now:
+                    seen[user] = now
+                    (up if now else down).append(user)
+            if up or down:
+                out.append((sub, sorted(up), sorted(down)))
+        return out
+
+    # up to limit users after the cursor, the next cursor (None on the last
+    # page) and the total
+    def page(self, after: str, limit: int, everyone: Callable[[], Iterable[str]]) -> Tuple[List[str], Optional[str], int]:
+        now = monotonic()
+        if self.dirty and now - self.built >= self.interval:
+            self.directory = sorted(everyone())
+            self.dirty = False
+            self.built = now
+        start = bisect.bisect_right(self.directory, after) if after else 0
+        users = self.directory[start : start + limit]
+        more = start + limit < len(self.directory)
+        return users, users[-1] if more and users else None, len(self.directory)
+
+    def _unlink(self, user: str, sub: str):
+        subs = self.watchers.get(user)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del self.watchers[user]
@@ -0,0 +1,50 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from typing import Optional
+
+# Resumption tokens let a client that lost its connection pick its chat back up.
+# A token is a signed {user, peer, issued} and needs no server state to check,
+# so any worker, or a relay restarted with the same --resume-key, can honour it.
+# Tokens are reissued whenever the user's chat pairing changes.
+class Resumer:
+    def __init__(self, key: Optional[bytes] = None, ttl: float = 86400.0):
+        self.key = key or os.urandom(32)
+        self.ttl = ttl
+
+    def issue(self, user: str, peer: Optional[str]) -> str:
+        body = base64.urlsafe_b64encode(json.dumps([user, peer, int(time.time())]).encode("utf-8"))
+        return (body + b"." + self._sign(body)).decode("ascii")
+
+    # the chat peer recorded in a valid token for user ("" for none), or None
+    def check(self, token, user: str) -> Optional[str]:
+        if not isinstance(token, str):
+            return None
+        body, _, sig = token.encode("ascii", "replace").partition(b".")
+        if not hmac.compare_digest(sig, self._sign(body)):
+            return None
+        try:
+            owner, peer, issued = json.loads(base64.urlsafe_b64decode(body))
+        except (ValueError, TypeError):
+            return None
+        if owner != user or time.time() - issued > self.ttl:
+            return None
+        return peer or ""
+
+    def _sign(self, body: bytes) -> bytes:
+        return base64.urlsafe_b64encode(hmac.new(self.key, body, hashlib.sha256).digest()[:18])
+
+# the key in path, created on first use so tokens survive relay restarts
+def load_key(path: str) -> bytes:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        key = os.urandom(32)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+        return key
@@ -0,0 +1,44 @@
+from typing import Dict, Set
+
+# Room membership of the users held by this process, with the reverse index
+# for disconnect cleanup. `remote` lists the other workers (by index) or
+# federated nodes (by name) that hold members of a room; they announce it with
+# room_open/room_close.
+class Rooms:
+    def __init__(self, max_per_user: int = 64):
+        self.max_per_user = max_per_user
+        self.members: Dict[str, Set[str]] = {}   # room -> users
+        self.joined: Dict[str, Set[str]] = {}    # user -> rooms
+        self.remote: Dict[str, Set] = {}         # room -> shards or nodes
+
+    def rooms_of(self, user: str) -> Set[str]:
+        return self.joined.get(user) or set()
+
+    def is_member(self, room: str, user: str) -> bool:
+        return user in self.members.get(room, ())
+
+    # True when the room just got its first local member
+    def join(self, room: str, user: str) -> bool:
+        members = self.members.get(room)
+        opened = members is None
+        if opened:
+            members = self.members[room] = set()
+        members.add(user)
+        self.joined.setdefault(user, set()).add(room)
+        return opened
+
+    # True when the room just lost its last local member
+    def leave(self, room: str, user: str) -> bool:
+        rooms = self.joined.get(user)
+        if rooms is not None:
+            rooms.discard(room)
+            if not rooms:
+                del self.joined[user]
+        members = self.members.get(room)
+        if members is None:
+            return False
+        members.discard(user)
+        if members:
+            return False
+        del self.members[room]
+        return True
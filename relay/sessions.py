@@ -0,0 +1,134 @@
+from time import monotonic
+from typing import Dict, List, Optional, Set
+
+# Chat state of the users held by this process.
+#   peers      user -> peer of their open chat (each side is kept by the process
+#              holding that user, so a session is two entries)
+#   pending    target -> {requester: expiry}, oldest first
+#   requested  requester -> targets with a request from them in `pending`
+# Every operation touches only the entries of the users involved, so a
+# disconnect costs O(that user's requests) however many are pending overall.
+class Sessions:
+    def __init__(self, request_ttl: float = 120.0, max_pending: int = 32):
+        self.request_ttl = request_ttl
+        self.max_pending = max_pending   # per target; the oldest request gives way
+        self.peers: Dict[str, str] = {}
+        self.pending: Dict[str, Dict[str, float]] = {}
+        self.requested: Dict[str, Set[str]] = {}
+        self.pending_count = 0
+
+    def peer(self, user: str) -> Optional[str]:
+        return self.peers.get(user)
+
+    # a user in a chat has no other requests either way; returns those still
+    # waiting on them, to be turned down
+    def open(self, user: str, peer: str) -> List[str]:
+        self.peers[user] = peer
+        self.drop_requests_from(user)
+        now = monotonic()
+        return [r for r, exp in self.drop_requests_to(user).items() if r != peer and exp > now]
+
+    # ends user's side if it is a chat with peer
+    def end(self, user: str, peer: str) -> bool:
+        if self.peers.get(user) != peer:
+            return False
+        del self.peers[user]
+        return True
+
+    def request(self, target: str, requester: str):
+        reqs = self.pending.get(target)
+        if reqs is not None:
+            if requester in reqs:
+                del reqs[requester]   # re-requesting moves it to the back with a fresh expiry
+                self.pending_count -= 1
+            self._expire(target, reqs)
+            while len(reqs) >= self.max_pending:
+                self._unlink(target, next(iter(reqs)), reqs)
+        reqs = self.pending.setdefault(target, {})   # _unlink drops emptied maps
+        reqs[requester] = monotonic() + self.request_ttl
+        self.pending_count += 1
+        self.requested.setdefault(requester, set()).add(target)
+
+    # requester if their request to target is pending, or the newest requester
+    def find_request(self, target: str, requester: Optional[str] = None) -> Optional[str]:
+        reqs = self.pending.get(target)
+        if not reqs:
+            return None
+        self._expire(target, reqs)
+        if requester is None:
+            return next(reversed(reqs), None)
+        return requester if requester in reqs else None
+
+    # removes and returns requester's request to target, or the newest one
+    def take_request(self, target: str, requester: Optional[str] = None) -> Optional[str]:
+        requester = self.find_request(target, requester)
+        if requester is not None:
+            self._unlink(target, requester, self.pending[target])
+        return requester
+
+    def requests(self, target: str) -> List[str]:
+        reqs = self.pending.get(target)
+        if not reqs:
+            return []
+        self._expire(target, reqs)
+        return list(reqs)
+
+    def drop_requests_from(self, requester: str):
+        for target in self.requested.pop(requester, ()):
+            reqs = self.pending.get(target)
+            if reqs is not None and reqs.pop(requester, None) is not None:
+                self.pending_count -= 1
+                if not reqs:
+                    del self.pending[target]
+
+    def drop_requests_to(self, target: str) -> Dict[str, float]:
+        reqs = self.pending.pop(target, None) or {}
+        for requester in reqs:
+            self._forget_target(requester, target)
+        self.pending_count -= len(reqs)
+        return reqs
+
+    # everything held for a user that went away; returns the peer of their chat
+    def forget(self, user: str) -> Optional[str]:
+        self.drop_requests_to(user)
+        self.drop_requests_from(user)
+        return self.peers.pop(user, None)
+
+    # state moved to the worker a user re-registered on; expiries become
+    # remaining seconds so they survive the trip
+    def export(self, user: str) -> dict:
+        now = monotonic()
+        reqs = self.drop_requests_to(user)
+        return {
+            "peer": self.peers.pop(user, None),
+            "pending": {r: exp - now for r, exp in reqs.items() if exp > now},
+        }
+
+    def restore(self, user: str, state: dict):
+        if state.get("peer"):
+            self.peers[user] = state["peer"]
+        for requester, remaining in (state.get("pending") or {}).items():
+            self.request(user, requester)
+            self.pending[user][requester] = monotonic() + remaining
+
+    def _expire(self, target: str, reqs: Dict[str, float]):
+        now = monotonic()
+        while reqs:
+            requester = next(iter(reqs))
+            if reqs[requester] > now:
+                break
+            self._unlink(target, requester, reqs)
+
+    def _unlink(self, target: str, requester: str, reqs: Dict[str, float]):
+        del reqs[requester]
+        self.pending_count -= 1
+        if not reqs:
+            self.pending.pop(target, None)
+        self._forget_target(requester, target)
+
+    def _forget_target(self, requester: str, target: str):
+        targets = self.requested.get(requester)
+        if targets is not None:
+            targets.discard(target)
+            if not targets:
+                del self.requested[requester]
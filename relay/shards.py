@@ -0,0 +1,116 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import struct
+from typing import Any, Callable, Dict, List, Optional
+from functions.net import pack_frame, read_frame, MAX_PAYLOAD, SEQ, F_SEQ, K_CONTROL, K_DELIVER, K_CHAT, K_FILE
+from relay.connection import Link
+
+# Workers of a sharded relay talk over unix sockets in <sock_dir>. Every worker
+# listens on its own socket and dials every other one, so each ordered pair has
+# one outgoing stream. Link frames reuse the client binary framing with the
+# routed user id as target:
+#   message ops (MESSAGE_OPS)  payload = from_len:u16 from payload-bytes  (never parsed)
+#   K_CONTROL                  payload = {"op": ..., "from": ..., "payload": ...}
+# A message routed for a client that sent it with a seq carries that seq as
+# clients do (F_SEQ and a seq:u32 prefix), so a refusal can name it.
+L_STORE = 0x10     # append to the recipient's offline mailbox
+L_BACKLOG = 0x11   # replayed offline message
+L_ROOM = 0x12      # room message for the receiving worker's members; target is the room
+MESSAGE_OPS = {"deliver": K_DELIVER, "chat_message": K_CHAT, "file_chunk": K_FILE, "store": L_STORE, "backlog": L_BACKLOG, "room": L_ROOM}
+MESSAGE_KINDS = {v: k for k, v in MESSAGE_OPS.items()}
+_FROM_LEN = struct.Struct("!H")
+
+OpHandler = Callable[[int, str, str, Optional[str], Any, int], Any]
+
+class ShardLinks:
+    def __init__(self, index: int, count: int, sock_dir: str, on_op: OpHandler, on_link_up: Callable[[int], Any]):
+        self.index = index
+        self.count = count
+        self.sock_dir = sock_dir
+        self.on_op = on_op
+        self.on_link_up = on_link_up
+        self.links: Dict[int, Link] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def path(self, index: int) -> str:
+        return os.path.join(self.sock_dir, f"shard-{index}.sock")
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self._accept, self.path(self.index))
+        for i in range(self.count):
+            if i != self.index:
+                asyncio.create_task(self._dial(i))
+
+    async def _dial(self, index: int):
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(self.path(index))
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+        link = Link(writer)
+        await link.send(encode_op("hello", "", str(self.index)))
+        self.links[index] = link
+        await self.on_link_up(index)
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        src = -1
+        try:
+            while True:
+                op, user, from_id, body, seq = decode_op(*await read_frame(reader, 2 * MAX_PAYLOAD))
+                if op == "hello":
+                    src = int(from_id)
+                    continue
+                await self.on_op(src, op, user, from_id, body, seq)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def send(self, index: int, op: str, user: str, from_id: Optional[str] = None, payload: Any = None, seq: int = 0):
+        link = self.links.get(index)
+        if link is not None:
+            await link.send(encode_op(op, user, from_id, payload, seq))
+
+    async def broadcast(self, op: str, user: str, from_id: Optional[str] = None, payload: Any = None):
+        data = encode_op(op, user, from_id, payload)
+        for link in self.links.values():
+            await link.send(data)
+
+def encode_op(op: str, user: str, from_id: Optional[str] = None, payload: Any = None, seq: int = 0) -> bytes:
+    kind = MESSAGE_OPS.get(op)
+    if kind is not None and isinstance(payload, (str, bytes, memoryview)):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        sender = from_id.encode("utf-8")
+        body = b"".join((_FROM_LEN.pack(len(sender)), sender, payload))
+        if seq:
+            return pack_frame(kind, user.encode("utf-8"), SEQ.pack(seq) + body, F_SEQ)
+        return pack_frame(kind, user.encode("utf-8"), body)
+    obj = {"op": op, "from": from_id, "payload": payload}
+    if seq:
+        obj["seq"] = seq
+    return pack_frame(K_CONTROL, user.encode("utf-8"), json.dumps(obj).encode("utf-8"))
+
+# (op, user, from_id, payload, seq) of a link frame; message payloads stay
+# views and seq is 0 for ops without one
+def decode_op(kind: int, flags: int, target, payload) -> tuple:
+    user = target.decode("utf-8")
+    if kind == K_CONTROL:
+        obj = json.loads(bytes(payload).decode("utf-8"))
+        return obj["op"], user, obj.get("from"), obj.get("payload"), obj.get("seq") or 0
+    seq = 0
+    if flags & F_SEQ:
+        (seq,) = SEQ.unpack_from(payload)
+        payload = payload[SEQ.size :]
+    (flen,) = _FROM_LEN.unpack_from(payload)
+    return MESSAGE_KINDS[kind], user, bytes(payload[2 : 2 + flen]).decode("utf-8"), payload[2 + flen :], seq
+
+def start_workers(target: Callable, count: int, *args) -> List[multiprocessing.Process]:
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=target, args=(i, count) + args, daemon=True) for i in range(count)]
+    for p in procs:
+        p.start()
+    return procs
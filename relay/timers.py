@@ -0,0 +1,63 @@
+import asyncio
+from time import perf_counter
+from typing import Callable, List, Optional, Set
+
+# Hashed timing wheel: an armed timer sits in the slot of the tick its deadline
+# falls in, and a single task advances the wheel every `resolution` seconds.
+# Arming and cancelling are O(1) set operations with no asyncio handle per
+# timer. Pushing a deadline later only rewrites `deadline`; when the old slot
+# comes round the timer is moved on instead of fired, so a busy connection
+# can reset its timer on every frame for the price of an attribute store.
+class Timer:
+    __slots__ = ("callback", "deadline", "tick")
+
+    def __init__(self, callback: Callable[[], None]):
+        self.callback = callback
+        self.deadline = 0.0
+        self.tick: Optional[int] = None   # slot tick while armed
+
+class TimerWheel:
+    def __init__(self, resolution: float = 0.5, slots: int = 1024):
+        self.resolution = resolution
+        self.slots: List[Set[Timer]] = [set() for _ in range(slots)]
+        self.current = int(perf_counter() / resolution)   # last tick processed
+
+    def arm(self, timer: Timer, delay: float):
+        deadline = perf_counter() + delay
+        if timer.tick is not None:
+            if deadline >= timer.deadline:
+                timer.deadline = deadline
+                return
+            self.cancel(timer)
+        timer.deadline = deadline
+        self._insert(timer)
+
+    def cancel(self, timer: Timer):
+        if timer.tick is not None:
+            self.slots[timer.tick % len(self.slots)].discard(timer)
+            timer.tick = None
+
+    def _insert(self, timer: Timer):
+        timer.tick = max(int(timer.deadline / self.resolution), self.current + 1)
+        self.slots[timer.tick % len(self.slots)].add(timer)
+
+    # callbacks run inline and may re-arm their timer; they must not raise
+    def advance(self, now: float):
+        target = int(now / self.resolution)
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            if not slot:
+                continue
+            for timer in [t for t in slot if t.tick <= self.current]:   # the rest are laps ahead
+                slot.discard(timer)
+                timer.tick = None
+                if timer.deadline > now:
+                    self._insert(timer)
+                else:
+                    timer.callback()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.resolution)
+            self.advance(perf_counter())
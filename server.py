@@ -1,146 +1,1052 @@
-import asyncio, json, signal
-from typing import Dict
-
-CLIENTS: Dict[str, asyncio.StreamWriter] = {}
-CHAT_SESSIONS: Dict[str, str] = {}  # key: user, value: peer
-PENDING_CHATS: Dict[str, str] = {}   # key: target, value: requester
-
-async def send_json(writer: asyncio.StreamWriter, obj: dict):
-    data = (json.dumps(obj) + "\n").encode("utf-8")
-    writer.write(data)
-    await writer.drain()
-
-async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    client_id = None
-    try:
-        line = await reader.readline()
-        if not line:
-            writer.close(); await writer.wait_closed(); return
-        try:
-            msg = json.loads(line.decode('utf-8').strip())
-        except json.JSONDecodeError:
-            await send_json(writer, {"type": "error", "error": "invalid_json"})
-            writer.close(); await writer.wait_closed(); return
-
-        if msg.get("type") != "register" or "id" not in msg:
-            await send_json(writer, {"type": "error", "error": "must_register_first"})
-            writer.close(); await writer.wait_closed(); return
-
-        client_id = str(msg["id"])[:128]
-
-        old = CLIENTS.get(client_id)
-        if old:
-            try:
-                await send_json(old, {"type": "info", "message": "signed_in_elsewhere"})
-                old.close()
-            except Exception:
-                pass
-        CLIENTS[client_id] = writer
-        await send_json(writer, {"type": "registered", "id": client_id})
-        print(f"+ {client_id} connected")
-
-        while not reader.at_eof():
-            line = await reader.readline()
-            if not line:
-                break
-            try:
-                msg = json.loads(line.decode('utf-8').strip())
-            except json.JSONDecodeError:
-                await send_json(writer, {"type": "error", "error": "invalid_json"})
-                continue
-
-            mtype = msg.get("type")
-            if mtype == "send":
-                to = msg.get("to"); payload = msg.get("payload", "")
-                if not to:
-                    await send_json(writer, {"type": "error", "error": "missing_to"})
-                    continue
-                target = CLIENTS.get(to)
-                if not target:
-                    await send_json(writer, {"type": "nodeliver", "to": to})
-                else:
-                    await send_json(target, {"type": "deliver", "from": client_id, "payload": payload})
-                    await send_json(writer, {"type": "sent", "to": to})
-            elif mtype == "chat_request":
-                to = msg.get("to")
-                if not to or to == client_id:
-                    await send_json(writer, {"type": "error", "error": "invalid_chat_target"})
-                    continue
-                target = CLIENTS.get(to)
-                if not target:
-                    await send_json(writer, {"type": "nodeliver", "to": to})
-                elif CHAT_SESSIONS.get(client_id) or CHAT_SESSIONS.get(to):
-                    await send_json(writer, {"type": "error", "error": "already_in_chat"})
-                else:
-                    PENDING_CHATS[to] = client_id
-                    await send_json(target, {"type": "chat_request", "from": client_id})
-            elif mtype == "chat_accept":
-                from_id = PENDING_CHATS.get(client_id)
-                if not from_id:
-                    await send_json(writer, {"type": "error", "error": "no_pending_chat"})
-                    continue
-                peer_writer = CLIENTS.get(from_id)
-                if peer_writer:
-                    CHAT_SESSIONS[client_id] = from_id
-                    CHAT_SESSIONS[from_id] = client_id
-                    await send_json(peer_writer, {"type": "chat_accept", "from": client_id})
-                    await send_json(writer, {"type": "chat_accept", "from": from_id})
-                PENDING_CHATS.pop(client_id, None)
-            elif mtype == "chat_reject":
-                from_id = PENDING_CHATS.get(client_id)
-                if from_id:
-                    peer_writer = CLIENTS.get(from_id)
-                    if peer_writer:
-                        await send_json(peer_writer, {"type": "chat_reject", "from": client_id})
-                PENDING_CHATS.pop(client_id, None)
-                await send_json(writer, {"type": "info", "message": "chat request rejected"})
-            elif mtype == "chat_message":
-                to = msg.get("to")
-                payload = msg.get("payload", "")
-                if CHAT_SESSIONS.get(client_id) == to and CHAT_SESSIONS.get(to) == client_id:
-                    target = CLIENTS.get(to)
-                    if target:
-                        await send_json(target, {"type": "chat_message", "from": client_id, "payload": payload})
-                else:
-                    await send_json(writer, {"type": "error", "error": "not_in_chat"})
-            elif mtype == "ping":
-                await send_json(writer, {"type": "pong"})
-            else:
-                await send_json(writer, {"type": "error", "error": "unknown_type"})
-    except Exception as e:
-        try:
-            await send_json(writer, {"type": "error", "error": "server_exception"})
-        except Exception:
-            pass
-    finally:
-        if client_id and CLIENTS.get(client_id) is writer:
-            CLIENTS.pop(client_id, None)
-            print(f"- {client_id} disconnected")
-            peer = CHAT_SESSIONS.pop(client_id, None)
-            if peer:
-                CHAT_SESSIONS.pop(peer, None)
-                peer_writer = CLIENTS.get(peer)
-                if peer_writer:
-                    try:
-                        await send_json(peer_writer, {"type": "info", "message": f"chat ended with {client_id}"})
-                    except Exception:
-                        pass
-            for k, v in list(PENDING_CHATS.items()):
-                if k == client_id or v == client_id:
-                    PENDING_CHATS.pop(k, None)
-        try:
-            writer.close(); await writer.wait_closed()
-        except Exception:
-            pass
-
-async def main(host="0.0.0.0", port=4040):
-    server = await asyncio.start_server(handle_client, host, port)
-    print(f"relay running on {host}:{port}")
-    async with server:
-        await server.serve_forever()
-
-if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        pass
+import argparse, asyncio, json, os, signal, sys, tempfile, zlib
+from functools import lru_cache
+from typing import Dict, List, Optional, Set, Union
+from time import perf_counter
+from functions.net import pack_frame, Deflater, Inflater, FRAME_HEADER, FROM_LEN, XFER, SEQ, F_DEFLATE, F_SEQ, K_CONTROL, K_SEND, K_DELIVER, K_CHAT, K_ROOM, K_FILE, K_ACK
+from relay.connection import Connection, OVERFLOW_POLICIES, WINDOW_MAX
+from relay.federation import Federation, parse_addr
+from relay.flow import Bucket
+from relay.mailbox import Mailbox
+from relay.metrics import METRICS, Histogram
+from relay.presence import Presence
+from relay.resume import Resumer, load_key
+from relay.rooms import Rooms
+from relay.sessions import Sessions
+from relay.shards import ShardLinks, start_workers
+from relay.timers import Timer, TimerWheel
+
+CLIENTS: Dict[str, Connection] = {}
+SESSIONS = Sessions()   # chats and pending chat requests
+ROOMS = Rooms()
+PRESENCE = Presence()   # /who and watched users
+WHO_PAGE = (100, 1000)   # default and largest /who page
+
+# sharded mode only: users held by other workers, and the links to reach them
+REMOTE: Dict[str, Union[int, str]] = {}   # key: user, value: owning shard, or node when federated
+SHARDS: Optional[ShardLinks] = None
+FEDERATION: Optional[Federation] = None
+
+MAILBOX: Optional[Mailbox] = None   # offline store, enabled with --mailbox
+
+# liveness, in seconds; 0 disables
+HEARTBEAT = 30.0      # ping a client after this long without a frame from it; only clients that
+                      # registered with "heartbeat": true are pinged, older ones never answer
+READ_TIMEOUT = 15.0   # to send `register` after connecting, and to answer a heartbeat ping
+IDLE_TIMEOUT = 0.0    # drop clients that sent nothing but pongs for this long
+WHEEL = TimerWheel()
+
+# stream compression for binary clients that ask for it; level 0 turns it off
+COMPRESS_LEVEL = 6
+COMPRESS_THRESHOLD = 64   # bytes; smaller frames are sent as they are
+
+RESUME = Resumer()
+RESUME_GRACE = 30.0   # a chat outlives its user's connection this long
+PARKED: Dict[str, Timer] = {}   # key: user who went away mid-chat, value: grace timer
+HELD: Dict[str, list] = {}   # key: such a user, value: (from, payload) of chat messages sent from here meanwhile
+HOLD_LIMIT = 256
+TASKS: Set[asyncio.Task] = set()
+
+# fairness: a client with a backlog of input is handled for this many
+# seconds, then goes to the back of the loop's ready queue behind everyone else
+SLICE = 0.002
+RATED = {"send", "chat_message", "room_message", "chat_request"}   # frames that take a token, see relay/flow.py
+PASSIVE = {"pong", "credit"}   # frames that do not count as activity for --idle-timeout
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    TASKS.add(task)
+    task.add_done_callback(TASKS.discard)
+    return task
+
+_encode = json.JSONEncoder(separators=(",", ":")).encode
+
+def encode(obj: dict, binary: bool = False) -> bytes:
+    data = _encode(obj).encode("utf-8")
+    if binary:
+        return pack_frame(K_CONTROL, b"", data)
+    return data + b"\n"
+
+PONG = (encode({"type": "pong"}), encode({"type": "pong"}, True))  # indexed by conn.binary
+PING = (encode({"type": "ping"}), encode({"type": "ping"}, True))
+
+@lru_cache(maxsize=None)
+def error(code: str, binary: bool = False) -> bytes:
+    return encode({"type": "error", "error": code}, binary)
+
+# deliver/chat_message frames are built for the recipient's framing; binary
+# recipients get the sender's payload bytes as they came off the wire
+def message_frame(conn: Connection, mtype: str, from_id: str, payload) -> bytes:
+    if conn.binary:
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif not isinstance(payload, (bytes, memoryview)):
+            payload = _encode(payload).encode("utf-8")
+        kind = K_DELIVER if mtype == "deliver" else K_CHAT
+        return pack_frame(kind, from_id.encode("utf-8"), payload)
+    if isinstance(payload, (bytes, memoryview)):
+        payload = bytes(payload).decode("utf-8", "replace")
+    return encode({"type": mtype, "from": from_id, "payload": payload})
+
+# room messages are encoded at most once per framing and the same bytes are
+# queued for every member
+def room_frame(binary: bool, room: str, from_id: str, payload) -> bytes:
+    if binary:
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif not isinstance(payload, (bytes, memoryview)):
+            payload = _encode(payload).encode("utf-8")
+        sender = from_id.encode("utf-8")
+        return pack_frame(K_ROOM, room.encode("utf-8"), b"".join((FROM_LEN.pack(len(sender)), sender, payload)))
+    if isinstance(payload, (bytes, memoryview)):
+        payload = bytes(payload).decode("utf-8", "replace")
+    return encode({"type": "room_message", "room": room, "from": from_id, "payload": payload})
+
+# file chunks keep the received payload view; the writer sends it as is
+def file_frame(from_id: str, payload) -> tuple:
+    sender = from_id.encode("utf-8")
+    return FRAME_HEADER.pack(K_FILE, 0, len(sender), len(payload)) + sender, payload
+
+async def send_json(conn: Connection, obj: dict):
+    await conn.send(encode(obj, conn.binary))
+
+# replies to a message that carried a seq name it
+async def reply_json(conn: Connection, obj: dict):
+    if conn.seq:
+        obj["seq"] = conn.seq
+    await conn.reply(encode(obj, conn.binary))
+
+async def reply_error(conn: Connection, code: str):
+    if conn.seq:
+        await conn.reply(encode({"type": "error", "error": code, "seq": conn.seq}, conn.binary))
+    else:
+        await conn.reply(error(code, conn.binary))
+
+# one cumulative ack for the messages handled since the last one
+async def send_ack(conn: Connection):
+    seq, conn.unacked = conn.unacked, 0
+    if conn.binary:
+        await conn.reply(pack_frame(K_ACK, b"", SEQ.pack(seq)))
+    else:
+        await conn.reply(encode({"type": "ack", "seq": seq}))
+
+ROOM_TYPES = {"join", "leave", "room_message"}   # JSON frames name the room in "room", not "to"
+SEQUENCED = {"send", "chat_message", "room_message"}   # may carry a seq, see functions/net.py
+
+# the next buffered frame of conn as (type, to, payload, msg, wire size, seq),
+# or None when no complete frame is buffered; msg is None for binary message
+# frames and seq is 0 for frames without one
+def read_message(conn: Connection):
+    if conn.binary:
+        frame = conn.read_frame()
+        if frame is None:
+            return None
+        kind, flags, target, payload = frame
+        size = FRAME_HEADER.size + len(target) + len(payload)
+        if flags & F_DEFLATE:
+            if conn.inflate is None:
+                raise ValueError("bad_compression")
+            started = perf_counter()
+            target, payload = conn.inflate.unpack(payload)
+            METRICS.observe_compress("in", perf_counter() - started, FRAME_HEADER.size + len(target) + len(payload) - size)
+        seq = 0
+        if flags & F_SEQ and kind != K_CONTROL:
+            if len(payload) < SEQ.size:
+                raise ValueError("invalid_seq")
+            (seq,) = SEQ.unpack_from(payload)
+            payload = payload[SEQ.size :]
+        if kind == K_SEND:
+            return "send", target.decode("utf-8"), payload, None, size, seq
+        if kind == K_CHAT:
+            return "chat_message", target.decode("utf-8"), payload, None, size, seq
+        if kind == K_ROOM:
+            return "room_message", target.decode("utf-8"), payload, None, size, seq
+        if kind == K_FILE:
+            return "file_chunk", target.decode("utf-8"), payload, None, size, 0
+        msg = json.loads(bytes(payload).decode("utf-8"))
+    else:
+        line = conn.read_line()
+        if line is None:
+            return None
+        size = len(line)
+        msg = json.loads(line.decode('utf-8').strip())
+    if not isinstance(msg, dict):
+        raise json.JSONDecodeError("frame is not an object", "", 0)
+    mtype = msg.get("type")
+    to = msg.get("room") if mtype in ROOM_TYPES else msg.get("to")
+    seq = msg.get("seq")
+    if type(seq) is not int or not 0 < seq < 1 << 32 or mtype not in SEQUENCED:
+        seq = 0
+    return mtype, to, msg.get("payload", ""), msg, size, seq
+
+# Per-user operations run on the process that holds the recipient. route()
+# runs them inline for local users and ships them over the shard or node link
+# otherwise; it returns False when nobody holds the user.
+async def route(to: str, op: str, from_id: str, payload=None, seq: int = 0) -> bool:
+    conn = CLIENTS.get(to)
+    if conn is not None:
+        await USER_OPS[op](conn, to, from_id, payload, seq)
+        return True
+    src = REMOTE.get(to)
+    if src is None:
+        return False
+    await send_to(src, op, to, from_id, payload, seq)
+    return True
+
+# src: a worker index, or a node name when federated
+async def send_to(src: Union[int, str], op: str, user: str, from_id: Optional[str] = None, payload=None, seq: int = 0):
+    if isinstance(src, str):
+        await FEDERATION.send(src, op, user, from_id, payload, seq)
+    else:
+        await SHARDS.send(src, op, user, from_id, payload, seq)
+
+def reachable(user: str) -> bool:
+    return user in CLIENTS or user in REMOTE
+
+def online(user: str) -> bool:
+    conn = CLIENTS.get(user)
+    return (conn is not None and not conn.closing) or user in REMOTE
+
+async def op_deliver(conn: Connection, to: str, from_id: str, payload, seq: int = 0):
+    await conn.send(message_frame(conn, "deliver", from_id, payload), True)
+
+# replayed offline messages wait for room instead of tripping the overflow policy
+async def op_backlog(conn: Connection, to: str, from_id: str, payload, seq: int = 0):
+    await conn.reply(message_frame(conn, "deliver", from_id, payload), True)
+
+async def op_chat_request(conn: Connection, to: str, from_id: str, payload, seq: int = 0):
+    if SESSIONS.peer(to):
+        await route(from_id, "notify", to, {"type": "error", "error": "already_in_chat"})
+        return
+    SESSIONS.request(to, from_id)
+    await send_json(conn, {"type": "chat_request", "from": from_id})
+
+# `to` may have gone into another chat since asking; the accepting side is
+# ended as any chat would be
+async def op_chat_accept(conn: Connection, to: str, from_id: str, payload, seq: int = 0):
+    if SESSIONS.peer(to) not in (None, from_id):
+        await route(from_id, "notify", to, {"type": "error", "error": "already_in_chat"})
+        await route(from_id, "chat_end", to)
+        return
+    await open_chat(to, from_id)
+    await send_json(conn, {"type": "chat_accept", "from": from_id})
+    await send_resume(conn, to)
+
+async def op_chat_reject(conn: Connection, to: str, from_id: str, payload, seq: int = 0):
+    await send_json(conn, {"type": "chat_reject", "from": from_id})
+
+# a refusal names the sender's seq, see refusal()
+async def op_chat_message(conn: Connection, to: str, from_id: str, payload, seq: int = 0):
+    if SESSIONS.peer(to) != from_id:
+        await route(from_id, "notify", to, refusal({"type": "error", "error": "not_in_chat"}, seq))
+        return
+    await conn.send(message_frame(conn, "chat_message", from_id, payload), True)
+
+async def op_chat_end(conn: Connection, to: str, from_id: str, payload, seq: int = 0):
+    HELD.pop(from_id, None)
+    if SESSIONS.end(to, from_id):
+        await send_json(conn, {"type": "info", "message": f"chat ended with {from_id}"})
+        await send_resume(conn, to)
+
+# from_id registered again with a token naming `to` as their peer; a peer
+# that has moved on ends the resumed side
+async def op_chat_resume(conn: Connection, to: str, from_id: str, payload, seq: int = 0):
+    if SESSIONS.peer(to) == from_id:
+        await send_json(conn, {"type": "info", "message": f"{from_id} is back"})
+        for sender, held in HELD.pop(from_id, ()):
+            await route(from_id, "chat_message", sender, held)
+    else:
+        await route(from_id, "chat_end", to)
+
+# file_offer/accept/ack/cancel; payload is the frame for the recipient.
+# Chunks only travel in binary framing, so text-framed clients cannot take files.
+async def op_file(conn: Connection, to: str, from_id: str, payload, seq: int = 0):
+    if payload["type"] == "file_offer" and not conn.binary:
+        cancel = {"type": "file_cancel", "from": to, "payload": {**payload["payload"], "reason": "unsupported"}}
+        await route(from_id, "notify", to, cancel)
+        return
+    await send_json(conn, payload)
+
+# a full outbox pauses the sending client rather than dropping a chunk; the
+# transfer window keeps that rare
+async def op_file_chunk(conn: Connection, to: str, from_id: str, payload, seq: int = 0):
+    if conn.binary:
+        await conn.reply(file_frame(from_id, payload), True)
+
+# A message refused by the recipient's process is answered with the sender's
+# seq. Within one process the answer comes before the ack and settles the
+# message; from another worker or node it usually comes after, and then
+# reaches the client as a frame naming an acked seq.
+def refusal(obj: dict, seq: int) -> dict:
+    if seq:
+        obj["seq"] = seq
+    return obj
+
+async def op_notify(conn: Connection, to: str, from_id: str, payload, seq: int = 0):
+    await send_json(conn, payload)
+
+USER_OPS = {
+    "deliver": op_deliver,
+    "backlog": op_backlog,
+    "chat_request": op_chat_request,
+    "chat_accept": op_chat_accept,
+    "chat_reject": op_chat_reject,
+    "chat_message": op_chat_message,
+    "chat_end": op_chat_end,
+    "chat_resume": op_chat_resume,
+    "file": op_file,
+    "file_chunk": op_file_chunk,
+    "notify": op_notify,
+}
+
+# In sharded mode every mailbox belongs to one worker, picked by hashing the user.
+def mailbox_shard(user: str) -> Optional[int]:
+    if SHARDS is None:
+        return None
+    return zlib.crc32(user.encode("utf-8")) % SHARDS.count
+
+async def store_offline(to: str, from_id: str, payload) -> bool:
+    if MAILBOX is None:
+        return False
+    owner = mailbox_shard(to)
+    if owner is None or owner == SHARDS.index:
+        return MAILBOX.append(to, from_id, payload)
+    await SHARDS.send(owner, "store", to, from_id, payload)
+    return True
+
+async def replay_offline(user: str):
+    owner = mailbox_shard(user)
+    if owner is not None and owner != SHARDS.index:
+        await SHARDS.send(owner, "replay", user)
+        return
+    count = MAILBOX.count(user)
+    if not count:
+        return
+    await route(user, "notify", user, {"type": "info", "message": f"{count} message(s) received while offline"})
+    for batch in MAILBOX.batches(user):
+        for from_id, payload, _ in batch:
+            await route(user, "backlog", from_id, payload)
+        if not online(user):
+            break   # the unfinished batch stays in the mailbox
+        await asyncio.sleep(0)
+
+# the token is reissued whenever the user's chat pairing changes
+async def send_resume(conn: Connection, user: str):
+    await send_json(conn, {"type": "resume", "token": RESUME.issue(user, SESSIONS.peer(user))})
+
+# requests still waiting on a user who went into a chat are turned down
+async def open_chat(user: str, peer: str):
+    for requester in SESSIONS.open(user, peer):
+        await route(requester, "chat_reject", user)
+
+# user is gone for good: their side goes and the peer is told
+async def end_chat(user: str, peer: str):
+    SESSIONS.end(user, peer)
+    if not await route(peer, "chat_end", user):
+        SESSIONS.end(peer, user)
+        HELD.pop(user, None)
+
+# absent went away mid-chat with waiting: hold the chat for RESUME_GRACE or end it
+async def hold_chat(absent: str, waiting: str):
+    if RESUME_GRACE:
+        await open_chat(absent, waiting)
+        park(absent, waiting)
+        await route(waiting, "notify", absent, {"type": "info", "message": f"{absent} lost connection, holding the chat for {RESUME_GRACE:g}s"})
+    else:
+        await end_chat(absent, waiting)
+
+def park(absent: str, waiting: str):
+    def expire():
+        if PARKED.get(absent) is timer:
+            del PARKED[absent]
+            spawn(end_chat(absent, waiting))
+    unpark(absent)
+    timer = PARKED[absent] = Timer(expire)
+    WHEEL.arm(timer, RESUME_GRACE)
+
+def unpark(user: str) -> bool:
+    timer = PARKED.pop(user, None)
+    if timer is None:
+        return False
+    WHEEL.cancel(timer)
+    return True
+
+# Settles the chat of a user who just registered. A valid token picks up the
+# chat held through the grace period, or, when nothing is held (another worker,
+# a restarted relay), restores the user's side from the token; the peer's
+# process confirms it with chat_resume once the user is registered. Returns the
+# peer of the resumed chat.
+async def resume_chat(user: str, token) -> Optional[str]:
+    parked = unpark(user)
+    peer = RESUME.check(token, user) if token else None
+    held = SESSIONS.peer(user)
+    if held and not parked:
+        return None   # taking over a live connection keeps its chat
+    if held and held != peer:
+        await end_chat(user, held)
+        held = None
+    if not peer:
+        return None
+    if not held:
+        if peer in CLIENTS and SESSIONS.peer(peer) != user:
+            return None
+        await open_chat(user, peer)
+        if not reachable(peer):
+            park(peer, user)   # both sides are coming back, e.g. after a relay restart
+    return peer
+
+async def join_room(room: str, user: str):
+    if ROOMS.join(room, user):
+        await broadcast("room_open", room)
+
+async def leave_room(room: str, user: str):
+    if ROOMS.leave(room, user):
+        await broadcast("room_close", room)
+
+async def broadcast(op: str, user: str):
+    if SHARDS is not None:
+        await SHARDS.broadcast(op, user)
+    if FEDERATION is not None:
+        await FEDERATION.broadcast(op, user)
+
+# each member's outbox absorbs the frame or applies its own overflow policy;
+# nobody waits for a slow member, whatever the policy
+def fan_out(room: str, from_id: str, payload) -> int:
+    frames: List[Optional[bytes]] = [None, None]   # indexed by conn.binary
+    queued = 0
+    for user in ROOMS.members.get(room, ()):
+        conn = CLIENTS.get(user)
+        if conn is None or user == from_id:
+            continue
+        frame = frames[conn.binary]
+        if frame is None:
+            frame = frames[conn.binary] = room_frame(conn.binary, room, from_id, payload)
+        queued += conn.offer(frame, True)
+    return queued
+
+async def room_message(room: str, from_id: str, payload):
+    fan_out(room, from_id, payload)
+    for src in list(ROOMS.remote.get(room, ())):
+        await send_to(src, "room", room, from_id, payload)
+
+# ops arriving from another worker, or from another node when federated (src
+# is then the node's name and a claim carries the user's registration time)
+async def handle_shard_op(src: Union[int, str], op: str, user: str, from_id: Optional[str], payload, seq: int = 0):
+    if op == "claim":
+        if isinstance(src, str) and FEDERATION.beats(user, payload, src):
+            return   # registered here later; src gives way when it hears of it
+        # user registered on src: take over like a local re-register would
+        user = sys.intern(user)
+        REMOTE[user] = src
+        presence_changed(user)
+        old = CLIENTS.pop(user, None)
+        if old is not None:
+            if FEDERATION is not None:
+                FEDERATION.down(user, announce=False)
+            await send_json(old, {"type": "info", "message": "signed_in_elsewhere"})
+            old.close()
+            state = SESSIONS.export(user)
+            state["rooms"] = list(ROOMS.rooms_of(user))
+            for room in state["rooms"]:
+                await leave_room(room, user)
+            await send_to(src, "handoff", user, None, state)
+        elif unpark(user):
+            # src settles the chat held here: resumed with the token or ended
+            await send_to(src, "handoff", user, None, {"parked": SESSIONS.peers.pop(user, None)})
+    elif op == "release":
+        if REMOTE.get(user) == src:
+            REMOTE.pop(user, None)
+            presence_changed(user)
+        SESSIONS.drop_requests_from(user)
+    elif op == "store":
+        if MAILBOX is not None:
+            MAILBOX.append(user, from_id, payload)
+    elif op == "replay":
+        if MAILBOX is not None:
+            spawn(replay_offline(user))
+    elif op == "handoff":
+        if user in CLIENTS:
+            SESSIONS.restore(user, payload)
+            for room in payload.get("rooms") or ():
+                await join_room(room, user)
+            if payload.get("peer"):
+                await send_resume(CLIENTS[user], user)
+        parked = payload.get("parked")
+        if parked and SESSIONS.peer(user) != parked:
+            await end_chat(user, parked)
+    elif op == "room_open":
+        ROOMS.remote.setdefault(user, set()).add(src)
+    elif op == "room_close":
+        shards = ROOMS.remote.get(user)
+        if shards is not None:
+            shards.discard(src)
+            if not shards:
+                del ROOMS.remote[user]
+    elif op == "room":
+        fan_out(user, from_id, payload)
+    elif user in CLIENTS:
+        await USER_OPS[op](CLIENTS[user], user, from_id, payload, seq)
+    elif op == "deliver":
+        await route(from_id, "notify", user, refusal({"type": "nodeliver", "to": user}, seq))
+    elif op == "chat_accept":
+        await route(from_id, "chat_end", user)
+
+async def announce_clients(shard: int):
+    for user in list(CLIENTS):
+        await SHARDS.send(shard, "claim", user)
+    for room in list(ROOMS.members):
+        await SHARDS.send(shard, "room_open", room)
+
+# Presence changes are collected and reported once per PRESENCE.interval by a
+# single wheel timer, armed only while something is pending.
+def presence_changed(user: str):
+    if PRESENCE.changed(user) and PRESENCE_TIMER.tick is None:
+        WHEEL.arm(PRESENCE_TIMER, PRESENCE.interval)
+
+def flush_presence():
+    for sub, up, down in PRESENCE.drain(online):
+        conn = CLIENTS.get(sub)
+        if conn is not None:
+            conn.offer(encode({"type": "presence", "online": up, "offline": down}, conn.binary))
+
+PRESENCE_TIMER = Timer(flush_presence)
+
+def everyone():
+    return set(CLIENTS).union(REMOTE)
+
+# users come with the federation's presence snapshot
+async def announce_rooms(node: str):
+    for room in list(ROOMS.members):
+        await FEDERATION.send(node, "room_open", room)
+
+# A node left the federation. Its users are unreachable until they register
+# again somewhere; chats our users had with them are held as on a disconnect.
+async def node_down(node: str):
+    gone = {user for user, src in REMOTE.items() if src == node}
+    for user in gone:
+        del REMOTE[user]
+        SESSIONS.drop_requests_from(user)
+        presence_changed(user)
+    for room, srcs in list(ROOMS.remote.items()):
+        srcs.discard(node)
+        if not srcs:
+            del ROOMS.remote[room]
+    for user, peer in list(SESSIONS.peers.items()):
+        if peer in gone and user in CLIENTS:
+            await hold_chat(peer, user)
+
+# Runs from the timer wheel. Frames only update conn.seen/conn.active; the
+# timer is re-armed here, once per period, rather than on every frame.
+def check_liveness(conn: Connection):
+    if conn.closing:
+        return
+    now = perf_counter()
+    if conn.user is None:
+        reap(conn, "register_timeout")
+        return
+    due = None
+    if HEARTBEAT and conn.heartbeat:
+        waiting = conn.pinged > conn.seen
+        if waiting and READ_TIMEOUT and now - conn.pinged >= READ_TIMEOUT:
+            reap(conn, "heartbeat_timeout")
+            return
+        last = max(conn.seen, conn.pinged)
+        if now - last >= HEARTBEAT:
+            conn.offer(PING[conn.binary])
+            conn.pinged = last = now
+            waiting = True
+        due = last + HEARTBEAT
+        if waiting and READ_TIMEOUT:
+            due = min(due, conn.pinged + READ_TIMEOUT)
+    if IDLE_TIMEOUT:
+        if now - conn.active >= IDLE_TIMEOUT:
+            METRICS.reaped["idle_timeout"] = METRICS.reaped.get("idle_timeout", 0) + 1
+            conn.offer(error("idle_timeout", conn.binary))
+            conn.close()
+            conn.timer.callback = conn.abort   # in case the goodbye cannot be flushed
+            WHEEL.arm(conn.timer, Connection.close_timeout)
+            return
+        due = conn.active + IDLE_TIMEOUT if due is None else min(due, conn.active + IDLE_TIMEOUT)
+    if due is not None:
+        WHEEL.arm(conn.timer, due - now)
+
+# aborting makes the read loop see EOF, so cleanup is the normal disconnect path
+def reap(conn: Connection, reason: str):
+    METRICS.reaped[reason] = METRICS.reaped.get(reason, 0) + 1
+    print(f"~ {conn.user or 'unregistered connection'} reaped: {reason}")
+    conn.abort()
+
+FILE_TYPES = {"file_offer", "file_accept", "file_ack", "file_cancel"}
+FRAME_TYPES = {"send", "chat_request", "chat_accept", "chat_reject", "chat_message", "join", "leave", "room_message", "file_chunk",
+               "who", "watch", "unwatch", "credit", "ping", "pong"} | FILE_TYPES
+
+async def dispatch(conn: Connection, client_id: str, mtype, to, payload):
+    if mtype == "send":
+        if not to:
+            await reply_error(conn, "missing_to")
+            return
+        if await route(to, "deliver", client_id, payload, conn.seq):
+            if not await window_closed(conn, to) and not conn.seq:
+                await reply_json(conn, {"type": "sent", "to": to})
+        elif await store_offline(to, client_id, payload):
+            await reply_json(conn, {"type": "nodeliver", "to": to, "queued": True})
+        else:
+            await reply_json(conn, {"type": "nodeliver", "to": to})
+    elif mtype == "chat_request":
+        if not to or to == client_id:
+            await reply_error(conn, "invalid_chat_target")
+            return
+        if not reachable(to):
+            await reply_json(conn, {"type": "nodeliver", "to": to})
+        elif SESSIONS.peer(client_id):
+            await reply_error(conn, "already_in_chat")
+        else:
+            await route(to, "chat_request", client_id)
+    elif mtype == "chat_accept":
+        # `to` picks one of several pending requests; without it the newest wins
+        from_id = SESSIONS.find_request(client_id, to)
+        if not from_id:
+            await reply_error(conn, "no_pending_chat")
+            return
+        if SESSIONS.peer(client_id) or SESSIONS.peer(from_id):
+            await reply_error(conn, "already_in_chat")   # the request stays pending
+            return
+        SESSIONS.take_request(client_id, from_id)
+        if reachable(from_id):
+            await open_chat(client_id, from_id)
+            await route(from_id, "chat_accept", client_id)
+            await reply_json(conn, {"type": "chat_accept", "from": from_id})
+            await send_resume(conn, client_id)
+    elif mtype == "chat_reject":
+        from_id = SESSIONS.take_request(client_id, to)
+        if from_id:
+            await route(from_id, "chat_reject", client_id)
+        await reply_json(conn, {"type": "info", "message": "chat request rejected"})
+    elif mtype == "chat_message":
+        if SESSIONS.peer(client_id) != to:
+            await reply_error(conn, "not_in_chat")
+        elif not await route(to, "chat_message", client_id, payload, conn.seq):
+            # the peer is reconnecting; their chat_resume releases what is held
+            held = HELD.setdefault(to, [])
+            queued = len(held) < HOLD_LIMIT
+            if queued:
+                held.append((client_id, payload))
+            await reply_json(conn, {"type": "nodeliver", "to": to, "queued": queued})
+        else:
+            await window_closed(conn, to)
+    elif mtype == "join":
+        if not isinstance(to, str) or not to or len(to) > 128:
+            await reply_error(conn, "invalid_room")
+            return
+        rooms = ROOMS.rooms_of(client_id)
+        if to not in rooms and len(rooms) >= ROOMS.max_per_user:
+            await reply_error(conn, "too_many_rooms")
+            return
+        await join_room(sys.intern(to), client_id)
+        await reply_json(conn, {"type": "joined", "room": to})
+    elif mtype == "leave":
+        if not ROOMS.is_member(to, client_id):
+            await reply_error(conn, "not_in_room")
+            return
+        await leave_room(to, client_id)
+        await reply_json(conn, {"type": "left", "room": to})
+    elif mtype == "room_message":
+        if not ROOMS.is_member(to, client_id):
+            await reply_error(conn, "not_in_room")
+            return
+        await room_message(to, client_id, payload)
+    elif mtype == "file_chunk":
+        # chunks only come as K_FILE frames; a JSON one would carry a str
+        if not conn.binary or not isinstance(payload, (bytes, memoryview)) or len(payload) < 4:
+            await reply_error(conn, "invalid_file_frame")
+        elif not await route(to, "file_chunk", client_id, payload):
+            # one cancel per chunk in flight; the client ignores the repeats
+            (xid,) = XFER.unpack_from(payload)
+            cancel = {"id": xid, "sender": client_id, "reason": "offline"}
+            await reply_json(conn, {"type": "file_cancel", "from": to, "payload": cancel})
+    elif mtype in FILE_TYPES:
+        if not to or not isinstance(payload, dict):
+            await reply_error(conn, "invalid_file_frame")
+        elif not await route(to, "file", client_id, {"type": mtype, "from": client_id, "payload": payload}):
+            await reply_json(conn, {"type": "nodeliver", "to": to})
+    elif mtype == "who":
+        opts = payload if isinstance(payload, dict) else {}
+        try:
+            limit = max(1, min(int(opts.get("limit") or WHO_PAGE[0]), WHO_PAGE[1]))
+        except (TypeError, ValueError):
+            limit = WHO_PAGE[0]
+        users, cursor, total = PRESENCE.page(str(opts.get("after") or ""), limit, everyone)
+        await reply_json(conn, {"type": "who", "users": users, "next": cursor, "total": total})
+    elif mtype in ("watch", "unwatch"):
+        if not isinstance(payload, list):
+            await reply_error(conn, "invalid_watch")
+        elif mtype == "unwatch":
+            PRESENCE.unwatch(client_id, map(str, payload))
+        else:
+            seen = PRESENCE.watch(client_id, (sys.intern(str(u)[:128]) for u in payload), online)
+            if seen is None:
+                await reply_error(conn, "watch_limit")
+            else:
+                state = {u: seen[u] for u in map(str, payload) if u in seen}
+                await reply_json(conn, {"type": "presence", "online": sorted(u for u, on in state.items() if on),
+                                        "offline": sorted(u for u, on in state.items() if not on)})
+    elif mtype == "credit":
+        if conn.credit is None or type(payload) is not int or payload <= 0:
+            await reply_error(conn, "invalid_credit")
+        else:
+            conn.grant(payload)
+    elif mtype == "ping":
+        await conn.reply(PONG[conn.binary])
+    elif mtype == "pong":
+        pass
+    else:
+        await reply_error(conn, "unknown_type")
+
+# A message to a local recipient beyond the credit it granted waits at the
+# relay; instead of `sent` the sender is told to slow down. Returns whether it
+# was.
+async def window_closed(conn: Connection, to: str) -> bool:
+    peer = CLIENTS.get(to)
+    if peer is None or not peer.held:
+        return False
+    METRICS.slowed["window"] += 1
+    await reply_json(conn, {"type": "slow_down", "to": to, "queued": len(peer.held)})
+    return True
+
+# Waits for the client's next token. The first wait of a burst is announced
+# with slow_down; the client's input is not handled meanwhile.
+async def throttle(conn: Connection, now: float):
+    bucket = conn.bucket
+    if bucket is None:
+        bucket = conn.bucket = Bucket(now)
+    wait = bucket.take(now)
+    if not wait:
+        return
+    if conn.unacked:
+        await send_ack(conn)
+    if not bucket.warned:
+        bucket.warned = True
+        METRICS.slowed["rate"] += 1
+        await reply_json(conn, {"type": "slow_down", "retry_after": round(wait, 3)})
+    while wait and not conn.closing:
+        await asyncio.sleep(wait)
+        wait = bucket.take(perf_counter())
+
+# protocol factory: the register timeout runs from the moment of accept
+def new_client() -> Connection:
+    conn = Connection(client_input)
+    conn.timer = Timer(lambda: check_liveness(conn))
+    if READ_TIMEOUT:
+        WHEEL.arm(conn.timer, READ_TIMEOUT)
+    return conn
+
+# Runs whenever a client has unhandled input and returns once every complete
+# frame is handled; the client's next bytes start it again. The first frame
+# must be register.
+async def client_input(conn: Connection):
+    turn = perf_counter()
+    try:
+        while not conn.closing:
+            try:
+                frame = read_message(conn)
+            except ValueError as e:
+                if conn.user is None:
+                    await reply_error(conn, "invalid_json")
+                    conn.close()
+                elif conn.binary and str(e) in ("frame_too_large", "bad_compression"):
+                    await reply_error(conn, str(e))
+                    conn.close()
+                elif str(e) == "invalid_seq":
+                    await reply_error(conn, "invalid_seq")
+                else:
+                    await reply_error(conn, "invalid_json")
+                continue
+            if frame is None:
+                break
+            mtype, to, payload, msg, size, seq = frame
+            if conn.user is None:
+                await register(conn, msg)
+                continue
+            conn.seen = started = perf_counter()
+            if mtype not in PASSIVE:
+                conn.active = started
+            if mtype in RATED and Bucket.rate:
+                await throttle(conn, started)
+                if conn.closing:
+                    break
+                started = perf_counter()
+            conn.seq = seq
+            await dispatch(conn, conn.user, mtype, to, payload)
+            if seq:
+                conn.seq, conn.unacked = 0, seq
+            done = perf_counter()
+            METRICS.observe_frame(mtype if mtype in FRAME_TYPES else "other", done - started, size)
+            if done - turn >= SLICE:
+                if conn.unacked:
+                    await send_ack(conn)
+                await asyncio.sleep(0)
+                turn = perf_counter()
+        if conn.unacked and not conn.closing:
+            await send_ack(conn)
+    except Exception:
+        try:
+            await reply_error(conn, "server_exception")
+        except Exception:
+            pass
+        conn.close()
+    if conn.lost:
+        await client_gone(conn)
+
+async def register(conn: Connection, msg: dict):
+    if msg.get("type") != "register" or "id" not in msg:
+        await reply_error(conn, "must_register_first")
+        conn.close()
+        return
+
+    # ids are interned so every table keyed by this user shares one string
+    client_id = sys.intern(str(msg["id"])[:128])
+
+    old = CLIENTS.get(client_id)
+    if old:
+        try:
+            await send_json(old, {"type": "info", "message": "signed_in_elsewhere"})
+            old.close()
+        except Exception:
+            pass
+    CLIENTS[client_id] = conn
+    REMOTE.pop(client_id, None)
+    presence_changed(client_id)
+    if SHARDS is not None:
+        await SHARDS.broadcast("claim", client_id)
+    if FEDERATION is not None:
+        FEDERATION.up(client_id)
+    resumed = await resume_chat(client_id, msg.get("resume"))
+    registered = {"type": "registered", "id": client_id, "resume": RESUME.issue(client_id, SESSIONS.peer(client_id)), "acks": True}
+    if resumed:
+        registered["chat"] = resumed
+    if "bin" in (msg.get("framing") or ()):
+        registered["framing"] = "bin"
+        if COMPRESS_LEVEL and "deflate" in (msg.get("compress") or ()):
+            registered["compress"] = "deflate"
+    # credit-based flow control: the client may be sent `window` messages and
+    # grants more with credit frames as it handles them; other frames need no credit
+    window = msg.get("window")
+    if type(window) is int and window > 0:
+        registered["window"] = conn.credit = min(window, WINDOW_MAX)
+    conn.heartbeat = msg.get("heartbeat") is True
+    if conn.heartbeat and HEARTBEAT:
+        registered["heartbeat"] = HEARTBEAT
+    await reply_json(conn, registered)
+    conn.binary = "framing" in registered
+    if "compress" in registered:
+        conn.deflate = Deflater(COMPRESS_THRESHOLD, COMPRESS_LEVEL)
+        conn.inflate = Inflater()
+    conn.user = client_id
+    conn.seen = conn.active = perf_counter()
+    WHEEL.cancel(conn.timer)
+    check_liveness(conn)
+    print(f"+ {client_id} connected")
+    if resumed:
+        await route(resumed, "chat_resume", client_id)
+    if MAILBOX is not None:
+        spawn(replay_offline(client_id))
+
+async def client_gone(conn: Connection):
+    WHEEL.cancel(conn.timer)
+    client_id = conn.user
+    if client_id and CLIENTS.get(client_id) is conn:
+        CLIENTS.pop(client_id, None)
+        print(f"- {client_id} disconnected")
+        presence_changed(client_id)
+        PRESENCE.forget(client_id)
+        for room in list(ROOMS.rooms_of(client_id)):
+            await leave_room(room, client_id)
+        peer = SESSIONS.forget(client_id)
+        if peer:
+            try:
+                await hold_chat(client_id, peer)
+            except Exception:
+                pass
+        if SHARDS is not None:
+            await SHARDS.broadcast("release", client_id)
+        if FEDERATION is not None:
+            FEDERATION.down(client_id)
+
+OUTBOX_BOUNDS = (0, 1, 4, 16, 64, 256, 1024, 4096)
+BUFFER_BOUNDS = (0, 1024, 16384, 65536, 262144, 1048576, 4194304)
+
+# per-connection backlog, sampled only when scraped
+def connection_stats(labels: str):
+    frames, buffered = Histogram(OUTBOX_BOUNDS), Histogram(BUFFER_BOUNDS)
+    for conn in CLIENTS.values():
+        frames.observe(conn.depth())
+        buffered.observe(conn.transport.get_write_buffer_size())
+    yield "# TYPE fluid_outbox_frames histogram"
+    yield from frames.render("fluid_outbox_frames", labels)
+    yield "# TYPE fluid_write_buffer_bytes histogram"
+    yield from buffered.render("fluid_write_buffer_bytes", labels)
+
+def configure(outbox_limit: int, overflow: str, heartbeat=HEARTBEAT, read_timeout=READ_TIMEOUT, idle_timeout=IDLE_TIMEOUT, request_ttl=SESSIONS.request_ttl,
+              resume_grace=RESUME_GRACE, resume_key: Optional[bytes] = None, compress_level=COMPRESS_LEVEL, compress_threshold=COMPRESS_THRESHOLD,
+              presence_interval=PRESENCE.interval, max_watch=PRESENCE.max_watch, rate=Bucket.rate, burst=Bucket.burst):
+    global HEARTBEAT, READ_TIMEOUT, IDLE_TIMEOUT, RESUME_GRACE, COMPRESS_LEVEL, COMPRESS_THRESHOLD
+    if overflow not in OVERFLOW_POLICIES:
+        raise ValueError(f"overflow must be one of {OVERFLOW_POLICIES}")
+    Connection.limit = outbox_limit
+    Connection.policy = overflow
+    HEARTBEAT, READ_TIMEOUT, IDLE_TIMEOUT = heartbeat, read_timeout, idle_timeout
+    SESSIONS.request_ttl = request_ttl
+    RESUME_GRACE = resume_grace
+    COMPRESS_LEVEL, COMPRESS_THRESHOLD = compress_level, compress_threshold
+    PRESENCE.interval, PRESENCE.max_watch = presence_interval, max_watch
+    Bucket.rate, Bucket.burst = rate, max(1.0, burst)
+    if resume_key:
+        RESUME.key = resume_key
+
+async def serve(host: str, port: int, shard=None, mailbox: Optional[dict] = None, metrics_port: Optional[int] = None,
+                federation: Optional[dict] = None):
+    global SHARDS, MAILBOX, FEDERATION
+    if shard is not None:
+        index, count, sock_dir = shard
+        SHARDS = ShardLinks(index, count, sock_dir, handle_shard_op, announce_clients)
+        await SHARDS.start()
+    if federation is not None:
+        listen = federation["listen"]
+        FEDERATION = Federation(federation["name"], federation.get("advertise") or listen, federation.get("peers") or (),
+                                handle_shard_op, announce_rooms, node_down, federation["key"])
+        await FEDERATION.start(*parse_addr(listen))
+        METRICS.gauges["fluid_federation_links"] = lambda: len(FEDERATION.links)
+        METRICS.gauges["fluid_remote_users"] = lambda: len(REMOTE)
+    if mailbox is not None:
+        owns = None if SHARDS is None else (lambda user: mailbox_shard(user) == SHARDS.index)
+        MAILBOX = Mailbox(owns=owns, **mailbox)
+    METRICS.gauges["fluid_clients"] = lambda: len(CLIENTS)
+    METRICS.gauges["fluid_chat_sessions"] = lambda: len(SESSIONS.peers) // 2
+    METRICS.gauges["fluid_pending_chats"] = lambda: SESSIONS.pending_count
+    METRICS.gauges["fluid_rooms"] = lambda: len(ROOMS.members)
+    METRICS.gauges["fluid_presence_watchers"] = lambda: len(PRESENCE.watching)
+    METRICS.gauges["fluid_parked_chats"] = lambda: len(PARKED)
+    METRICS.gauges["fluid_closed_windows"] = lambda: sum(1 for c in CLIENTS.values() if c.credit == 0)
+    METRICS.collectors.append(connection_stats)
+    spawn(METRICS.watch_loop())
+    spawn(WHEEL.run())
+    if metrics_port:
+        # one endpoint per worker: shard i listens on metrics_port + i
+        if SHARDS is not None:
+            METRICS.labels = f'shard="{SHARDS.index}"'
+            metrics_port += SHARDS.index
+        await METRICS.serve("127.0.0.1", metrics_port)
+    # every worker binds the same port; the kernel spreads accepted connections
+    server = await asyncio.get_running_loop().create_server(new_client, host, port, reuse_port=shard is not None)
+    if shard is None:
+        print(f"relay running on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def run_worker(index: int, count: int, sock_dir: str, host: str, port: int, outbox_limit: int, overflow: str, mailbox: Optional[dict], metrics_port: Optional[int], settings: Optional[dict]):
+    configure(outbox_limit, overflow, **(settings or {}))
+    try:
+        asyncio.run(serve(host, port, (index, count, sock_dir), mailbox, metrics_port))
+    except KeyboardInterrupt:
+        pass
+
+# mailbox: Mailbox keyword arguments (at least "root") to keep messages for offline users
+# metrics_port: serve Prometheus text on 127.0.0.1:metrics_port
+# settings: configure() keyword arguments (heartbeat, read_timeout, idle_timeout, request_ttl, resume_grace, resume_key,
+#           compress_level, compress_threshold, presence_interval, max_watch, rate, burst)
+# federation: {"name", "listen", "advertise", "peers", "key"} to join other relays; single worker only; key is required
+async def main(host="0.0.0.0", port=4040, outbox_limit=Connection.limit, overflow=Connection.policy, workers=1, mailbox=None, metrics_port=None, settings=None,
+               federation=None):
+    settings = dict(settings or {})
+    settings.setdefault("resume_key", os.urandom(32))   # workers must share it
+    configure(outbox_limit, overflow, **settings)
+    if workers <= 1:
+        await serve(host, port, mailbox=mailbox, metrics_port=metrics_port, federation=federation)
+        return
+    if federation is not None:
+        raise ValueError("federation runs one worker per node")
+    # SIGTERM must unwind through the finally below, or the workers are orphaned
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    with tempfile.TemporaryDirectory(prefix="fluid-relay-") as sock_dir:
+        procs = start_workers(run_worker, workers, sock_dir, host, port, outbox_limit, overflow, mailbox, metrics_port, settings)
+        print(f"relay running on {host}:{port} with {workers} workers")
+        try:
+            await asyncio.gather(*(asyncio.to_thread(p.join) for p in procs))
+        finally:
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+                p.join()
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="fluid relay")
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=4040)
+    ap.add_argument("--workers", type=int, default=1, help="worker processes sharing the port")
+    ap.add_argument("--outbox-limit", type=int, default=Connection.limit)
+    ap.add_argument("--overflow", choices=OVERFLOW_POLICIES, default=Connection.policy)
+    ap.add_argument("--heartbeat", type=float, default=HEARTBEAT, help="seconds of client silence before a ping (0: off)")
+    ap.add_argument("--read-timeout", type=float, default=READ_TIMEOUT, help="seconds to register / answer a ping (0: off)")
+    ap.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT, help="drop clients idle this long (0: off)")
+    ap.add_argument("--chat-request-ttl", type=float, default=SESSIONS.request_ttl, help="seconds a chat request stays pending")
+    ap.add_argument("--resume-grace", type=float, default=RESUME_GRACE, help="seconds a chat waits for a disconnected user (0: end it)")
+    ap.add_argument("--resume-key", metavar="FILE", help="resumption token key, created if missing; keeps tokens valid across restarts")
+    ap.add_argument("--compress-level", type=int, default=COMPRESS_LEVEL, choices=range(10), metavar="0-9", help="deflate level for clients that ask (0: off)")
+    ap.add_argument("--compress-threshold", type=int, default=COMPRESS_THRESHOLD, help="bytes; smaller frames are not compressed")
+    ap.add_argument("--presence-interval", type=float, default=PRESENCE.interval, help="seconds between presence updates to a watcher")
+    ap.add_argument("--max-watch", type=int, default=PRESENCE.max_watch, help="users one client may watch")
+    ap.add_argument("--rate", type=float, default=Bucket.rate, help="messages a second per client (0: unlimited)")
+    ap.add_argument("--burst", type=float, default=Bucket.burst, help="messages a client may send at once before --rate applies")
+    ap.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on 127.0.0.1 (worker i: port + i)")
+    ap.add_argument("--node", metavar="NAME", help="federation node name (default: the federation address)")
+    ap.add_argument("--federation", metavar="HOST:PORT", help="listen for other relays here and join their federation")
+    ap.add_argument("--advertise", metavar="HOST:PORT", help="address other nodes dial (default: --federation)")
+    ap.add_argument("--peer", metavar="HOST:PORT", action="append", default=[], help="a node to join through; repeatable")
+    ap.add_argument("--federation-key", metavar="FILE", help="shared node key, required with --federation; created if missing, copy it to every node")
+    ap.add_argument("--mailbox", metavar="DIR", help="keep messages for offline users in DIR")
+    ap.add_argument("--mailbox-max-messages", type=int, default=10000, help="per recipient")
+    ap.add_argument("--mailbox-max-mb", type=int, default=16, help="per recipient")
+    ap.add_argument("--mailbox-max-total-mb", type=int, default=1024)
+    ap.add_argument("--mailbox-max-age", type=float, default=7 * 86400, help="seconds")
+    args = ap.parse_args()
+    mailbox = None
+    if args.mailbox:
+        mailbox = {
+            "root": args.mailbox,
+            "max_user_messages": args.mailbox_max_messages,
+            "max_user_bytes": args.mailbox_max_mb << 20,
+            "max_total_bytes": args.mailbox_max_total_mb << 20,
+            "max_age": args.mailbox_max_age,
+        }
+    settings = {
+        "heartbeat": args.heartbeat,
+        "read_timeout": args.read_timeout,
+        "idle_timeout": args.idle_timeout,
+        "request_ttl": args.chat_request_ttl,
+        "resume_grace": args.resume_grace,
+        "compress_level": args.compress_level,
+        "compress_threshold": args.compress_threshold,
+        "presence_interval": args.presence_interval,
+        "max_watch": args.max_watch,
+        "rate": args.rate,
+        "burst": args.burst,
+    }
+    if args.resume_key:
+        settings["resume_key"] = load_key(args.resume_key)
+    federation = None
+    if args.federation:
+        if args.workers > 1:
+            ap.error("--federation runs one worker per node")
+        if not args.federation_key:
+            ap.error("--federation needs --federation-key: nodes only accept peers that share it")
+        advertise = args.advertise or args.federation
+        federation = {
+            "name": args.node or advertise,
+            "listen": args.federation,
+            "advertise": advertise,
+            "peers": args.peer,
+            "key": load_key(args.federation_key),
+        }
+    try:
+        asyncio.run(main(args.host, args.port, args.outbox_limit, args.overflow, args.workers, mailbox, args.metrics_port, settings, federation))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
@@ -0,0 +1,110 @@
+import asyncio
+import socket
+import subprocess
+import sys
+import time
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from functions.client import Client
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.port = free_port()
+        self.relay = subprocess.Popen([sys.executable, str(ROOT / "server.py"), "--host", "127.0.0.1", "--port", str(self.port)],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 0.2).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+
+    def tearDown(self):
+        self.relay.terminate()
+        self.relay.wait()
+
+    def test_recv_after_timeout(self):
+        async def run():
+            a, b = Client("127.0.0.1", self.port, "a"), Client("127.0.0.1", self.port, "b")
+            await a.connect()
+            await b.connect()
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(b.recv(), 0.1)
+            # the next recv waits before anything arrives, next to one that times out
+            pending = asyncio.ensure_future(b.recv())
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(b.recv(), 0.1)
+            self.assertEqual(await asyncio.wait_for(a.send("b", "hi"), 5), "sent")
+            msg = await asyncio.wait_for(pending, 5)
+            self.assertEqual((msg["type"], msg["from"], msg["payload"]), ("deliver", "a", "hi"))
+            await asyncio.wait_for(b.close(), 5)
+            self.assertIsNone(await b.recv())
+            await a.close()
+
+        asyncio.run(run())
+
+    # a client that stopped reading still gets acks for what it sends
+    def test_acks_pass_a_closed_window(self):
+        async def run():
+            a, b = Client("127.0.0.1", self.port, "a"), Client("127.0.0.1", self.port, "b", window=16)
+            await a.connect()
+            await b.connect()
+            states = await asyncio.wait_for(a.send_batch([("b", f"m{i}") for i in range(100)]), 5)
+            self.assertIn("slow", states)
+            self.assertEqual(await asyncio.wait_for(b.send("a", "still here"), 5), "sent")
+            self.assertLessEqual(len(b.incoming), 16)
+            got = 0
+            while got < 100:
+                msg = await asyncio.wait_for(b.recv(), 5)
+                got += msg["type"] == "deliver"
+            await a.close()
+            await b.close()
+
+        asyncio.run(run())
+
+    # a chat that opens turns down the other requests of both users
+    def test_accept_keeps_pairings(self):
+        async def run():
+            a, b, c, d = (Client("127.0.0.1", self.port, user) for user in "abcd")
+            for client in (a, b, c, d):
+                await client.connect()
+
+            async def expect(client, mtype):
+                while True:
+                    msg = await asyncio.wait_for(client.recv(), 5)
+                    if msg["type"] not in ("info", "resume"):
+                        self.assertEqual(msg["type"], mtype, msg)
+                        return msg
+
+            await a.chat_request("b")
+            await expect(b, "chat_request")
+            await c.chat_request("a")
+            await d.chat_request("a")
+            await expect(a, "chat_request")
+            await expect(a, "chat_request")
+            await a.chat_accept("c")
+            self.assertEqual((await expect(a, "chat_accept"))["from"], "c")
+            self.assertEqual((await expect(c, "chat_accept"))["from"], "a")
+            self.assertEqual((await expect(d, "chat_reject"))["from"], "a")
+            await b.chat_accept("a")   # a's request went when a's chat opened
+            self.assertEqual((await expect(b, "error"))["error"], "no_pending_chat")
+            await d.chat_request("b")
+            await expect(b, "chat_request")
+            await c.chat_request("b")
+            self.assertEqual((await expect(c, "error"))["error"], "already_in_chat")
+            for client in (a, b, c, d):
+                await client.close()
+
+        asyncio.run(run())
+
+if __name__ == "__main__":
+    unittest.main()
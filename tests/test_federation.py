@@ -0,0 +1,100 @@
+import asyncio
+import socket
+import sys
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from functions.net import read_frame
+from relay.federation import Federation
+from relay.shards import decode_op, encode_op
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class Node:
+    def __init__(self, name: str, key: bytes, seeds=()):
+        self.port = free_port()
+        self.ops = []
+        self.fed = Federation(name, f"127.0.0.1:{self.port}", seeds, self.on_op, self.on_up, self.on_down, key)
+
+    async def on_op(self, src, op, user, from_id, payload, seq):
+        self.ops.append((src, op, user))
+
+    async def on_up(self, name):
+        pass
+
+    async def on_down(self, name):
+        pass
+
+    async def start(self):
+        await self.fed.start("127.0.0.1", self.port)
+
+    def stop(self):
+        self.fed.server.close()
+        for link in self.fed.links.values():
+            link.close()
+
+async def until(cond, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not cond():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("timed out")
+        await asyncio.sleep(0.01)
+
+class HandshakeTest(unittest.TestCase):
+    def test_nodes_with_the_key_link(self):
+        async def run():
+            a = Node("a", b"secret")
+            b = Node("b", b"secret", [f"127.0.0.1:{a.port}"])
+            a.fed.up("alice")
+            b.fed.up("bob")
+            await a.start()
+            await b.start()
+            await until(lambda: ("a", "claim", "alice") in b.ops and ("b", "claim", "bob") in a.ops)
+            self.assertEqual(set(a.fed.links), {"b"})
+            self.assertEqual(set(b.fed.links), {"a"})
+            a.stop()
+            b.stop()
+
+        asyncio.run(run())
+
+    def test_wrong_key_gets_nothing(self):
+        async def run():
+            a = Node("a", b"secret")
+            c = Node("c", b"guess", [f"127.0.0.1:{a.port}"])
+            a.fed.up("alice")
+            await a.start()
+            await c.start()
+            await asyncio.sleep(0.5)
+            self.assertEqual((a.ops, c.ops, a.fed.links, c.fed.links), ([], [], {}, {}))
+            self.assertNotIn("c", a.fed.nodes)
+            a.stop()
+            c.stop()
+
+        asyncio.run(run())
+
+    # a stranger's hello gets a challenge and a proof, not the node list
+    def test_challenge_tells_nothing(self):
+        async def run():
+            a = Node("a", b"secret")
+            a.fed.nodes["b"] = "127.0.0.1:1"
+            await a.start()
+            reader, writer = await asyncio.open_connection("127.0.0.1", a.port)
+            writer.write(encode_op("hello", "", "x", {"nonce": "n1"}))
+            op, _, name, body, _ = decode_op(*await asyncio.wait_for(read_frame(reader), 5))
+            self.assertEqual((op, name, set(body)), ("hello", "a", {"nonce", "mac"}))
+            self.assertEqual(body["mac"], a.fed._mac("accept", "n1", "a"))
+            # answering with the node's own proof, as a reflection would, is refused
+            writer.write(encode_op("auth", "", "x", {"mac": a.fed._mac("accept", body["nonce"], "x")}))
+            self.assertEqual(await asyncio.wait_for(reader.read(), 5), b"")
+            writer.close()
+            a.stop()
+
+        asyncio.run(run())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from relay.mailbox import Mailbox, RECORD
+
+class MailboxTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.boxes = []
+
+    def tearDown(self):
+        for mb in self.boxes:
+            close(mb)
+        shutil.rmtree(self.root)
+
+    def open(self, **kwargs) -> Mailbox:
+        mb = Mailbox(self.root, **kwargs)
+        self.boxes.append(mb)
+        return mb
+
+    def replay(self, mb: Mailbox, user: str) -> list:
+        return [(from_id, bytes(p) if isinstance(p, (bytes, memoryview)) else p) for batch in mb.batches(user) for from_id, p, _ in batch]
+
+    def test_replay_after_reopen(self):
+        mb = self.open()
+        for i in range(5):
+            mb.append("bob", "alice", f"m{i}")
+        mb.append("bob", "carol", {"n": 1})
+        batches = mb.batches("bob", size=2)
+        self.assertEqual([p for _, p, _ in next(batches)], [b"m0", b"m1"])
+        next(batches)   # asking for the next batch consumes the first
+        batches.close()   # the second one was not consumed
+        close(mb)
+        mb = self.open()
+        self.assertEqual(mb.count("bob"), 4)
+        self.assertEqual(self.replay(mb, "bob"), [("alice", b"m2"), ("alice", b"m3"), ("alice", b"m4"), ("carol", {"n": 1})])
+        self.assertEqual(mb.count("bob"), 0)
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_torn_tail(self):
+        mb = self.open()
+        mb.append("bob", "alice", "first")
+        mb.append("bob", "alice", "second")
+        close(mb)
+        (name,) = os.listdir(self.root)
+        (seg,) = os.listdir(os.path.join(self.root, name))
+        path = os.path.join(self.root, name, seg)
+        good = RECORD.size + len("alice") + len("first")
+        os.truncate(path, os.path.getsize(path) - 3)   # a crash mid-append of the second
+        mb = self.open()
+        self.assertEqual(mb.count("bob"), 1)
+        self.assertEqual(os.path.getsize(path), good)
+        self.assertEqual(mb.total_bytes, good)
+        mb.append("bob", "alice", "third")
+        self.assertEqual(self.replay(mb, "bob"), [("alice", b"first"), ("alice", b"third")])
+
+    # whole segments give way, oldest first, once a user is over the cap
+    def test_user_byte_cap(self):
+        record = RECORD.size + len("alice") + len("m0")
+        mb = self.open(segment_bytes=2 * record, max_user_bytes=5 * record)
+        for i in range(6):
+            self.assertTrue(mb.append("bob", "alice", f"m{i}"))
+        self.assertEqual(mb.count("bob"), 4)
+        self.assertEqual(mb.total_bytes, 4 * record)
+        self.assertFalse(mb.append("bob", "alice", "x" * 6 * record))   # larger than the cap on its own
+        mb.append("carol", "alice", "c0")   # other users keep their own cap
+        self.assertEqual(self.replay(mb, "bob"), [("alice", f"m{i}".encode()) for i in range(2, 6)])
+        self.assertEqual(mb.count("carol"), 1)
+
+def close(mb: Mailbox):
+    while mb.fds:
+        os.close(mb.fds.popitem()[1])
+
+if __name__ == "__main__":
+    unittest.main()
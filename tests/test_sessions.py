@@ -0,0 +1,124 @@
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from relay.sessions import Sessions
+
+class SessionsTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("relay.sessions.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sessions = Sessions(request_ttl=10.0, max_pending=3)
+
+    def test_request_and_take(self):
+        s = self.sessions
+        s.request("alice", "bob")
+        s.request("alice", "carol")
+        self.assertEqual(s.requests("alice"), ["bob", "carol"])
+        self.assertEqual(s.take_request("alice"), "carol")   # the newest
+        self.assertEqual(s.take_request("alice", "dave"), None)
+        self.assertEqual(s.take_request("alice", "bob"), "bob")
+        self.assertEqual(s.take_request("alice"), None)
+        self.assertEqual((s.pending, s.requested, s.pending_count), ({}, {}, 0))
+
+    def test_find_keeps_the_request(self):
+        s = self.sessions
+        s.request("alice", "bob")
+        self.assertEqual(s.find_request("alice"), "bob")
+        self.assertEqual(s.find_request("alice", "bob"), "bob")
+        self.assertEqual(s.requests("alice"), ["bob"])
+
+    def test_re_request_moves_to_the_back(self):
+        s = self.sessions
+        s.request("alice", "bob")
+        s.request("alice", "carol")
+        s.request("alice", "bob")
+        self.assertEqual(s.requests("alice"), ["carol", "bob"])
+        self.assertEqual(s.pending_count, 2)
+
+    def test_oldest_request_gives_way(self):
+        s = self.sessions
+        for requester in ("a", "b", "c", "d"):
+            s.request("alice", requester)
+        self.assertEqual(s.requests("alice"), ["b", "c", "d"])
+        self.assertNotIn("a", s.requested)
+        self.assertEqual(s.pending_count, 3)
+
+    def test_expiry(self):
+        s = self.sessions
+        s.request("alice", "bob")
+        self.now += 5
+        s.request("alice", "carol")
+        self.now += 6   # bob's request is 11s old, carol's 6s
+        self.assertEqual(s.requests("alice"), ["carol"])
+        self.assertEqual(s.take_request("alice", "bob"), None)
+        self.now += 5
+        self.assertEqual(s.take_request("alice"), None)
+        self.assertEqual((s.pending, s.requested, s.pending_count), ({}, {}, 0))
+
+    def test_open_and_end(self):
+        s = self.sessions
+        self.assertEqual(s.open("alice", "bob"), [])
+        self.assertEqual(s.peer("alice"), "bob")
+        self.assertFalse(s.end("alice", "carol"))
+        self.assertTrue(s.end("alice", "bob"))
+        self.assertIsNone(s.peer("alice"))
+
+    # opening a chat drops the user's other requests, both ways, and names
+    # those still waiting on them
+    def test_open_drops_other_requests(self):
+        s = self.sessions
+        s.request("alice", "bob")
+        self.now += 11   # bob's request expires
+        s.request("alice", "carol")
+        s.request("alice", "erin")
+        s.request("dave", "alice")
+        self.assertEqual(s.take_request("alice", "erin"), "erin")
+        self.assertEqual(s.open("alice", "erin"), ["carol"])
+        self.assertEqual(s.requests("alice"), [])
+        self.assertEqual(s.requests("dave"), [])
+        self.assertEqual((s.pending, s.requested, s.pending_count), ({}, {}, 0))
+
+    # both asked each other; the peer's own request is not turned down
+    def test_open_with_crossed_requests(self):
+        s = self.sessions
+        s.request("alice", "bob")
+        s.request("bob", "alice")
+        s.request("carol", "dave")
+        self.assertEqual(s.take_request("bob", "alice"), "alice")
+        self.assertEqual(s.open("bob", "alice"), [])
+        self.assertEqual(s.open("alice", "bob"), [])
+        self.assertEqual(s.requests("carol"), ["dave"])
+        self.assertEqual(s.pending_count, 1)
+
+    def test_forget(self):
+        s = self.sessions
+        s.open("alice", "bob")
+        s.request("alice", "carol")
+        s.request("dave", "alice")
+        self.assertEqual(s.forget("alice"), "bob")
+        self.assertIsNone(s.peer("alice"))
+        self.assertEqual((s.pending, s.requested, s.pending_count), ({}, {}, 0))
+
+    def test_export_and_restore(self):
+        s = self.sessions
+        s.open("alice", "bob")
+        s.request("alice", "carol")
+        self.now += 4
+        state = s.export("alice")
+        self.assertEqual(state, {"peer": "bob", "pending": {"carol": 6.0}})
+        other = Sessions(request_ttl=10.0)
+        other.restore("alice", state)
+        self.assertEqual(other.peer("alice"), "bob")
+        self.now += 5
+        self.assertEqual(other.requests("alice"), ["carol"])
+        self.now += 2
+        self.assertEqual(other.requests("alice"), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+import sys
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from functions.net import FRAME_HEADER
+from relay.shards import decode_op, encode_op
+
+def roundtrip(data: bytes) -> tuple:
+    kind, flags, tlen, plen = FRAME_HEADER.unpack_from(data)
+    body = memoryview(data)[FRAME_HEADER.size :]
+    op, user, from_id, payload, seq = decode_op(kind, flags, bytes(body[:tlen]), body[tlen : tlen + plen])
+    if isinstance(payload, memoryview):
+        payload = bytes(payload)
+    return op, user, from_id, payload, seq
+
+class LinkFrameTest(unittest.TestCase):
+    def test_message_ops(self):
+        self.assertEqual(roundtrip(encode_op("chat_message", "bob", "alice", "hi")), ("chat_message", "bob", "alice", b"hi", 0))
+        self.assertEqual(roundtrip(encode_op("deliver", "bob", "alice", b"hi", 7)), ("deliver", "bob", "alice", b"hi", 7))
+
+    def test_control_ops(self):
+        self.assertEqual(roundtrip(encode_op("chat_end", "bob", "alice")), ("chat_end", "bob", "alice", None, 0))
+        # a message whose payload is not text goes as a control op and keeps its seq
+        self.assertEqual(roundtrip(encode_op("chat_message", "bob", "alice", {"n": 1}, 9)), ("chat_message", "bob", "alice", {"n": 1}, 9))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from relay.timers import Timer, TimerWheel
+
+# an 8-slot wheel of 1s ticks on a clock the test moves by hand
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch("relay.timers.perf_counter", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.wheel = TimerWheel(resolution=1.0, slots=8)
+        self.fired = []
+
+    def timer(self, name: str) -> Timer:
+        return Timer(lambda: self.fired.append((name, self.now)))
+
+    def run_until(self, end: float):
+        while self.now < end:
+            self.now += 1
+            self.wheel.advance(self.now)
+
+    # delays longer than a revolution pass their slot until their lap comes
+    def test_lapping_timers(self):
+        self.wheel.arm(self.timer("far"), 20)
+        self.wheel.arm(self.timer("near"), 3)
+        self.wheel.arm(self.timer("lap"), 8)
+        self.run_until(130)
+        self.assertEqual(self.fired, [("near", 103), ("lap", 108), ("far", 120)])
+
+    def test_cancel(self):
+        a, b = self.timer("a"), self.timer("b")
+        self.wheel.arm(a, 2)
+        self.wheel.arm(b, 2)
+        self.wheel.cancel(a)
+        self.wheel.cancel(a)   # twice is harmless
+        self.run_until(110)
+        self.assertEqual(self.fired, [("b", 102)])
+        self.assertIsNone(a.tick)
+        self.assertEqual([s for s in self.wheel.slots if s], [])
+
+    # a later deadline moves the timer on when its old slot comes round; an
+    # earlier one moves it back, and it fires once
+    def test_rearm(self):
+        later, sooner = self.timer("later"), self.timer("sooner")
+        self.wheel.arm(later, 5)
+        self.wheel.arm(sooner, 10)
+        self.run_until(103)
+        self.wheel.arm(later, 5)
+        self.wheel.arm(sooner, 1)
+        self.run_until(120)
+        self.assertEqual(self.fired, [("sooner", 104), ("later", 108)])
+
+    def test_rearm_from_callback(self):
+        def tick():
+            self.fired.append(self.now)
+            if len(self.fired) < 3:
+                self.wheel.arm(timer, 2)
+        timer = Timer(tick)
+        self.wheel.arm(timer, 2)
+        self.run_until(110)
+        self.assertEqual(self.fired, [102, 104, 106])
+
+    # a clock that jumps ahead fires everything due, in tick order
+    def test_jump(self):
+        for delay in (9, 2, 17):
+            self.wheel.arm(self.timer(delay), delay)
+        self.now = 125
+        self.wheel.advance(self.now)
+        self.assertEqual([name for name, _ in self.fired], [2, 9, 17])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,30 +1,58 @@
 import curses
+import sys
+from bisect import bisect_right
 from collections import deque
-from typing import Deque, Tuple, Optional
-from .widgets import Button, Modal
+from typing import Deque, List, Set, Tuple, Optional
+from .widgets import Button, InputLine, Modal
 from functions.constants import PROMPT, CHAT_PROMPT
 
+# bracketed paste: the terminal wraps pasted text in ESC[200~ ... ESC[201~
+PASTE_ON = "\x1b[?2004h"
+PASTE_OFF = "\x1b[?2004l"
+PASTE_START = [27, ord("["), ord("2"), ord("0"), ord("0"), ord("~")]
+PASTE_END = [27, ord("["), ord("2"), ord("0"), ord("1"), ord("~")]
+
 class CursesUI:
     def __init__(self, stdscr, my_id: str):
         self.stdscr = stdscr
         self.my_id = my_id
 
+        # the newest max_log_lines lines; scrolling back past them pages older
+        # history rows in (want_older) and the log grows until the view is
+        # back at the bottom. line_ids holds each line's history row, or None.
         self.max_log_lines = 2000
-        self.log: Deque[str] = deque(maxlen=self.max_log_lines)
+        self.log: Deque[str] = deque()
+        self.line_ids: Deque[Optional[int]] = deque()
+        self.line_base = 0   # number of log[0]; a line keeps its number while trims and pages move it
+        self.want_older = False
 
         self.input_history: Deque[str] = deque(maxlen=300)
         self.history_index: Optional[int] = None
-        self.input_buffer = ""
-        self.cursor_pos = 0
+        self.input = InputLine()
+        self.paste: Optional[bytearray] = None   # raw bytes of a paste in progress
 
         self.chat_peer: Optional[str] = None
         self.pending_from: Optional[str] = None
 
         self.modal: Optional[Modal] = None
+        self.overlay: Optional[List[str]] = None   # /stats box over the top right of the log
         self.should_exit = False
 
         self.scroll_offset = 0
 
+        # wrapped log rows, kept up to date as lines arrive and rebuilt only when
+        # the width changes. rows[i] is absolute row row_base + i and line_start
+        # maps each line of `log` to its first absolute row.
+        self.rows: List[str] = []
+        self.row_base = 0
+        self.line_start: Deque[int] = deque()
+        self.wrap_width = max(1, stdscr.getmaxyx()[1] - 1)
+        self.log_height = 0
+
+        # screen regions to repaint on the next draw(): header, log, input, all
+        self.dirty: Set[str] = {"all"}
+        self.size: Tuple[int, int] = (0, 0)
+
         curses.curs_set(1)
         curses.mousemask(curses.ALL_MOUSE_EVENTS | curses.REPORT_MOUSE_POSITION)
         curses.start_color()
@@ -45,75 +73,115 @@ class CursesUI:
         self.stdscr.bkgd(' ', self.cyan_text)
 
     def draw(self):
-        self.stdscr.erase()
         h, w = self.stdscr.getmaxyx()
-
-        header = f" ur id {self.my_id} "
-        status = f"status: {'chatting with ' + self.chat_peer if self.chat_peer else 'idle'}"
-        pad = max(0, w - len(header) - len(status) - 1)
-        header_line = header + " " * pad + status
-        if w > 0:
-            self.stdscr.addstr(0, 0, header_line[: w - 1], curses.A_BOLD | self.cyan_bg)
-
-        self._hline(1, w)
-
         log_top = 2
         input_height = 3
         log_bottom = max(log_top, h - input_height)
-        log_height = max(0, log_bottom - log_top)
-        self._draw_log(log_top, w, log_height)
+        self.log_height = max(0, log_bottom - log_top)
+        if (h, w) != self.size:
+            self.size = (h, w)
+            if max(1, w - 1) != self.wrap_width:
+                self._rewrap(max(1, w - 1))
+            self.dirty.add("all")
+
+        dirty = self.dirty
+        if not dirty:
+            return
+        full = "all" in dirty
+        if full:
+            self.stdscr.erase()
+            self._hline(1, w)
+            self._hline(log_bottom, w)
+            help_text = "Keys: Enter=send  ↑/↓=history  PgUp/PgDn=scroll  Ctrl+U/Ctrl+K=kill  /help"
+            if h - 1 >= 0 and w > 0:
+                self.stdscr.addstr(h - 1, 0, help_text[: w - 1], self.blue_bg)
+
+        if full or "header" in dirty:
+            header = f" ur id {self.my_id} "
+            status = f"status: {'chatting with ' + self.chat_peer if self.chat_peer else 'idle'}"
+            pad = max(0, w - len(header) - len(status) - 1)
+            header_line = header + " " * pad + status
+            if w > 0:
+                self.stdscr.addstr(0, 0, header_line[: w - 1], curses.A_BOLD | self.cyan_bg)
 
-        self._hline(log_bottom, w)
+        if full or "log" in dirty:
+            self._draw_log(log_top, w, self.log_height, clear=not full)
+        if self.overlay is not None and (full or "log" in dirty):
+            self._draw_overlay(log_top, w, self.log_height)
 
         prompt = CHAT_PROMPT if self.chat_peer else PROMPT
-        self._draw_input(log_bottom + 1, w, prompt)
-
-        help_text = "Keys: Enter=send  ↑/↓=history  PgUp/PgDn=scroll  Ctrl+U/Ctrl+K=kill  /help"
-        if h - 1 >= 0 and w > 0:
-            self.stdscr.addstr(h - 1, 0, help_text[: w - 1], self.blue_bg)
+        if full or "input" in dirty or "header" in dirty:
+            self._draw_input(log_bottom + 1, w, prompt)
 
         if self.modal:
             self._draw_modal(self.modal)
-
-        if not self.modal:
-            cur_x = len(prompt) + self.cursor_pos
+        else:
+            cur_x = len(prompt) + self.input.cursor - self.input_scroll(w, prompt)
             cy = log_bottom + 1
             if 0 <= cy < h and 0 <= cur_x < w:
                 self.stdscr.move(cy, cur_x)
 
+        dirty.clear()
         self.stdscr.refresh()
 
-    def _draw_log(self, top: int, w: int, height: int):
-        lines = list(self.log)
-
-        wrapped = []
-        wrapw = max(1, w - 1)
-        for ln in lines:
-            if not ln:
-                wrapped.append("")
-                continue
-            start = 0
-            while start < len(ln):
-                wrapped.append(ln[start : start + wrapw])
-                start += wrapw
-
-        total = len(wrapped)
-        start_index = max(0, total - height - self.scroll_offset)
-        end_index = max(0, total - self.scroll_offset)
-        visible = wrapped[start_index:end_index][-height:]
-
-        y = top
-        for ln in visible:
-            if y >= top + height:
-                break
-            if w > 0:
-                self.stdscr.addstr(y, 0, ln[: w - 1], self.cyan_text)
-            y += 1
+    # only the visible rows are touched, whatever the length of the history
+    def _draw_log(self, top: int, w: int, height: int, clear: bool = False):
+        end = self.row_base + len(self.rows)
+        first = self.line_start[0] if self.line_start else end
+        stop = max(first, end - self.scroll_offset)
+        start = max(first, stop - height)
+        visible = self.rows[start - self.row_base : stop - self.row_base]
+
+        for i in range(height):
+            y = top + i
+            if clear:
+                self.stdscr.move(y, 0)
+                self.stdscr.clrtoeol()
+            if i < len(visible) and w > 0:
+                self.stdscr.addstr(y, 0, visible[i][: w - 1], self.cyan_text)
+
+    def _draw_overlay(self, top: int, w: int, height: int):
+        box_w = max(map(len, self.overlay)) + 2
+        x = max(0, w - 1 - box_w)
+        for i, text in enumerate(self.overlay[:height]):
+            self.stdscr.addstr(top + i, x, f" {text:{box_w - 2}} "[: w - 1 - x], self.blue_bg)
+
+    def _wrap(self, ln: str) -> List[str]:
+        wrapw = self.wrap_width
+        return [ln[i : i + wrapw] for i in range(0, len(ln), wrapw)] or [""]
+
+    def _rewrap(self, width: int):
+        # keep the line at the top of a scrolled-back view in place
+        anchor = None
+        if self.scroll_offset and self.line_start:
+            top = self.row_base + len(self.rows) - self.scroll_offset - self.log_height
+            anchor = max(0, bisect_right(self.line_start, top) - 1)
+        self.wrap_width = width
+        self.rows = []
+        self.row_base = 0
+        self.line_start.clear()
+        for ln in self.log:
+            self.line_start.append(len(self.rows))
+            self.rows.extend(self._wrap(ln))
+        if anchor is not None:
+            self.scroll_offset = max(0, len(self.rows) - self.log_height - self.line_start[anchor])
+
+    def _max_scroll(self) -> int:
+        end = self.row_base + len(self.rows)
+        first = self.line_start[0] if self.line_start else end
+        return max(0, end - first - self.log_height)
 
     def _draw_input(self, y: int, w: int, prompt: str):
         if y < curses.LINES and w > 0:
+            self.stdscr.move(y, 0)
+            self.stdscr.clrtoeol()
             self.stdscr.addstr(y, 0, prompt, self.blue_bg)
-            self.stdscr.addstr(y, len(prompt), self.input_buffer[:w-len(prompt)-1], self.cyan_text)
+            start = self.input_scroll(w, prompt)
+            self.stdscr.addstr(y, len(prompt), self.input.text()[start : start + w - len(prompt) - 1], self.cyan_text)
+
+    # first input character shown, so that the cursor stays on screen
+    def input_scroll(self, w: int, prompt: str) -> int:
+        return max(0, self.input.cursor - max(1, w - len(prompt) - 1) + 1)
 
     def _hline(self, y: int, w: int):
         if 0 <= y < curses.LINES and w > 0:
@@ -172,12 +240,82 @@ class CursesUI:
             b.set_bounds(by, x + start, 1, max(1, end - start))
             x += len(text) + 3
 
-    def log_line(self, s: str):
+    # returns the number of the (last) line added, for replace_line
+    def log_line(self, s: str, rid: Optional[int] = None) -> int:
         for ln in s.splitlines() or [""]:
             self.log.append(ln)
+            self.line_ids.append(rid)
+            self.line_start.append(self.row_base + len(self.rows))
+            added = self._wrap(ln)
+            self.rows.extend(added)
+            if self.scroll_offset:
+                self.scroll_offset += len(added)   # a scrolled-back view stays put
+        number = self.line_base + len(self.log) - 1
+        if not self.scroll_offset:
+            self._trim()
+            self.dirty.add("log")
+        return number
+
+    # swaps line `number` (from log_line) for new, which must be as long so
+    # the wrapped rows stay put (delivery marks); False once it was trimmed
+    def replace_line(self, number: int, new: str) -> bool:
+        i = number - self.line_base
+        if not 0 <= i < len(self.log):
+            return False
+        self.log[i] = new
+        start = self.line_start[i] - self.row_base
+        added = self._wrap(new)
+        self.rows[start : start + len(added)] = added
+        self.dirty.add("log")
+        return True
+
+    # rows: (history id, text) oldest first, all older than what is in the log
+    def prepend_lines(self, rows):
+        self._drop_dead_rows(0)
+        new_rows, starts, lines, ids = [], [], [], []
+        for rid, text in rows:
+            for ln in text.splitlines() or [""]:
+                starts.append(len(new_rows))
+                lines.append(ln)
+                ids.append(rid)
+                new_rows.extend(self._wrap(ln))
+        self.rows[0:0] = new_rows
+        self.row_base -= len(new_rows)
+        self.line_start.extendleft(self.row_base + start for start in reversed(starts))
+        self.log.extendleft(reversed(lines))
+        self.line_ids.extendleft(reversed(ids))
+        self.line_base -= len(lines)
+        self.dirty.add("log")
+
+    # the history row of the oldest line held, if any line has one
+    def oldest_id(self) -> Optional[int]:
+        return next((rid for rid in self.line_ids if rid is not None), None)
+
+    def _trim(self):
+        while len(self.log) > self.max_log_lines:
+            self.log.popleft()
+            self.line_ids.popleft()
+            self.line_start.popleft()
+            self.line_base += 1
+        self._drop_dead_rows(len(self.rows) // 2)
+
+    # rows of dropped lines go once there are more than keep of them
+    def _drop_dead_rows(self, keep: int):
+        end = self.row_base + len(self.rows)
+        dead = (self.line_start[0] if self.line_start else end) - self.row_base
+        if dead > keep:
+            del self.rows[:dead]
+            self.row_base += dead
 
     def set_chat_peer(self, peer: Optional[str]):
         self.chat_peer = peer
+        self.dirty.add("header")
+
+    # None hides it; the same list again is a no-op
+    def set_overlay(self, lines: Optional[List[str]]):
+        if lines is not self.overlay:
+            self.overlay = lines
+            self.dirty.add("log")
 
     def set_pending_from(self, f: Optional[str]):
         self.pending_from = f
@@ -189,9 +327,46 @@ class CursesUI:
             message=f"{from_id} wants to chat.",
             buttons=(Button("accept"), Button("reject")),
         )
+        self.dirty.add("all")
+
+    def bracketed_paste(self, on: bool):
+        sys.stdout.write(PASTE_ON if on else PASTE_OFF)
+        sys.stdout.flush()
+
+    # all keys read in one wakeup; pastes are collected and inserted in one go
+    def handle_keys(self, keys: List[int]) -> List[str]:
+        cmds = []
+        i = 0
+        while i < len(keys):
+            ch = keys[i]
+            if ch == 27 and keys[i : i + 6] == (PASTE_END if self.paste is not None else PASTE_START):
+                if self.paste is None:
+                    self.paste = bytearray()
+                else:
+                    self._insert_paste(self.paste.decode("utf-8", "replace"))
+                    self.paste = None
+                i += 6
+                continue
+            if self.paste is not None:
+                if ch < 256:
+                    self.paste.append(ch)
+            else:
+                cmd = self.handle_key(ch)
+                if cmd is not None:
+                    cmds.append(cmd)
+            i += 1
+        return cmds
+
+    def _insert_paste(self, text: str):
+        if self.modal:
+            return
+        # the input is a single line: newlines and other control characters become spaces
+        self.input.insert("".join(c if c.isprintable() else " " for c in text.replace("\r\n", "\n")))
+        self.dirty.add("input")
 
     def handle_key(self, ch) -> Optional[str]:
         if self.modal:
+            self.dirty.add("all")
             if ch in (curses.KEY_LEFT,):
                 self.modal.prev()
                 return None
@@ -225,22 +400,20 @@ class CursesUI:
                     pass
             return None
 
+        self.dirty.add("input")
         if ch in (10, 13):
-            cmd = self.input_buffer.strip()
+            cmd = self.input.text().strip()
             if cmd:
                 self.input_history.append(cmd)
             self.history_index = None
-            self.input_buffer = ""
-            self.cursor_pos = 0
+            self.input.set("")
             return cmd
 
         if ch == curses.KEY_LEFT:
-            if self.cursor_pos > 0:
-                self.cursor_pos -= 1
+            self.input.move_left()
             return None
         if ch == curses.KEY_RIGHT:
-            if self.cursor_pos < len(self.input_buffer):
-                self.cursor_pos += 1
+            self.input.move_right()
             return None
         if ch == curses.KEY_UP:
             self._history_prev()
@@ -249,27 +422,29 @@ class CursesUI:
             self._history_next()
             return None
         if ch == curses.KEY_PPAGE:
-            self.scroll_offset = min(self.scroll_offset + 5, max(0, len(self.log) - 1))
+            top = self._max_scroll()
+            self.want_older = self.scroll_offset + 5 > top
+            self.scroll_offset = min(self.scroll_offset + 5, top)
+            self.dirty.add("log")
             return None
         if ch == curses.KEY_NPAGE: 
             self.scroll_offset = max(0, self.scroll_offset - 5)
+            if not self.scroll_offset:
+                self._trim()
+            self.dirty.add("log")
             return None
 
         if ch == 21:
-            self.input_buffer = self.input_buffer[self.cursor_pos:]
-            self.cursor_pos = 0
+            self.input.kill_before()
             return None
         if ch == 11: 
-            self.input_buffer = self.input_buffer[: self.cursor_pos]
+            self.input.kill_after()
             return None
         if ch in (curses.KEY_BACKSPACE, 127, 8):
-            if self.cursor_pos > 0:
-                self.input_buffer = self.input_buffer[: self.cursor_pos - 1] + self.input_buffer[self.cursor_pos :]
-                self.cursor_pos -= 1
+            self.input.backspace()
             return None
         if ch == curses.KEY_DC:
-            if self.cursor_pos < len(self.input_buffer):
-                self.input_buffer = self.input_buffer[: self.cursor_pos] + self.input_buffer[self.cursor_pos + 1 :]
+            self.input.delete()
             return None
 
         if ch == curses.KEY_MOUSE:
@@ -280,9 +455,7 @@ class CursesUI:
             return None
 
         if 32 <= ch <= 126:
-            c = chr(ch)
-            self.input_buffer = self.input_buffer[: self.cursor_pos] + c + self.input_buffer[self.cursor_pos :]
-            self.cursor_pos += 1
+            self.input.insert(chr(ch))
             return None
 
         return None
@@ -294,16 +467,14 @@ class CursesUI:
             self.history_index = len(self.input_history) - 1
         elif self.history_index > 0:
             self.history_index -= 1
-        self.input_buffer = self.input_history[self.history_index]
-        self.cursor_pos = len(self.input_buffer)
+        self.input.set(self.input_history[self.history_index])
 
     def _history_next(self):
         if self.history_index is None:
             return
         if self.history_index < len(self.input_history) - 1:
             self.history_index += 1
-            self.input_buffer = self.input_history[self.history_index]
+            self.input.set(self.input_history[self.history_index])
         else:
             self.history_index = None
-            self.input_buffer = ""
-        self.cursor_pos = len(self.input_buffer)
+            self.input.set("")
@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import List, Tuple
 
 class Button:
     def __init__(self, label: str):
@@ -24,3 +24,47 @@ class Modal:
 
     def prev(self):
         self.selected = (self.selected - 1) % len(self.buttons)
+
+# Edit line kept as two stacks split at the cursor: characters before it in
+# order, characters after it reversed. Typing, deleting and moving by one are
+# O(1) wherever the cursor is; a paste is a single extend.
+class InputLine:
+    def __init__(self):
+        self.left: List[str] = []
+        self.right: List[str] = []
+
+    @property
+    def cursor(self) -> int:
+        return len(self.left)
+
+    def text(self) -> str:
+        return "".join(self.left) + "".join(reversed(self.right))
+
+    def set(self, text: str):
+        self.left = list(text)
+        self.right = []
+
+    def insert(self, text: str):
+        self.left.extend(text)
+
+    def backspace(self):
+        if self.left:
+            self.left.pop()
+
+    def delete(self):
+        if self.right:
+            self.right.pop()
+
+    def move_left(self):
+        if self.left:
+            self.right.append(self.left.pop())
+
+    def move_right(self):
+        if self.right:
+            self.left.append(self.right.pop())
+
+    def kill_before(self):
+        self.left = []
+
+    def kill_after(self):
+        self.right = []